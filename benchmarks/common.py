@@ -0,0 +1,27 @@
+# Helpers shared by the benchmarks: run them from the repository root, e.g. python benchmarks/save_bindings.py
+import argparse
+import importlib.util
+import os
+import sys
+import tempfile
+
+os.environ.setdefault('PYWIKIBOT_NO_USER_CONFIG', '2')
+os.environ.setdefault('PYWIKIBOT_DIR', tempfile.mkdtemp(prefix='pywikibot-'))
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def arguments(description, **options):
+    # --module compares another version, e.g. git show <commit>:pywdcollections.py > /tmp/old.py
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--module', default=os.path.join(ROOT, 'pywdcollections.py'), help='pywdcollections.py to benchmark')
+    for (name, default) in options.items():
+        parser.add_argument('--' + name, type=type(default), default=default)
+    return parser.parse_args()
+
+
+def load_module(path):
+    spec = importlib.util.spec_from_file_location('pywdcollections', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['pywdcollections'] = module
+    spec.loader.exec_module(module)
+    return module
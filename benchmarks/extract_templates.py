@@ -0,0 +1,37 @@
+# Pages per second parsed by Collection.extract_templates and by pywikibot's textlib.extract_templates_and_params,
+# on a directory of .wiki files given with --corpus, or on synthetic pages of infoboxes, links and references.
+import os
+import random
+import time
+
+from common import arguments, load_module
+
+args = arguments('extract_templates throughput', corpus='', count=300, repeat=3)
+PYWDC = load_module(args.module)
+from pywikibot import textlib
+
+
+def corpus():
+    if args.corpus:
+        for name in sorted(os.listdir(args.corpus)):
+            if name.endswith('.wiki'):
+                with open(os.path.join(args.corpus, name), encoding='utf-8') as f:
+                    yield f.read()
+        return
+    random.seed(1)
+    words = ['lorem', 'ipsum', '[[Paris]]', '[[Musée du Louvre|Louvre]]', '{{lang|en|museum}}', "''dolor''", '<!-- note -->', '[[Fichier:Louvre.jpg|thumb|Le Louvre]]']
+    for n in range(args.count):
+        infobox = '{{Infobox Musée\n| nom = Musée %s\n| image = Musée %s.jpg\n| pays = {{France}}\n| commune = [[Ville %s]]\n| latitude = 48.86\n| longitude = 2.33\n| site web = {{URL|https://example.org/%s}}\n}}' % (n, n, n, n)
+        paragraphs = [' '.join(random.choice(words) for i in range(40)) + '<ref>{{Lien web|url=https://example.org/%s|titre=Source %s|date=2020}}</ref>' % (p, p) for p in range(10)]
+        yield '\n\n'.join([infobox] + paragraphs + ['{{Portail|musées|France}}', '[[Catégorie:Musée]]'])
+
+
+pages = list(corpus())
+size = sum(len(page) for page in pages) / len(pages) / 1000
+for (label, extract) in (('extract_templates', lambda text: PYWDC.Collection.extract_templates(text, 'Musée')), ('pywikibot', lambda text: textlib.extract_templates_and_params(text, True, True))):
+    start = time.perf_counter()
+    for i in range(args.repeat):
+        for page in pages:
+            extract(page)
+    duration = time.perf_counter() - start
+    print('%s: %.0f pages/s (%s pages of %.1f kB on average)' % (label, len(pages) * args.repeat / duration, len(pages), size))
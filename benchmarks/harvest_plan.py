@@ -0,0 +1,101 @@
+# Page loop of the harvest (matching the searched templates and converting their values) over saved wikitext,
+# the templates being extracted beforehand. Give a directory of .wiki files with --corpus, or synthetic infobox pages are used.
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+from common import arguments, load_module
+
+args = arguments('HarvestPlan page loop', corpus='', count=2000, repeat=20)
+(module, args.corpus) = (os.path.abspath(args.module), args.corpus and os.path.abspath(args.corpus))
+os.chdir(tempfile.mkdtemp(prefix='bench-')) # pywikibot writes its files in the current directory
+PYWDC = load_module(module)
+from pywikibot import textlib
+
+TEMPLATES = {'enwiki': {'Commonscat': 373, 'Infobox cemetery': {'image': 18, 'location': 131, 'coordinates': 625, 'lat': '625a', 'long': '625b'}}}
+PROPERTIES = [18, 131, 373, 625]
+
+
+def corpus():
+    if args.corpus:
+        for name in sorted(os.listdir(args.corpus)):
+            if name.endswith('.wiki'):
+                with open(os.path.join(args.corpus, name), encoding='utf-8') as f:
+                    yield (name[:-5], f.read())
+        return
+    for n in range(args.count):
+        body = ' '.join('Lorem [[Ipsum %s]] {{cite web|url=http://example.org/%s|title=T}}' % (i, i) for i in range(40))
+        yield ('Cemetery %s' % (n,), '{{Infobox cemetery|name=C%s|image=Foo %s.jpg|location=[[Town %s]]|coordinates=48°51′N 2°21′E|established=1850}}\n%s\n{{Commonscat|Cemetery %s}}' % (n, n, n, body, n))
+
+
+class TemplatePage:
+    # What templatesWithParams returns as template names.
+    def __init__(self, name):
+        self.name = name
+
+    def title(self, with_ns = True):
+        return self.name
+
+
+class Page:
+    site = None
+
+    def __init__(self, title):
+        self.name = title
+
+    def title(self, with_ns = True):
+        return self.name
+
+
+class Cursor:
+    def execute(self, *args):
+        pass
+
+
+def collection():
+    c = object.__new__(PYWDC.Collection)
+    c.templates = TEMPLATES
+    c.properties = PROPERTIES
+    c.template_aliases = {'enwiki': {}}
+    c.harvest_plans = {}
+    c.debug = False
+    c.saved = []
+    c.save_harvested_value = lambda prop, value, wikidata_id, site_id: c.saved.append((prop, value))
+    c.find_items_in_value = lambda site, value, constraints, one: 'Q1'
+    c.db = type('DB', (), {'cur': Cursor()})()
+    return c
+
+
+def templates_with_params(text):
+    # Versions before extract_templates get the templates of pywikibot, as page.templatesWithParams() returns them.
+    result = []
+    for (name, params) in textlib.extract_templates_and_params(text, True, True):
+        result.append((TemplatePage(name), [value if key.isdigit() else '%s=%s' % (key, value) for (key, value) in params.items()]))
+    return result
+
+
+pages = list(corpus())
+c = collection()
+if hasattr(PYWDC.Collection, 'parse_page'):
+    prepared = [(title, PYWDC.Collection.extract_templates(text, title)) for (title, text) in pages]
+    plan = c.harvest_plan('enwiki')
+
+    def loop():
+        for (title, templates) in prepared:
+            c.save_parsed_page(PYWDC.Collection.parse_page(plan, None, title, 1, 'enwiki', templates), title, 'enwiki', 1)
+else:
+    prepared = [(Page(title), templates_with_params(text)) for (title, text) in pages]
+    props = c.list_props_for_site_id('enwiki')
+
+    def loop():
+        for (page, templates) in prepared:
+            c.harvest_templates_for_page(page, 'enwiki', 1, [None] * len(props), props, templates)
+
+start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    for i in range(args.repeat):
+        loop()
+duration = time.perf_counter() - start
+print('%s pages x %s in %.2f s: %.0f pages/s, %s values' % (len(pages), args.repeat, duration, len(pages) * args.repeat / duration, len(c.saved)))
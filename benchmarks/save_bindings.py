@@ -0,0 +1,58 @@
+# Rows per second written by Collection.save_bindings for synthetic SPARQL bindings, into an on-disk DB.
+import os
+import random
+import tempfile
+import time
+
+from common import arguments, load_module
+
+args = arguments(__doc__ or 'save_bindings throughput', count=1000000, batch_size=1000)
+PYWDC = load_module(args.module)
+directory = tempfile.mkdtemp(prefix='bench-')
+os.chdir(directory)
+
+
+class Museums(PYWDC.Collection):
+    def __init__(self, pywb):
+        self.db = PYWDC.Database(os.path.join(directory, 'museums.db'))
+        self.name = 'museums'
+        self.main_type = 33506
+        self.properties = [17, 131, 625]
+        self.languages = ['fr']
+        self.templates = {}
+        self.batch_size = args.batch_size
+        self.commit_frequency = 10000
+        super().__init__(pywb)
+
+
+def bindings(count):
+    # About 3 bindings per item, as OPTIONAL properties with several values produce.
+    random.seed(1)
+    for i in range(count):
+        wikidata_id = i // 3 + 1
+        yield {
+            'museums': 'http://www.wikidata.org/entity/Q%s' % (wikidata_id,),
+            'P17': 'http://www.wikidata.org/entity/Q%s' % (random.choice([142, 183, 38, 29]),),
+            'P131': 'http://www.wikidata.org/entity/Q%s' % (random.randint(1, 100000),),
+            'P625': 'Point(%.5f %.5f)' % (random.uniform(-5, 9), random.uniform(41, 51)),
+            'label_fr': 'Musée %s' % (wikidata_id,),
+            'description_fr': 'musée',
+            'link_fr': 'https://fr.wikipedia.org/wiki/Mus%%C3%%A9e_%s' % (wikidata_id,),
+            'commonslink': 'Category:Museum %s' % (wikidata_id,),
+            'modified': '2026-01-01T00:00:00Z',
+        }
+
+
+def raw(bindings):
+    # Versions before compact bindings read SPARQL JSON values.
+    for binding in bindings:
+        yield {key: {'value': value} for (key, value) in binding.items()}
+
+
+collection = Museums(None)
+generated = bindings(args.count) if hasattr(PYWDC.Collection, 'compact') else raw(bindings(args.count))
+start = time.perf_counter()
+collection.save_bindings(generated, args.count)
+collection.db.con.commit()
+duration = time.perf_counter() - start
+print('%s bindings in %.1f s: %.0f rows/s' % (args.count, duration, args.count / duration))
@@ -0,0 +1,99 @@
+# Untyped and typed collection tables for the same synthetic items: size, save_bindings, migration and two report queries.
+import contextlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from common import arguments, load_module
+
+args = arguments('typed columns', count=100000, repeat=20)
+PYWDC = load_module(args.module)
+if not hasattr(PYWDC.Collection, 'migrate_typed_columns'):
+    sys.exit('This version has no typed columns.')
+directory = tempfile.mkdtemp(prefix='bench-')
+os.chdir(directory)
+
+
+class PYWB:
+    def backoff(self, attempt, retry_after = 0):
+        return 0
+
+
+def collection(name, typed):
+    class Museums(PYWDC.Collection):
+        def __init__(self, pywb):
+            self.db = PYWDC.Database(os.path.join(directory, name))
+            self.name = 'museums'
+            self.main_type = 33506
+            self.properties = [17, 131, 571, 625, 2971]
+            self.languages = ['fr']
+            self.templates = {}
+            self.typed_columns = typed
+            self.commit_frequency = 10000
+            super().__init__(pywb)
+
+    return Museums(PYWB())
+
+
+def bindings(count):
+    random.seed(1)
+    for wikidata_id in range(1, count + 1):
+        yield {
+            'museums': 'http://www.wikidata.org/entity/Q%s' % (wikidata_id,),
+            'P17': 'http://www.wikidata.org/entity/Q%s' % (random.choice([142, 183, 38, 29]),),
+            'P131': 'http://www.wikidata.org/entity/Q%s' % (random.randint(1, 5000),),
+            'P571': '%s-01-01T00:00:00Z' % (random.randint(1500, 2020),),
+            'P625': 'Point(%.5f %.5f)' % (random.uniform(-5, 9), random.uniform(41, 51)),
+            'P2971': '%s' % (random.randint(1, 100000),),
+            'modified': '2026-01-01T00:00:00Z',
+        }
+
+
+def save(name, typed):
+    c = collection(name, typed)
+    start = time.perf_counter()
+    c.save_bindings(bindings(args.count), args.count)
+    c.db.con.commit()
+    duration = time.perf_counter() - start
+    c.db.cur.execute('VACUUM')
+    return (c, duration)
+
+
+def timed(c, query):
+    start = time.perf_counter()
+    for i in range(args.repeat):
+        c.db.cur.execute(query)
+        c.db.cur.fetchall()
+    return (time.perf_counter() - start) / args.repeat * 1000
+
+
+with contextlib.redirect_stdout(io.StringIO()):
+    (untyped, untyped_save) = save('untyped.db', False)
+    (typed, typed_save) = save('typed.db', True)
+    untyped.db.close()
+    shutil.copy(os.path.join(directory, 'untyped.db'), os.path.join(directory, 'migrated.db'))
+    start = time.perf_counter()
+    migrated = collection('migrated.db', True)
+    migration = time.perf_counter() - start
+    untyped = collection('untyped.db', False)
+columns = 'wikidata_id, P17, P131, P571, P625, P625_longitude, P2971'
+typed.db.cur.execute('SELECT %s FROM museums ORDER BY wikidata_id' % (columns,))
+expected = typed.db.cur.fetchall()
+migrated.db.cur.execute('SELECT %s FROM museums ORDER BY wikidata_id' % (columns,))
+differences = sum(1 for (a, b) in zip(expected, migrated.db.cur.fetchall()) if a != b)
+
+print('%s items' % (args.count,))
+print('size: %.1f MB untyped, %.1f MB typed' % (os.path.getsize(os.path.join(directory, 'untyped.db')) / 1024 ** 2, os.path.getsize(os.path.join(directory, 'typed.db')) / 1024 ** 2))
+print('save_bindings: %.1f s untyped, %.1f s typed' % (untyped_save, typed_save))
+print('migration of the untyped DB: %.1f s, %s differences from a typed fetch' % (migration, differences))
+print('P17 filter + GROUP BY P131: %.1f ms untyped, %.1f ms typed' % (
+    timed(untyped, 'SELECT P131, COUNT(*) FROM museums WHERE P17 = "Q142" GROUP BY P131'),
+    timed(typed, 'SELECT P131, COUNT(*) FROM museums WHERE P17 = 142 GROUP BY P131')))
+print('latitude range: %.1f ms untyped, %.1f ms typed' % (
+    timed(untyped, 'SELECT COUNT(*) FROM museums WHERE CAST(substr(P625, 1, instr(P625, "|") - 1) AS REAL) BETWEEN 45 AND 46'),
+    timed(typed, 'SELECT COUNT(*) FROM museums WHERE P625 BETWEEN 45 AND 46')))
+shutil.rmtree(directory)
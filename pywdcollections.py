@@ -1,38 +1,79 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import itertools
 import json
 import os
 import re
+import socket
+import sys
 import pywikibot
 import sqlite3
 import time
 import threading
+import datetime
 import hashlib
+import gzip
+import lzma
+import mmap
+import pickle
+import queue
 import urllib.parse
+import zlib
 import http.client as http
+import concurrent.futures
 
-from codecs import open
+from collections import OrderedDict
+from codecs import open, getincrementaldecoder
 from SPARQLWrapper import SPARQLWrapper, JSON, SPARQLExceptions
 
 class Collection:
+    link_regex = re.compile(r'\[\[(.*?)\]\]', re.DOTALL)
+    template_token_regex = re.compile(r'\{\{\{|\}\}\}|\{\{|\}\}|\[\[|\]\]|\||=')
+    disabled_parts_regex = re.compile(r'<!--.*?(?:-->|$)|<(nowiki|pre|includeonly|syntaxhighlight|source)(?:\s[^>]*)?>.*?</\1>', re.DOTALL | re.IGNORECASE)
+    pagename_regex = re.compile(r'\{\{\s*PAGENAME\s*\}\}')
+    invalid_name_regex = re.compile(r'[{}\[\]<>\n]') # in the name of a template or a link, besides nested templates
+    nested_template_regex = re.compile(r'\{\{\{?[^{}]*\}?\}\}')
+    plan_index_regex = re.compile(r'USING (?:COVERING )?INDEX (\S+)')
+    plan_subquery_regex = re.compile(r'^SCAN \(subquery-\d+\)') # rows already selected by a subquery
+    # errors worth another attempt, also when they interrupt a response being read (HTTPError is handled before URLError)
+    cache_errors = (EOFError, FileNotFoundError) # incomplete entry, or evicted before it was read
+    retryable_errors = (json.decoder.JSONDecodeError, SPARQLExceptions.EndPointInternalError, http.IncompleteRead, http.RemoteDisconnected, ConnectionResetError, socket.timeout, urllib.error.URLError)
+
     def __init__(self, pywb):
         print('Checking configuration...', end=' ')
         self.pywb = pywb
         self.commit_frequency = self.commit_frequency if hasattr(self, 'commit_frequency') else 50 # write to the DB every 50 operations
         self.harvest_frequency = self.harvest_frequency if hasattr(self, 'harvest_frequency') else 30 # harvest a Wikipedia page every 30 days
         self.update_frequency = self.update_frequency if hasattr(self, 'update_frequency') else 3 # update Wikidata items every 3 days
-        self.chunk_size = self.chunk_size if hasattr(self, 'chunk_size') else 50 # parallelize http calls by groups of 50
+        self.chunk_size = self.chunk_size if hasattr(self, 'chunk_size') else 50 # at most 50 parallel API requests when fetching pages
         # FIXME optional_articles False means there MUST be an article in EACH language, that's wrong, we should require AT LEAST one article among all the languages
         self.optional_articles = self.optional_articles if hasattr(self, 'optional_articles') else False # by default, harvest only items with Wikipedia articles
         self.skip_if_recent = self.skip_if_recent if hasattr(self, 'skip_if_recent') else True # don't query Wikidata again if there is a recent cache file
+        self.cache = self.cache if hasattr(self, 'cache') else Cache('cache') # compressed SPARQL results
+        self.streaming = self.streaming if hasattr(self, 'streaming') else False # parse SPARQL results while downloading them instead of loading them at once
+        self.batch_size = self.batch_size if hasattr(self, 'batch_size') else 1000 # number of SPARQL results written to the DB at once
+        self.shards = self.shards if hasattr(self, 'shards') else None # split fetch into slices: 'subclasses' of main_type, 'digits' (last digit of the QID) or a list of country IDs
+        self.workers = self.workers if hasattr(self, 'workers') else 4 # number of slices downloaded at once
+        self.retries = self.retries if hasattr(self, 'retries') else 5 # number of attempts for each SPARQL query or slice
+        self.delta = self.delta if hasattr(self, 'delta') else False # only fetch items modified since the previous fetch
+        self.removal_frequency = self.removal_frequency if hasattr(self, 'removal_frequency') else 30 # in delta mode, look for removed items every 30 days
+        self.high_water_mark = None # most recent modification date seen in SPARQL results
+        self.template_aliases = {} # per site: lowercase template name or redirect -> searched template
+        self.harvest_plans = {} # per site: searched templates compiled by HarvestPlan
         self.debug = self.debug if hasattr(self, 'debug') else False # show SPARQL & SQL queries
         self.country = self.country if hasattr(self, 'country') else None
         self.excluded_types = self.excluded_types if hasattr(self, 'excluded_types') else [] # remove items if their P31 (nature) is in this list
         self.save_texts = False # save labels and descriptions in the local database
-        self.limit = 500 # limit number of harvested pages, for memory reasons
-        self.sleep = 70 # rate-limiting
+        self.limit = 500 # number of pages listed by each harvest query, the next window starts after the last item
+        self.preload_window = self.preload_window if hasattr(self, 'preload_window') else 500 # number of items loaded ahead, 50 per request, when writing or updating them
+        self.bulk_refresh = self.bulk_refresh if hasattr(self, 'bulk_refresh') else False # refresh outdated items with SPARQL queries instead of loading them one by one
+        self.refresh_size = self.refresh_size if hasattr(self, 'refresh_size') else 500 # number of outdated items per SPARQL query in bulk refresh
+        self.harvest_all = self.harvest_all if hasattr(self, 'harvest_all') else False # harvest the whole backlog, by windows of self.limit pages
+        self.processes = self.processes if hasattr(self, 'processes') else 0 # parse harvested pages in that many processes, 0 to parse them in the main one
+        self.offline = self.offline if hasattr(self, 'offline') else False # harvest the texts kept in pywb.snapshots again, whatever their harvest date, without fetching pages or resolving new links; items missing from constraints.db are still loaded to check constraints
         self.mandatory_properties = self.mandatory_properties if hasattr(self, 'mandatory_properties') else []
+        self.typed_columns = self.typed_columns if hasattr(self, 'typed_columns') else False # store entities as INTEGER, coordinates as REAL latitude and longitude columns, dates as YYYY-MM-DD
         if not (self.db and self.name and self.properties):
             print("Please define your collection's DB, name, main_type, languages and properties first.")
             return
@@ -43,39 +84,192 @@ class Collection:
             if wiki not in PYWB.sources:
                 print('Wikipedia instance "%s" cannot be used yet. Add its Wikidata ID to class PYWB to use it as a source.' % (wiki,))
                 return
-        # FIXME adapt column type to property type + store descriptions
+        # FIXME store descriptions
         self.db.cur.execute('CREATE TABLE IF NOT EXISTS `%s` (wikidata_id INT, last_modified, CONSTRAINT `unique_item` UNIQUE(wikidata_id) ON CONFLICT REPLACE)' % self.name)
         self.db.cur.execute('CREATE TABLE IF NOT EXISTS interwiki (wikidata_id INT, lang, title, last_harvested, errors, CONSTRAINT `unique_link` UNIQUE(wikidata_id, lang) ON CONFLICT REPLACE)')
         self.db.cur.execute('CREATE TABLE IF NOT EXISTS harvested (wikidata_id INT, source, date_time, CONSTRAINT `unique_item` UNIQUE(wikidata_id, source) ON CONFLICT REPLACE)')
         self.db.cur.execute('CREATE TABLE IF NOT EXISTS texts (wikidata_id INT, lang, label, description, CONSTRAINT `unique_language` UNIQUE(wikidata_id, lang) ON CONFLICT REPLACE)')
-        for prop in self.properties + self.mandatory_properties: # add columns for each property, if they already exist, it does nothing
+        self.db.cur.execute('CREATE TABLE IF NOT EXISTS metadata (key, value, CONSTRAINT `unique_key` UNIQUE(key) ON CONFLICT REPLACE)')
+        self.db.cur.execute('CREATE TABLE IF NOT EXISTS links (lang, title, wikidata_id, checked, CONSTRAINT `unique_title` UNIQUE(lang, title) ON CONFLICT REPLACE)')
+        self.db.cur.execute('CREATE TABLE IF NOT EXISTS template_aliases (lang, alias, template, checked, CONSTRAINT `unique_alias` UNIQUE(lang, alias) ON CONFLICT REPLACE)')
+        for (prop, kind, names) in self.property_columns(): # add columns for each property, if they already exist, it does nothing
             try:
-                self.db.cur.execute('ALTER TABLE `%s` ADD COLUMN `P%s`' % (self.name, prop))
+                for name in names:
+                    self.db.cur.execute('ALTER TABLE `%s` ADD COLUMN `%s` %s' % (self.name, name, self.column_type(kind)))
                 self.db.cur.execute('ALTER TABLE `harvested` ADD COLUMN `P%s`' % prop)
             except sqlite3.OperationalError:
                 pass
+        if self.typed_columns:
+            self.migrate_typed_columns()
+        elif self.get_metadata('typed_columns'):
+            print('WARNING: this database has typed columns, set typed_columns = True.')
+        self.migrate()
+        self.create_property_indexes()
         self.db.con.commit()
+        if self.debug:
+            self.check_query_plans()
         for nature in self.excluded_types:
             if 31 in self.properties:
-                self.db.cur.execute('DELETE FROM `%s` WHERE P31 = ?' % self.name, ('Q%s' % nature,))
+                self.db.cur.execute('DELETE FROM `%s` WHERE P31 = ?' % self.name, self.column_values('entity', 'Q%s' % nature))
         print('done!')
 
+    def migrations(self):
+        # Only append new steps: the number of steps already applied is stored in the metadata table.
+        return [
+            [
+                'CREATE INDEX IF NOT EXISTS `interwiki_lang` ON interwiki (lang, last_harvested)',
+                'CREATE INDEX IF NOT EXISTS `%s_outdated` ON `%s` (wikidata_id) WHERE last_modified IS NULL' % (self.name, self.name),
+            ],
+            # partial indexes on missing values: no plan used them, every write maintained them
+            ['DROP INDEX IF EXISTS `%s`' % (name,) for name in self.index_names(self.name) if name.startswith('%s_P' % (self.name,)) and name.endswith('_missing')],
+        ]
+
+    def index_names(self, table):
+        self.db.cur.execute('SELECT name FROM sqlite_master WHERE type = "index" AND tbl_name = ?', (table,))
+        return [row[0] for row in self.db.cur.fetchall()]
+
+    def migrate(self):
+        version = int(self.get_metadata('schema_version') or 0)
+        migrations = self.migrations()
+        for (index, statements) in enumerate(migrations[version:]):
+            if self.debug:
+                print('Migrating database to version', version + index + 1)
+            for statement in statements:
+                self.db.cur.execute(statement)
+            self.set_metadata('schema_version', version + index + 1)
+
+    def property_columns(self):
+        # (property, type, columns) of the collection table, in typed mode coordinates take two columns: latitude in Pxxx, longitude in Pxxx_longitude.
+        columns = []
+        for prop in self.properties + self.mandatory_properties:
+            kind = PYWB.managed_properties[prop]['type'] if prop in PYWB.managed_properties else None
+            names = ['P%s' % (prop,), 'P%s_longitude' % (prop,)] if self.typed_columns and kind == 'coordinates' else ['P%s' % (prop,)]
+            columns.append((prop, kind, names))
+        return columns
+
+    def column_type(self, kind):
+        if not self.typed_columns:
+            return ''
+        return {'entity': 'INTEGER', 'coordinates': 'REAL', 'integer': 'INTEGER'}.get(kind, 'TEXT')
+
+    def column_values(self, kind, value):
+        # Value as read from SPARQL or from an item ("Q42", "lat|lon|alt", "1850-01-01T00:00:00Z"...) -> values of its columns.
+        if not self.typed_columns:
+            return [value]
+        if kind == 'coordinates':
+            parts = value.split('|') if value else []
+            try:
+                return [float(parts[0]), float(parts[1])]
+            except (IndexError, ValueError):
+                return [None, None]
+        if value is None or value == '':
+            return [None]
+        if kind == 'entity':
+            value = format(value)
+            return [int(value[1:]) if value[:1] == 'Q' and value[1:].isdigit() else int(value) if value.isdigit() else None] # blank nodes of unknown values are dropped
+        if kind == 'date':
+            sign = '-' if value.startswith('-') else ''
+            date = value.lstrip('+-').partition('T')[0]
+            parts = date.split('-')
+            return ['%s%04d-%s' % (sign, int(parts[0]), '-'.join(parts[1:])) if len(parts) == 3 and parts[0].isdigit() else value]
+        if kind == 'integer':
+            try:
+                return [int(value)]
+            except ValueError:
+                return [value]
+        return [value]
+
+    def migrate_typed_columns(self):
+        # Rebuild the collection table once with typed columns, its indexes and the columns of other properties are kept.
+        if self.get_metadata('typed_columns'):
+            return
+        self.db.cur.execute('PRAGMA table_info(`%s`)' % (self.name,))
+        existing = [row[1] for row in self.db.cur.fetchall()]
+        property_columns = self.property_columns()
+        names = [name for (prop, kind, column_names) in property_columns for name in column_names]
+        others = [name for name in existing if name not in ['wikidata_id', 'last_modified'] + names]
+        definitions = ['`%s` %s' % (name, self.column_type(kind)) for (prop, kind, column_names) in property_columns for name in column_names]
+        definitions.extend(['`%s`' % (name,) for name in others])
+        self.db.cur.execute('SELECT sql FROM sqlite_master WHERE type = "index" AND tbl_name = ? AND sql IS NOT NULL', (self.name,))
+        indexes = [row[0] for row in self.db.cur.fetchall()]
+        print('Converting the columns of "%s" to typed columns, please wait...' % (self.name,))
+        self.db.cur.execute('DROP TABLE IF EXISTS `%s_typed`' % (self.name,))
+        self.db.cur.execute('CREATE TABLE `%s_typed` (wikidata_id INT, last_modified, %s, CONSTRAINT `unique_item` UNIQUE(wikidata_id) ON CONFLICT REPLACE)' % (self.name, ', '.join(definitions)))
+        selected = ['`P%s`' % (prop,) if 'P%s' % (prop,) in existing else 'NULL' for (prop, kind, column_names) in property_columns]
+        insert = 'INSERT INTO `%s_typed` (wikidata_id, last_modified, %s) VALUES (?, ?%s)' % (self.name, ', '.join(['`%s`' % (name,) for name in names + others]), ', ?' * len(names + others))
+        reader = self.db.con.cursor()
+        reader.execute('SELECT wikidata_id, last_modified, %s FROM `%s`' % (', '.join(selected + ['`%s`' % (name,) for name in others]), self.name))
+        count = 0
+        while True:
+            rows = reader.fetchmany(self.batch_size)
+            if not rows:
+                break
+            converted = []
+            for row in rows:
+                values = list(row[:2])
+                for ((prop, kind, column_names), value) in zip(property_columns, row[2:]):
+                    values.extend(self.column_values(kind, value))
+                converted.append(values + list(row[2 + len(property_columns):]))
+            self.db.cur.executemany(insert, converted)
+            count += len(rows)
+        reader.close()
+        self.db.cur.execute('DROP TABLE `%s`' % (self.name,))
+        self.db.cur.execute('ALTER TABLE `%s_typed` RENAME TO `%s`' % (self.name, self.name))
+        for index in indexes:
+            self.db.cur.execute(index)
+        self.set_metadata('typed_columns', 1)
+        print(count, 'items converted.')
+
+    def create_property_indexes(self):
+        # Partial indexes on harvested values, read by the copy queries; they follow the list of properties so they are not versioned.
+        for prop in self.properties + self.mandatory_properties:
+            self.db.cur.execute('CREATE INDEX IF NOT EXISTS `harvested_P%s` ON harvested (wikidata_id) WHERE P%s IS NOT NULL' % (prop, prop))
+
+    def hot_queries(self):
+        queries = []
+        for site_id in self.templates.keys():
+            props = HarvestPlan(self.templates[site_id], self.properties).props # same properties as harvest_plan, without listing the redirects
+            if props:
+                queries.append((self.harvest_query(props, True), (site_id, self.harvest_frequency)))
+                queries.append((self.harvest_query(props), (site_id, self.harvest_frequency, 0)))
+        for prop in self.properties:
+            queries.append((self.copy_harvested_query(prop), ()))
+        queries.append((self.copy_harvested_properties_query(self.properties), ()))
+        if 373 in self.properties + self.mandatory_properties:
+            queries.append((self.copy_ciwiki_query(), ()))
+        queries.append((self.outdated_query(), ()))
+        return queries
+
+    def check_query_plans(self):
+        # Return the frequent queries which would read a whole table, and why.
+        # A scan is only accepted through a partial index, which holds just the rows to process; a scan through any other index reads the whole table.
+        partial_indexes = set([row[0] for row in self.db.read('SELECT name FROM sqlite_master WHERE type = "index" AND sql LIKE "% WHERE %"')])
+        full_scans = []
+        for (query, params) in self.hot_queries():
+            for row in self.db.read('EXPLAIN QUERY PLAN ' + query, params):
+                detail = row[-1]
+                index = self.plan_index_regex.search(detail)
+                if detail.startswith('SCAN') and 'CONSTANT ROW' not in detail and not self.plan_subquery_regex.match(detail) and not (index and index.group(1) in partial_indexes):
+                    print('WARNING: full scan (%s) in %s' % (detail, query))
+                    full_scans.append((query, detail))
+        return full_scans
+
     @staticmethod
     def chunks(l, n):
-        for i in range(0, len(l), n):
-            yield l[i:i + n]
+        iterator = iter(l)
+        chunk = list(itertools.islice(iterator, n))
+        while chunk:
+            yield chunk
+            chunk = list(itertools.islice(iterator, n))
 
     @staticmethod
     def decode(string):
         return urllib.parse.unquote(string.split('/')[-1]).replace('_', ' ')
 
-    def fetch(self):
+    def build_query(self, main_condition = None, filters = ''):
         languages = ['mul'] + sorted(self.languages) # ensure same query to allow caching
         properties = sorted(self.properties)
         mandatory_properties = sorted(self.mandatory_properties)
-        endpoint = "https://query.wikidata.org/bigdata/namespace/wdq/sparql"
-        user_agent = 'pyWdCollections (User:' + self.pywb.user +'; wikidata)'
-        sparql = SPARQLWrapper(endpoint, agent=user_agent)
         keys = [self.name, 'commonslink']
         keys.extend(['P%s' % (prop,) for prop in properties])
         keys.extend(['label_%s' % (lang,) for lang in languages])
@@ -83,8 +277,8 @@ class Collection:
         keys.extend(['link_%s' % (lang,) for lang in languages])
         keys_str = ' '.join(['?%s' % (key,) for key in keys]) + ' ?modified'
         country_filter = ('?%s wdt:P17 wd:Q%s .' % (self.name, self.country)) if self.country else ''
-        main_condition = ' (wdt:P31/wdt:P279*) wd:Q%s ' % self.main_type if self.main_type else self.main_condition
-        condition = '{ ?%s %s . } %s ?%s schema:dateModified ?modified ' % (self.name, main_condition, country_filter, self.name)
+        main_condition = main_condition or (' (wdt:P31/wdt:P279*) wd:Q%s ' % self.main_type if self.main_type else self.main_condition)
+        condition = '{ ?%s %s . } %s %s ?%s schema:dateModified ?modified ' % (self.name, main_condition, country_filter, filters, self.name)
         optional_articles = 'OPTIONAL' if self.optional_articles else ''
         contents = ' '.join(['OPTIONAL {?%s wdt:P%s ?P%s .}' % (self.name, prop, prop) for prop in properties])
         contents += ' '.join(['{?%s wdt:P%s ?P%s .}' % (self.name, prop, prop) for prop in mandatory_properties])
@@ -94,100 +288,297 @@ class Collection:
             contents += ' %s { ?link_%s schema:isPartOf [ wikibase:wikiGroup "wikipedia" ] ; schema:inLanguage "%s" ; schema:about ?%s}' % (optional_articles, lang, lang, self.name)
         contents += ' OPTIONAL { ?%s ^schema:about [ schema:isPartOf <https://commons.wikimedia.org/>; schema:name ?commonslink ] . FILTER( STRSTARTS( ?commonslink, "Category:" )) . }' % (self.name,)
         langs = ','.join(languages)
-        query = 'PREFIX schema: <http://schema.org/> SELECT DISTINCT %s WHERE { %s %s SERVICE wikibase:label { bd:serviceParam wikibase:language "%s". } }' % (keys_str, condition, contents, langs)
-        if not os.path.exists('cache'):
-            os.makedirs('cache')
-        cache_file = 'cache/' + self.name + '_' + '-'.join(languages) + '_' + hashlib.md5(query.encode('utf-8')).hexdigest()
-        if os.path.isfile(cache_file) and os.path.getmtime(cache_file) > time.time() - self.update_frequency * 24 * 3600 and os.path.getsize(cache_file) > 0:
+        return 'PREFIX schema: <http://schema.org/> SELECT DISTINCT %s WHERE { %s %s SERVICE wikibase:label { bd:serviceParam wikibase:language "%s". } }' % (keys_str, condition, contents, langs)
+
+    def sparql(self, query):
+        endpoint = "https://query.wikidata.org/bigdata/namespace/wdq/sparql"
+        user_agent = 'pyWdCollections (User:' + self.pywb.user +'; wikidata)'
+        sparql = SPARQLWrapper(endpoint, agent=user_agent)
+        sparql.setQuery(query)
+        sparql.setReturnFormat(JSON)
+        return sparql
+
+    def cache_key(self, query):
+        languages = ['mul'] + sorted(self.languages)
+        return self.name + '_' + '-'.join(languages) + '_' + hashlib.md5(query.encode('utf-8')).hexdigest()
+
+    def get_metadata(self, key):
+        self.db.cur.execute('SELECT value FROM metadata WHERE key = ?', ('%s_%s' % (self.name, key),))
+        result = self.db.cur.fetchone()
+        return result[0] if result else None
+
+    def set_metadata(self, key, value):
+        self.db.cur.execute('INSERT INTO metadata (key, value) VALUES (?, ?)', ('%s_%s' % (self.name, key), value))
+        self.db.con.commit()
+
+    def fetch(self):
+        filters = ''
+        self.high_water_mark = self.get_metadata('high_water_mark')
+        if self.delta and self.high_water_mark:
+            # overlap one day, the query service may receive some edits late
+            since = datetime.datetime.strptime(self.high_water_mark, '%Y-%m-%dT%H:%M:%SZ') - datetime.timedelta(days=1)
+            print('Fetching items modified since %s' % (since,))
+            filters = 'FILTER(?modified > "%s"^^xsd:dateTime) .' % (since.strftime('%Y-%m-%dT%H:%M:%SZ'),)
+        if not (self.fetch_shards(filters) if self.shards else self.fetch_query(filters)):
+            return
+        if self.high_water_mark:
+            self.set_metadata('high_water_mark', self.high_water_mark)
+        if self.delta:
+            self.remove_deleted_items()
+
+    def fetch_query(self, filters = ''):
+        query = self.build_query(None, filters)
+        key = self.cache_key(query)
+        if self.cache.is_recent(key, self.update_frequency):
             if self.skip_if_recent:
-                print('Found recent cache "%s", skipping...' % (cache_file,))
-                return
-            print('Loading from "%s", please wait...' % (cache_file,))
-            with open(cache_file, 'r', encoding='utf-8') as content_file:
-                data = json.load(content_file)
-        else:
-            print('Query running, please wait...')
+                print('Found recent cache "%s", skipping...' % (key,))
+                return True
+            print('Loading from cache "%s", please wait...' % (key,))
+            try:
+                self.save_bindings(self.cache.read(key))
+                return True
+            except Collection.cache_errors as e:
+                print('ERROR... (%s) running the query again.' % (e,))
+        print('Query running, please wait...')
+        if not self.download(query, key, self.streaming):
+            return False
+        if not self.streaming:
+            self.save_bindings(self.cache.read(key))
+        return True
+
+    def list_shards(self):
+        if self.shards == 'subclasses':
+            if not self.main_type:
+                print('Sharding by subclasses requires main_type.')
+                return []
+            bindings = self.download_bindings('SELECT ?subclass WHERE { ?subclass wdt:P279 wd:Q%s . }' % (self.main_type,))
+            if bindings is None:
+                print('ERROR: cannot list the subclasses of Q%s, run fetch again to retry.' % (self.main_type,))
+                return []
+            subclasses = sorted(set([int(self.decode(binding['subclass']).replace('Q', '')) for binding in bindings]))
+            shards = [(' wdt:P31 wd:Q%s ' % (self.main_type,), '')]
+            shards.extend([(' (wdt:P31/wdt:P279*) wd:Q%s ' % (subclass,), '') for subclass in subclasses])
+            return shards
+        if self.shards == 'digits':
+            return [(None, 'FILTER(STRENDS(STR(?%s), "%s")) .' % (self.name, digit)) for digit in range(10)]
+        if isinstance(self.shards, list):
+            return [(None, '?%s wdt:P17 wd:Q%s .' % (self.name, country)) for country in self.shards]
+        print('Unknown sharding "%s".' % (self.shards,))
+        return []
+
+    def fetch_shards(self, filters = ''):
+        # Download slices of the collection in parallel, each one with its own cache entry, and write them to the DB as they arrive.
+        shards = self.list_shards()
+        queries = [self.build_query(main_condition, shard_filters + ' ' + filters) for (main_condition, shard_filters) in shards]
+        pending = []
+        for query in queries:
+            key = self.cache_key(query)
+            if self.cache.is_recent(key, self.update_frequency):
+                if self.skip_if_recent:
+                    if self.debug:
+                        print('Found recent cache "%s", skipping...' % (key,))
+                    continue
+                try:
+                    self.save_bindings(self.cache.read(key))
+                    continue
+                except Collection.cache_errors as e:
+                    print('ERROR... (%s) downloading the slice again.' % (e,))
+            pending.append((query, key))
+        print('%s slices to download (%s in total).' % (len(pending), len(queries)))
+        failed = 0
+        retried = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.download, query, key): (query, key) for (query, key) in pending}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    downloaded = future.result()
+                except Exception as e: # one slice must not stop the others
+                    print('ERROR... (%s)' % (e,))
+                    downloaded = False
+                if not downloaded:
+                    failed += 1
+                    continue
+                try:
+                    self.save_bindings(self.cache.read(futures[future][1])) # DB writes stay in the main thread
+                except Collection.cache_errors + Collection.retryable_errors as e:
+                    print('ERROR... (%s) downloading the slice again.' % (e,))
+                    retried.append(futures[future])
+        for (query, key) in retried:
+            try:
+                if self.download(query, key):
+                    self.save_bindings(self.cache.read(key))
+                    continue
+            except Collection.cache_errors as e:
+                print('ERROR... (%s)' % (e,))
+            failed += 1
+        if failed:
+            print('%s slices failed, run fetch again to retry them.' % (failed,))
+        return len(shards) > 0 and failed == 0
+
+    def remove_deleted_items(self):
+        # Cheap query on IDs only, to find items which were deleted or left the collection since they were fetched.
+        last_check = self.get_metadata('removal_check')
+        if last_check and float(last_check) > time.time() - self.removal_frequency * 24 * 3600:
+            return
+        country_filter = ('?%s wdt:P17 wd:Q%s .' % (self.name, self.country)) if self.country else ''
+        main_condition = ' (wdt:P31/wdt:P279*) wd:Q%s ' % self.main_type if self.main_type else self.main_condition
+        query = 'SELECT ?%s WHERE { ?%s %s . %s }' % (self.name, self.name, main_condition, country_filter)
+        key = self.cache_key(query)
+        print('Looking for removed items...')
+        if not self.download(query, key):
+            return
+        self.db.cur.execute('CREATE TEMP TABLE IF NOT EXISTS current_items (wikidata_id INTEGER PRIMARY KEY)')
+        self.db.cur.execute('DELETE FROM current_items')
+        for batch in self.chunks(self.cache.read(key), self.batch_size):
+            self.db.cur.executemany('INSERT OR IGNORE INTO current_items (wikidata_id) VALUES (?)', [(int(item[self.name].split('/')[-1].replace('Q', '')),) for item in batch])
+        self.cache.delete(key) # read once, the next check runs the query again
+        self.db.cur.execute('SELECT COUNT(*) FROM current_items')
+        if self.db.cur.fetchone()[0] > 0: # never empty the collection because of an empty answer
+            self.db.cur.execute('DELETE FROM `%s` WHERE wikidata_id NOT IN (SELECT wikidata_id FROM current_items)' % (self.name,))
+            print(self.db.cur.rowcount, 'removed items deleted.')
+        self.db.cur.execute('DROP TABLE current_items')
+        self.commit(0)
+        self.set_metadata('removal_check', time.time())
+
+    def download(self, query, key, stream = False):
+        # Retry this query only, the cache entry is kept only if the response is complete.
+        # With stream, rows reach the DB while the response is read, so it must run in the main thread; slices run in worker threads.
+        for attempt in range(1, self.retries + 1):
             if self.debug:
                 print(query)
-            sparql.setQuery(query)
-            sparql.setReturnFormat(JSON)
+            retry_after = 0
             try:
-                data = sparql.query().convert()
-            except urllib.error.HTTPError as e:
-                data = {} # avoid memory leak
-                sparql = None # avoid memory leak
-                if e.code in [429, 403, 500, 502, 503, 504]:
-                    print('ERROR... (%s) will retry in %s seconds...' % (e, self.sleep))
-                    e = None # avoid memory leak
-                    time.sleep(self.sleep)
-                    return self.fetch() # FIXME limit nb of retries or increase time between
+                response = self.sparql(query).query().response
+                bindings = map(self.compact, self.iterate_bindings(response))
+                if stream:
+                    self.save_bindings(self.cache.tee(key, bindings))
                 else:
+                    self.cache.write(key, bindings)
+                return True
+            except urllib.error.HTTPError as e:
+                if e.code not in [429, 403, 500, 502, 503, 504]:
                     print('ERROR: %s' % (e,))
-                return
-            except (json.decoder.JSONDecodeError, SPARQLExceptions.EndPointInternalError, http.IncompleteRead, http.RemoteDisconnected) as e:
-                data = {} # avoid memory leak
-                sparql = None # avoid memory leak
+                    return False
+                message = '%s' % (e,)
+                retry_after = int(e.headers.get('Retry-After', 0)) if e.headers and format(e.headers.get('Retry-After', '')).isdigit() else 0
+            except Collection.retryable_errors as e:
                 message = '%s' % (e,)
-                e = None # avoid memory leak
                 message = message[:128] + '...' if len(message) > 128 and not self.debug else message
-                print('ERROR... (%s) will retry in %s seconds...' % (message, self.sleep))
-                time.sleep(self.sleep)
-                return self.fetch() # FIXME limit nb of retries or increase time between
-            if 'results' in data.keys():
-                if self.debug:
-                    print('Saving to', cache_file)
-                with open(cache_file, 'w') as f:
-                    json.dump(data, f)
+            if attempt < self.retries:
+                delay = self.pywb.backoff(attempt - 1, retry_after)
+                print('ERROR... (%s) will retry in %s seconds...' % (message, delay))
+                time.sleep(delay)
+        print('ERROR: giving up query "%s"' % (key,))
+        return False
+
+    @staticmethod
+    def compact(binding):
+        return {key: value['value'] for (key, value) in binding.items()}
+
+    @staticmethod
+    def iterate_bindings(stream, buffer_size = 65536):
+        # Yield the bindings of a SPARQL JSON result one by one, without loading the whole document.
+        decoder = json.JSONDecoder()
+        reader = getincrementaldecoder('utf-8')()
+        buffer = ''
+        position = 0
+        eof = False
+        started = False
+        while True:
+            if not started:
+                start = buffer.find('"bindings"')
+                bracket = buffer.find('[', start) if start >= 0 else -1
+                if bracket >= 0:
+                    buffer = buffer[bracket + 1:]
+                    started = True
+                    continue
             else:
-                print('Unknown error (invalid JSON with keys "%s")' % ', '.join(data.keys()))
-        if 'results' in data.keys() and 'bindings' in data['results'].keys():
-            self.db.cur.execute('SELECT wikidata_id, last_modified FROM `%s`' % (self.name,))
-            existing_items = dict(self.db.cur.fetchall())
-            t = len(data['results']['bindings'])
-            if self.debug:
-                print(t, 'elements loaded')
-            i = 0
-            for item in data['results']['bindings']:
+                while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                    position += 1
+                if position < len(buffer):
+                    if buffer[position] == ']':
+                        return
+                    try:
+                        binding, position = decoder.raw_decode(buffer, position)
+                        yield binding
+                        continue
+                    except json.decoder.JSONDecodeError:
+                        if eof:
+                            raise
+            if eof:
+                if not started:
+                    print('Unknown error (no bindings found in SPARQL results)')
+                    return
+                raise json.decoder.JSONDecodeError('Unterminated bindings', buffer, position)
+            chunk = stream.read(buffer_size)
+            eof = not chunk
+            buffer = buffer[position:] + reader.decode(chunk, final=eof)
+            position = 0
+
+    def save_bindings(self, bindings, total = None):
+        # Rows are assembled in Python for a whole batch, then written with one upsert per item and per table.
+        t = total if total is not None else '?'
+        i = 0
+        property_columns = self.property_columns()
+        columns = [name for (prop, kind, names) in property_columns for name in names]
+        upsert_item = 'INSERT INTO `%s` (wikidata_id, last_modified%s) VALUES (?, ?%s) ON CONFLICT (wikidata_id) DO UPDATE SET last_modified = excluded.last_modified%s' % (self.name, ''.join([', %s' % (column,) for column in columns]), ', ?' * len(columns), ''.join([', %s = COALESCE(excluded.%s, %s)' % (column, column, column) for column in columns]))
+        upsert_link = 'INSERT INTO interwiki (wikidata_id, lang, title, last_harvested) VALUES (?, ?, ?, NULL) ON CONFLICT (wikidata_id, lang) DO UPDATE SET title = excluded.title'
+        upsert_text = 'INSERT INTO texts (wikidata_id, lang, label, description) VALUES (?, ?, ?, ?) ON CONFLICT (wikidata_id, lang) DO UPDATE SET label = excluded.label, description = excluded.description'
+        for batch in self.chunks(bindings, self.batch_size):
+            ids = list(set([int(item[self.name].split('/')[-1].replace('Q', '')) for item in batch]))
+            existing_items = {}
+            for chunk in self.chunks(ids, 500): # older SQLite versions allow 999 parameters
+                self.db.cur.execute('SELECT wikidata_id, last_modified FROM `%s` WHERE wikidata_id IN (%s)' % (self.name, ','.join(['?'] * len(chunk))), chunk)
+                existing_items.update(self.db.cur.fetchall())
+            deleted = set()
+            rows = {}
+            links = {}
+            texts = {}
+            for item in batch:
                 i += 1
-                wikidata_id = int(item[self.name]['value'].split('/')[-1].replace('Q', ''))
+                wikidata_id = int(item[self.name].split('/')[-1].replace('Q', ''))
+                if self.high_water_mark is None or item['modified'] > self.high_water_mark:
+                    self.high_water_mark = item['modified']
                 if 'P31' in item.keys():
-                    nature = self.decode(item['P31']['value'])
+                    nature = self.decode(item['P31'])
                     if nature and int(nature.replace('Q', '')) in self.excluded_types:
                         if self.debug:
                             print('Delete', wikidata_id, 'because type', nature, 'is excluded.')
-                        self.db.cur.execute('DELETE FROM `%s` WHERE wikidata_id = ?' % (self.name,), (wikidata_id,))
+                        deleted.add(wikidata_id)
+                        rows.pop(wikidata_id, None)
                         continue
-                modified = item['modified']['value'].replace('T', ' ').replace('Z', '')
-                if wikidata_id in existing_items and existing_items[wikidata_id] == modified:
-                    print('(%s/%s) Q%s' % (i, t, wikidata_id), '-> continue', end='     \r')
-                else:
-                    print('(%s/%s) Q%s' % (i, t, wikidata_id), end='                      \r')
-                    self.db.cur.execute('INSERT OR IGNORE INTO `%s` (wikidata_id, last_modified) VALUES (?, ?)' % (self.name,), (wikidata_id, modified))
-                    for prop in self.properties + self.mandatory_properties:
+                modified = item['modified'].replace('T', ' ').replace('Z', '')
+                if not (wikidata_id in existing_items and existing_items[wikidata_id] == modified):
+                    row = rows.setdefault(wikidata_id, [wikidata_id, modified] + [None] * len(columns))
+                    row[1] = modified
+                    position = 2
+                    for (prop, kind, names) in property_columns:
                         pprop = 'P%s' % (prop,)
-                        if pprop in item.keys():
-                            value = item[pprop]['value']
-                            if prop in PYWB.managed_properties:
-                                if PYWB.managed_properties[prop]['type'] in ['entity', 'image', 'sound']:
-                                    value = self.decode(value)
-                                elif PYWB.managed_properties[prop]['type'] == 'coordinates':
-                                    values = value.replace('Point(', '').replace(')', '').split(' ')
-                                    value = '%s|%s|0' % (values[1], values[0]) if len(values) == 2 else ''
-                            self.db.cur.execute('UPDATE `%s` SET %s = ? WHERE wikidata_id = ?' % (self.name, pprop), (value, wikidata_id))
+                        if pprop in item:
+                            value = item[pprop]
+                            if kind in ['entity', 'image', 'sound']:
+                                value = self.decode(value)
+                            elif kind == 'coordinates':
+                                values = value.replace('Point(', '').replace(')', '').split(' ')
+                                value = '%s|%s|0' % (values[1], values[0]) if len(values) == 2 else ''
+                            row[position:position + len(names)] = self.column_values(kind, value)
+                        position += len(names)
                 for lang in self.languages:
                     if 'link_' + lang in item.keys():
-                        title = self.decode(item['link_' + lang]['value'])
-                        siteid = lang + 'wiki'
-                        self.db.cur.execute('INSERT INTO interwiki (wikidata_id, lang, title, last_harvested) VALUES (?, ?, ?, NULL) ON CONFLICT (wikidata_id, lang) DO UPDATE SET title = ?', (wikidata_id, siteid, title, title))
+                        links[(wikidata_id, lang + 'wiki')] = self.decode(item['link_' + lang])
                 if 'commonslink' in item.keys():
-                    title = item['commonslink']['value']
-                    self.db.cur.execute('INSERT INTO interwiki (wikidata_id, lang, title, last_harvested) VALUES (?, "commonswiki", ?, NULL) ON CONFLICT (wikidata_id, lang) DO UPDATE SET title = ?', (wikidata_id, title, title))
+                    links[(wikidata_id, 'commonswiki')] = item['commonslink']
                 for lang in self.languages:
-                    label = item.get('label_' + lang, {}).get('value', '') or item.get('label_mul', {}).get('value', '')
-                    description = item.get('description_' + lang, {}).get('value', '') or item.get('description_mul', {}).get('value', '')
-                    self.db.cur.execute('INSERT INTO texts (wikidata_id, lang, label, description) VALUES (?, ?, ?, ?) ON CONFLICT (wikidata_id, lang) DO UPDATE SET label = ?, description = ?', (wikidata_id, lang, label, description, label, description))
-            print('')
+                    label = item.get('label_' + lang, '') or item.get('label_mul', '')
+                    description = item.get('description_' + lang, '') or item.get('description_mul', '')
+                    texts[(wikidata_id, lang)] = (label, description)
+            self.db.cur.executemany('DELETE FROM `%s` WHERE wikidata_id = ?' % (self.name,), [(wikidata_id,) for wikidata_id in deleted])
+            self.db.cur.executemany(upsert_item, rows.values())
+            self.db.cur.executemany(upsert_link, [(wikidata_id, site_id, title) for ((wikidata_id, site_id), title) in links.items()])
+            self.db.cur.executemany(upsert_text, [(wikidata_id, lang, label, description) for ((wikidata_id, lang), (label, description)) in texts.items()])
             self.commit(0)
+            print('(%s/%s) Q%s - %s updated' % (i, t, wikidata_id, len(rows)), end='                      \r')
+        print('')
 
     @staticmethod
     def find_coordinates_in_template(template):
@@ -201,94 +592,203 @@ class Collection:
         return (latitude, longitude)
 
     def find_items_in_value(self, site, val, constraints, one = False):
-        matches = re.findall('\[\[(.*?)\]\]', val, re.DOTALL)
+        titles = self.link_titles(val)
+        links = self.resolve_links(site, titles)
         result = []
-        for match in matches:
-            value = match.strip()
-            if ':' in value:
-                continue # Ignore images
-            site_id = site.lang + 'wiki'
-            page = self.pywb.Page(site_id, value)
-            if page.exists():
-                if page.isRedirectPage():
-                    page = page.getRedirectTarget()
-                if 'wikibase_item' in page.properties():
-                    wikidata_id = page.properties()['wikibase_item']
-                    if constraints and self.pywb.check_constraints(wikidata_id, constraints):
-                        if one:
-                            return wikidata_id
-                        if wikidata_id not in result:
-                            result.append(wikidata_id)
-                    else:
+        for title in titles:
+            wikidata_id = links.get(title)
+            if wikidata_id:
+                if constraints and self.pywb.check_constraints(wikidata_id, constraints):
+                    if one:
+                        return wikidata_id
+                    if wikidata_id not in result:
                         result.append(wikidata_id)
+                else:
+                    result.append(wikidata_id)
         return result[0] if len(result) == 1 and one else result if not one else None
 
+    def link_titles(self, val):
+        titles = []
+        for match in self.link_regex.findall(val):
+            title = match.split('|')[0].split('#')[0].strip()
+            if title and ':' not in title: # Ignore images
+                titles.append(title)
+        return titles
+
+    def resolve_links(self, site, titles):
+        # Wikidata IDs of the link targets, from the links table if checked recently, else from the wiki by 50 titles.
+        site_id = site.lang + 'wiki'
+        links = {}
+        titles = list(set(titles))
+        for chunk in self.chunks(titles, 500):
+            if self.offline: # whatever their age, the titles never resolved stay unresolved
+                self.db.cur.execute('SELECT title, wikidata_id FROM links WHERE lang = ? AND title IN (%s)' % ', '.join(['?'] * len(chunk)), [site_id] + chunk)
+            else:
+                self.db.cur.execute('SELECT title, wikidata_id FROM links WHERE lang = ? AND checked > datetime("NOW", ?) AND title IN (%s)' % ', '.join(['?'] * len(chunk)), [site_id, '-%s days' % self.harvest_frequency] + chunk)
+            links.update(self.db.cur.fetchall())
+        if self.offline:
+            return links
+        for chunk in self.chunks([title for title in titles if title not in links], self.pywb.preload_size):
+            found = self.pywb.get_wikibase_items(site, chunk)
+            self.db.cur.executemany('INSERT INTO links (lang, title, wikidata_id, checked) VALUES (?, ?, ?, datetime("NOW"))', [(site_id, title, found[title]) for title in chunk])
+            links.update(found)
+        return links
+
+    def prefetch_links(self, site_id, pages):
+        # Resolve at once the links found in the entity values of several parsed pages.
+        plan = self.harvest_plan(site_id)
+        titles = set()
+        for page in pages:
+            for (item_id, searched_property, value, source) in page.get('parsed', ([], [], []))[0]:
+                if searched_property in plan.entities:
+                    titles.update(self.link_titles(value))
+        if titles:
+            try:
+                self.resolve_links(pywikibot.Site(site_id.replace('wiki', '')), titles)
+            except pywikibot.exceptions.Error as e:
+                print('ERROR... (%s) links will be resolved page by page' % (e,))
+
     def list_props_for_site_id(self, site_id):
-        props = []
-        for name, params in self.templates[site_id].items():
-            if isinstance(params, dict):
-                for param in params.keys():
-                    prop = format(params[param]).replace('a', '').replace('b', '')
-                    if int(prop) in self.properties:
-                        props.append(prop)
-            elif isinstance(params, int):
-                prop = format(params)
-                if int(prop) in self.properties:
-                    props.append(prop)
-        return list(set(props)) # remove duplicates
+        return self.harvest_plan(site_id).props
 
     def debug_templates(self, site_id, title):
         props = self.list_props_for_site_id(site_id)
         print('Will harvest properties', ', '.join(props), 'from', site_id, 'on', title)
-        query = 'SELECT w.wikidata_id, i.title, %s FROM `%s` w JOIN interwiki i ON w.wikidata_id = i.wikidata_id WHERE lang = ? AND title = ?' % (','.join(['P%s' % prop for prop in props]), self.name)
+        query = 'SELECT w.wikidata_id, i.title FROM `%s` w JOIN interwiki i ON w.wikidata_id = i.wikidata_id WHERE lang = ? AND title = ?' % (self.name,)
         if self.debug:
             print(query)
         self.db.cur.execute(query, (site_id, title))
         results = self.db.cur.fetchall()
-        for (wikidata_id, title, *values) in results:
-            self.harvest_templates_for_page(self.pywb.Page(site_id, title), site_id, wikidata_id, values, props)
+        for (wikidata_id, title) in results:
+            if self.offline and self.pywb.snapshots:
+                snapshot = self.pywb.snapshots.read(site_id, title)
+                if snapshot:
+                    self.harvest_templates_for_text(snapshot[2], snapshot[0], site_id, wikidata_id)
+                else:
+                    print('No snapshot of', title)
+                continue
+            self.harvest_templates_for_page(self.pywb.Page(site_id, title), site_id, wikidata_id)
+
+    def harvest_query(self, props, count = False):
+        # Windows are read by increasing wikidata_id (keyset pagination), CROSS JOIN keeps the collection table as the outer loop
+        # so that each window reads the index from the previous position instead of sorting the whole backlog.
+        if count:
+            return 'SELECT COUNT(i.title) FROM `%s` w JOIN interwiki i ON w.wikidata_id = i.wikidata_id WHERE lang = ? AND (%s) AND ((julianday(datetime("now")) - julianday(last_harvested)) > ? OR last_harvested IS NULL)' % (self.name, ' OR '.join(['P%s IS NULL' % prop for prop in props]))
+        return 'SELECT w.wikidata_id, i.title, %s FROM `%s` w CROSS JOIN interwiki i ON w.wikidata_id = i.wikidata_id WHERE lang = ? AND (%s) AND ((julianday(datetime("now")) - julianday(last_harvested)) > ? OR last_harvested IS NULL) AND w.wikidata_id > ? ORDER BY w.wikidata_id LIMIT %s' % (','.join(['P%s' % prop for prop in props]), self.name, ' OR '.join(['P%s IS NULL' % prop for prop in props]), self.limit)
+
+    def fetch_closures(self):
+        # All the subclasses of each constraint list, so that checking an item needs only its natures.
+        for prop in self.properties + self.mandatory_properties:
+            constraints = PYWB.managed_properties.get(prop, {}).get('constraints')
+            if not constraints or self.pywb.closure_is_recent(constraints):
+                continue
+            query = 'SELECT ?class WHERE { VALUES ?root { %s } ?class wdt:P279* ?root . }' % ' '.join(['wd:Q%s' % constraint for constraint in constraints])
+            print('Fetching subclasses for the constraints of P%s...' % (prop,))
+            bindings = self.download_bindings(query)
+            if bindings is None:
+                if self.pywb.get_closure(constraints) is not None:
+                    print('ERROR: keeping the previous subclasses of the constraints of P%s.' % (prop,))
+                else:
+                    print('ERROR: constraints of P%s will only follow one level of subclasses.' % (prop,))
+                continue
+            classes = [binding['class'].replace('http://www.wikidata.org/entity/Q', '') for binding in bindings]
+            self.pywb.set_closure(constraints, [int(subclass) for subclass in classes if subclass.isdigit()])
 
     def harvest_templates(self, only_those = None):
+        if self.offline and not self.pywb.snapshots:
+            print('Please set pywb.snapshots to harvest offline.')
+            return 0
         total = 0
-        for site_id in (only_those if only_those else self.templates.keys()):
-            props = self.list_props_for_site_id(site_id)
-            print('Will harvest properties', ', '.join(props), 'from', site_id)
-            count = 'SELECT COUNT(i.title) FROM `%s` w JOIN interwiki i ON w.wikidata_id = i.wikidata_id WHERE lang = ? AND (%s) AND ((julianday(datetime("now")) - julianday(last_harvested)) > ? OR last_harvested IS NULL)' % (self.name, ' OR '.join(['P%s IS NULL' % prop for prop in props]))
-            if self.debug:
-                print(count)
-            self.db.cur.execute(count, (site_id, self.harvest_frequency))
-            t = self.db.cur.fetchone()[0]
-            print(t, 'pages to harvest.')
-            total += t
-            query = 'SELECT w.wikidata_id, i.title, %s FROM `%s` w JOIN interwiki i ON w.wikidata_id = i.wikidata_id WHERE lang = ? AND (%s) AND ((julianday(datetime("now")) - julianday(last_harvested)) > ? OR last_harvested IS NULL) LIMIT %s' % (','.join(['P%s' % prop for prop in props]), self.name, ' OR '.join(['P%s IS NULL' % prop for prop in props]), self.limit)
-            if self.debug:
-                print(query)
-            self.db.cur.execute(query, (site_id, self.harvest_frequency))
-            results = self.db.cur.fetchall()
-            t = len(results)
-            pages = {}
-            for (wikidata_id, title, *values) in results:
-                pages['Q%s' % (wikidata_id,)] = {
-                    'page': self.pywb.Page(site_id, title),
-                    'values': values,
-                }
-            nb_chunks = t // self.chunk_size + (1 if (t // self.chunk_size) * self.chunk_size < t else 0)
-            print('Fetching %s pages (%s chunk%s of %s)' % (t, nb_chunks, 's' if nb_chunks > 1 else '', self.chunk_size))
-            i = 0
-            for chunk in self.chunks(list(pages.keys()), self.chunk_size):
-                threads = []
-                for qid in chunk:
-                    thread = threading.Thread(target=PYWB.fetch_page_templates, args=(pages[qid],))
-                    thread.start()
-                    threads.append(thread)
-                for thread in threads:
-                    thread.join()
-                for qid in chunk:
-                    self.harvest_templates_for_page(pages[qid]['page'], site_id, int(qid.replace('Q', '')), pages[qid]['values'], props)
-                    i += 1
-                    print('(%s/%s)' % (i, t), end='')
-                self.commit(0)
-            print('Done!         ')
+        if not self.offline:
+            self.fetch_closures() # offline, the closures already fetched are used
+        tasks = queue.Queue()
+        fetched = queue.Queue()
+        workers = [threading.Thread(target=self.pywb.page_worker, args=(tasks, fetched), daemon=True) for i in range(self.chunk_size)]
+        for worker in workers:
+            worker.start()
+        pool = concurrent.futures.ProcessPoolExecutor(self.processes) if self.processes else None
+        try:
+            for site_id in (only_those if only_those else self.templates.keys()):
+                props = self.list_props_for_site_id(site_id)
+                print('Will harvest properties', ', '.join(props), 'from', site_id)
+                self.load_template_aliases(site_id)
+                count = self.harvest_query(props, True)
+                if self.debug:
+                    print(count)
+                frequency = -1 if self.offline else self.harvest_frequency # offline, all the pages are harvested again
+                self.db.cur.execute(count, (site_id, frequency))
+                t = self.db.cur.fetchone()[0]
+                print(t, 'pages to harvest.')
+                total += t
+                query = self.harvest_query(props)
+                if self.debug:
+                    print(query)
+                i = 0
+                last_id = 0
+                while True:
+                    start = time.time()
+                    self.db.cur.execute(query, (site_id, frequency, last_id))
+                    results = self.db.cur.fetchall()
+                    if not results:
+                        break
+                    last_id = results[-1][0]
+                    pages = [{
+                        'page': self.pywb.Page(site_id, title),
+                        'key': (site_id, title),
+                        'values': values,
+                        'wikidata_id': wikidata_id,
+                    } for (wikidata_id, title, *values) in results]
+                    if self.offline:
+                        pages = self.pywb.read_snapshots(site_id, pages)
+                        print('Reading %s pages from the snapshots (%s without snapshot)' % (len(pages), len(results) - len(pages)))
+                        for page in pages:
+                            fetched.put(page)
+                    else:
+                        print('Fetching %s pages (%s per request)' % (len(results), self.pywb.preload_size))
+                        self.pywb.lookup_pages(site_id, pages)
+                        for batch in self.chunks([page for page in pages if not page.get('fresh')], self.pywb.preload_size):
+                            tasks.put(batch)
+                        for page in pages:
+                            if page.get('fresh'):
+                                fetched.put(page) # parsed recently by a collection, no request needed
+                    j = 0
+                    parsing = [] # (group, future) parsed by the pool, saved as soon as they are done
+                    while j < len(pages) or parsing:
+                        for (group, future) in [(group, future) for (group, future) in parsing if future.done()]:
+                            parsing.remove((group, future))
+                            i = self.save_pages(site_id, group, future.result(), i, t)
+                        if j < len(pages) and len(parsing) < max(1, 2 * self.processes): # keep all the processes busy
+                            try:
+                                group = [fetched.get(timeout=0.1 if parsing else None)] # parse the pages as soon as their batch arrives
+                            except queue.Empty:
+                                continue
+                            while len(group) < self.pywb.preload_size and j + len(group) < len(pages):
+                                try:
+                                    group.append(fetched.get_nowait())
+                                except queue.Empty:
+                                    break
+                            j += len(group)
+                            parsing.append((group, self.parse_pages(site_id, group, pool)))
+                        elif parsing:
+                            concurrent.futures.wait([future for (group, future) in parsing], return_when=concurrent.futures.FIRST_COMPLETED)
+                    self.commit(0)
+                    pages = results = None # keep only the current window in memory
+                    duration = time.time() - start
+                    print('Window of %s pages harvested in %.1f seconds (%.1f pages/s)' % (j, duration, j / duration if duration else 0))
+                    if not self.harvest_all:
+                        break
+                print('Done!         ')
+            self.pywb.print_cache_stats()
+        finally:
+            try:
+                while True:
+                    tasks.get_nowait() # drop the pages left if harvesting was interrupted
+            except queue.Empty:
+                pass
+            for worker in workers:
+                tasks.put(None)
+            if pool:
+                pool.shutdown(cancel_futures=True)
         return total
 
     @staticmethod
@@ -317,92 +817,311 @@ class Collection:
                 (latitude, longitude) = Collection.find_coordinates_in_template(template) # don't break the loop! continue searching for 'Location estimated'
         return (latitude, longitude)
 
-    def get_template_name_with_redirect(self, site_id, template_page):
-        template_name = template_page.title(with_ns=False).lower()
-        if site_id in self.pywb.pages.keys() and template_name in self.pywb.pages[site_id].keys():
-            return self.pywb.pages[site_id][template_name]
-        if template_page.isRedirectPage():
-            template_page = template_page.getRedirectTarget()
-            template_name = template_page.title(with_ns=False).lower()
-        if site_id not in self.pywb.pages.keys():
-            self.pywb.pages[site_id] = {}
-        self.pywb.pages[site_id][template_name] = template_name
-        return template_name
-
-    def harvest_templates_for_page(self, page, site_id, wikidata_id, values, props):
+    def load_template_aliases(self, site_id):
+        # Redirects to the searched templates of a wiki, listed once and kept in the template_aliases table.
+        self.db.cur.execute('SELECT alias, template FROM template_aliases WHERE lang = ? AND checked > datetime("NOW", ?)', (site_id, '-%s days' % self.harvest_frequency))
+        aliases = dict(self.db.cur.fetchall())
+        if self.offline:
+            self.db.cur.execute('SELECT alias, template FROM template_aliases WHERE lang = ?', (site_id,))
+            aliases = dict(self.db.cur.fetchall()) # whatever their age, templates not listed yet are only found by their name
+        elif not aliases or set(self.copy_with_lowercase_keys(self.templates[site_id]).keys()) - set(aliases.values()):
+            print('Listing redirects to the templates of', site_id)
+            site = pywikibot.Site(site_id.replace('wiki', ''))
+            aliases = {}
+            for name in self.templates[site_id].keys():
+                template_name = name.lower()
+                aliases[template_name] = template_name
+                template_page = pywikibot.Page(site, name, ns=10)
+                for redirect in self.pywb.call(site, lambda: list(template_page.backlinks(follow_redirects=False, filter_redirects=True, namespaces=[10]))):
+                    aliases[redirect.title(with_ns=False).lower()] = template_name
+            self.db.cur.execute('DELETE FROM template_aliases WHERE lang = ?', (site_id,))
+            self.db.cur.executemany('INSERT INTO template_aliases (lang, alias, template, checked) VALUES (?, ?, ?, datetime("NOW"))', [(site_id, alias, template) for (alias, template) in aliases.items()])
+            self.db.con.commit()
+        self.template_aliases[site_id] = aliases
+        self.harvest_plans.pop(site_id, None) # compiled with the previous aliases
+
+    def harvest_plan(self, site_id):
+        if site_id not in self.harvest_plans:
+            if site_id not in self.template_aliases:
+                self.load_template_aliases(site_id)
+            self.harvest_plans[site_id] = HarvestPlan(self.templates[site_id], self.properties, self.template_aliases[site_id])
+        return self.harvest_plans[site_id]
+
+    def harvest_templates_for_page(self, page, site_id, wikidata_id):
+        self.harvest_templates_for_text(page.text, page.title(with_ns=False), site_id, wikidata_id)
+
+    def harvest_templates_for_text(self, text, title, site_id, wikidata_id):
+        parsed = Collection.parse_page(self.harvest_plan(site_id), text, title, wikidata_id, site_id)
+        self.save_parsed_page(parsed, title, site_id, wikidata_id)
+
+    def parse_pages(self, site_id, pages, pool = None):
+        # Parse the fetched pages in a worker process if there is a pool, a future of their (parsed, templates) is returned.
+        plan = self.harvest_plan(site_id)
+        pages = [page for page in pages if not (page.get('missing') or page.get('error'))]
+        arguments = (plan, [None if 'templates' in page else page['page'].text for page in pages], [page['page'].title(with_ns=False) for page in pages], [page['wikidata_id'] for page in pages], site_id, [page.get('templates') for page in pages])
+        if pool:
+            return pool.submit(Collection.parse_texts, *arguments)
+        future = concurrent.futures.Future()
+        future.set_result(Collection.parse_texts(*arguments))
+        return future
+
+    def save_pages(self, site_id, pages, parsed, i, total):
+        # Save a group of pages once parsed, in the main process. Returns the number of pages harvested so far.
+        for (page, (result, templates)) in zip([page for page in pages if not (page.get('missing') or page.get('error'))], parsed):
+            page['parsed'] = result
+            page['templates'] = templates
+        if not self.offline:
+            self.pywb.store_pages(site_id, pages)
+            self.pywb.save_snapshots(site_id, pages)
+        self.prefetch_links(site_id, pages)
+        for page in pages:
+            if page.get('missing'):
+                self.db.cur.execute('UPDATE interwiki SET last_harvested = datetime("NOW"), errors = ? WHERE wikidata_id = ? AND lang = ?', ('missing page', page['wikidata_id'], site_id))
+            elif page.get('error'): # not marked as harvested, it is fetched again at the next run
+                self.db.cur.execute('UPDATE interwiki SET errors = ? WHERE wikidata_id = ? AND lang = ?', ('fetch failed: %s' % (page['error'],), page['wikidata_id'], site_id))
+            else:
+                self.save_parsed_page(page['parsed'], page['page'].title(with_ns=False), site_id, page['wikidata_id'])
+            i += 1
+            print('(%s/%s)' % (i, total), end='')
+            self.commit(i)
+        return i
+
+    @staticmethod
+    def parse_texts(plan, texts, titles, wikidata_ids, site_id, templates):
+        return [Collection.parse_text(plan, text, title, wikidata_id, site_id, page_templates) for (text, title, wikidata_id, page_templates) in zip(texts, titles, wikidata_ids, templates)]
+
+    @staticmethod
+    def parse_text(plan, text, title, wikidata_id, site_id, templates = None):
+        # Same as parse_page, the templates are returned too so that they can be stored.
+        templates = templates if templates is not None else Collection.extract_templates(text, title)
+        return (Collection.parse_page(plan, text, title, wikidata_id, site_id, templates), templates)
+
+    @staticmethod
+    def parse_page(plan, text, title, wikidata_id, site_id, templates = None):
+        # Runs in worker processes, so it only depends on its arguments.
+        # Returns the (wikidata_id, property, value, site_id) found, the matching templates and the errors; links are resolved later.
+        values = []
+        matching = []
         errors = []
-        searched_templates = self.copy_with_lowercase_keys(self.templates[site_id])
-        title = page.title(with_ns=False)
-        if self.debug:
-            print('Searching templates in', title)
-        props_to_analyze = {}
-        for (index, prop) in enumerate(props):
-            pprop = 'P%s' % (prop,)
-            props_to_analyze[pprop] = values[index] is None
-        j = 0
-        k = 0
-        for template in page.templatesWithParams():
-            if self.debug:
-                print('Found template', template)
-            template_page = template[0]
-            template_name = self.get_template_name_with_redirect(site_id, template_page)
-            if template_name in searched_templates:
-                if self.debug:
-                    print('Found template', template_name)
-                j += 1
-                searched_template = searched_templates[template_name]
-                (latitude, longitude) = (None, None)
-                for param in template[1]:
-                    param.replace('{{PAGENAME}}', title)
+        for template in (templates if templates is not None else Collection.extract_templates(text, title)):
+            template_name = plan.template_name(template[0])
+            searched_template = plan.templates.get(template_name) # redirects included
+            if searched_template is None:
+                continue
+            matching.append(template_name)
+            (latitude, longitude) = (None, None)
+            if isinstance(searched_template, dict): # template with named parameters
+                for (key, val) in template[2].items():
                     try:
-                        if isinstance(searched_template, dict): # template with named parameters
-                            keyval = param.split('=')
-                            if len(keyval) != 2:
+                        target = searched_template.get(key.lower())
+                        if not target or len(val) <= 2:
+                            continue
+                        (searched_property, kind) = target
+                        if kind == 'coordinates':
+                            val = plan.convert_coordinates(val)
+                        elif kind in ['latitude', 'longitude']:
+                            if kind == 'latitude':
+                                latitude = val
+                            else:
+                                longitude = val
+                            if not (latitude and longitude):
                                 continue
-                            key = keyval[0].strip().lower()
-                            val = keyval[1].strip()
-                            if key in searched_template.keys() and len(val) > 2:
-                                searched_property = searched_template[key]
-                                pprop = 'P%s' % (searched_property,)
-                                searched_property = searched_property if pprop in props_to_analyze else None # avoid harvesting props that are already defined
-                                if searched_property and searched_property in PYWB.managed_properties and PYWB.managed_properties[searched_property]['type'] == 'entity': # fetch wikidata_id of link target
-                                    val = self.find_items_in_value(page.site, val, PYWB.managed_properties[searched_property]['constraints'], not PYWB.managed_properties[searched_property]['multiple'])
-                                elif searched_property == '625a':
-                                    latitude = val
-                                elif searched_property == '625b':
-                                    longitude = val
-                                elif searched_property == 625:
-                                    val = val.strip().replace('\t', '').replace(' ', '|')
-                                    if val.count('/') == 1:
-                                        val = val.replace('/', '|') + '|0'
-                                    else:
-                                        val = val.replace('°', '/').replace('′', '/').replace('″', '/').replace("'", '/').replace('"', '/').replace('N/', 'N|').replace('S/', 'S|') + '|0'
-                                if searched_property in ['625a', '625b'] and latitude and longitude:
-                                    searched_property = 625
-                                    val = '%s|%s|0' % (latitude, longitude)
-                                if format(searched_property) in props and searched_property not in ['625a','625b'] and val:
-                                    self.save_harvested_value(searched_property, val, wikidata_id, site_id)
-                                    k += 1
-                        elif isinstance(searched_template, int) and len(param) > 2: # template with single parameter
-                            searched_property = searched_template
-                            if searched_property == 625:
-                                (latitude, longitude) = self.find_coordinates_in_template(template)
-                                param = '%s|%s|0' if latitude and longitude else ''
-                            self.save_harvested_value(searched_template, param, wikidata_id, site_id)
-                            k += 1
-                            break # to consider only the 1st parameter (e.g. {{Commonscat|commonscat|display}}
+                            val = '%s|%s|0' % (latitude, longitude)
+                        if val:
+                            values.append((wikidata_id, searched_property, val, site_id))
                     except Exception as e:
-                        errors.append(str(e))
-                        print('[EEE] Error when parsing param "%s" in template "%s" on "%s" (%s)' % (param, template_name, title, e))
+                        errors.append((str(e), '[EEE] Error when parsing param "%s=%s" in template "%s" on "%s" (%s)' % (key, val, template_name, title, e)))
+            else: # template with single parameter
+                for param in template[1]:
+                    if len(param) <= 2:
+                        continue
+                    if searched_template == 625:
+                        (latitude, longitude) = Collection.find_coordinates_in_template(template)
+                        param = '%s|%s|0' % (latitude, longitude) if latitude and longitude else ''
+                    if param:
+                        values.append((wikidata_id, searched_template, param, site_id))
+                    break # to consider only the 1st parameter (e.g. {{Commonscat|commonscat|display}}
+        return (values, matching, errors)
+
+    def save_parsed_page(self, parsed, title, site_id, wikidata_id):
+        (values, matching, parse_errors) = parsed
+        plan = self.harvest_plan(site_id)
+        if self.debug:
+            print('Searching templates in', title)
+            for template_name in matching:
+                print('Found template', template_name)
+        errors = []
+        for (error, message) in parse_errors:
+            errors.append(error)
+            print(message)
+        k = 0
+        site = None
+        for (item_id, searched_property, val, source) in values:
+            try:
+                if searched_property in plan.entities: # fetch wikidata_id of link target
+                    (constraints, one) = plan.entities[searched_property]
+                    site = site or pywikibot.Site(site_id.replace('wiki', ''))
+                    val = self.find_items_in_value(site, val, constraints, one)
+                if val:
+                    self.save_harvested_value(searched_property, val, item_id, source)
+                    k += 1
+            except Exception as e:
+                errors.append(str(e))
+                print('[EEE] Error when saving value "%s" for P%s on "%s" (%s)' % (val, searched_property, title, e))
         self.db.cur.execute('UPDATE interwiki SET last_harvested = datetime("NOW"), errors = ? WHERE wikidata_id = ? AND lang = ?', (' | '.join(errors), wikidata_id, site_id))
         if self.debug:
             if errors:
                 print('Errors:')
                 for error in errors:
                     print(error)
-            print(' - %s matching templates - %s values harvested in "%s"' % (j, k, title))
+            print(' - %s matching templates - %s values harvested in "%s"' % (len(matching), k, title))
         else:
-            print(' - %s matching templates - %s values harvested       ' % (j, k), end='\r')
+            print(' - %s matching templates - %s values harvested       ' % (len(matching), k), end='\r')
+
+    @staticmethod
+    def extract_templates(text, title = None):
+        # Templates of a wikitext as (name, positional parameters, named parameters), in a single pass, nested templates included.
+        # Parameters are numbered like MediaWiki does and stripped, {{PAGENAME}} is replaced by the title.
+        # Like mwparserfromhell, templates and links which are not closed are plain text: when a link contains the }} of a template,
+        # or a template the ]] of a link, the text is parsed again from there if it is not closed.
+        text = Collection.disabled_parts_regex.sub('', text)
+        if title:
+            text = Collection.pagename_regex.sub(lambda match: title, text)
+        templates = []
+        stack = [] # open templates, links and template parameters: [kind, start, separators, number of pipes, tried]
+        checkpoints = [] # (start of the element tried, position, stack, number of templates)
+
+        def separator(top, token, position):
+            top[2].append((token, position))
+            if token == '|':
+                top[3] += 1
+
+        def plain_text(element):
+            # The separators of an element which is not closed belong to the enclosing one.
+            if stack:
+                for (token, position) in element[2]:
+                    separator(stack[-1], token, position)
+
+        def copy(elements):
+            return [[kind, start, list(separators), pipes, tried] for (kind, start, separators, pipes, tried) in elements]
+
+        def backtrack(element_start):
+            # The element tried was not closed: parse again from the token it contained.
+            while checkpoints[-1][0] != element_start:
+                checkpoints.pop()
+            (start, position, saved, count) = checkpoints.pop()
+            stack[:] = copy(saved)
+            stack[-1][4] = False
+            del templates[count:]
+            return position
+
+        def attempt(top, position):
+            top[4] = True
+            checkpoints.append((top[1], position, copy(stack), len(templates)))
+
+        search = Collection.template_token_regex.search
+        invalid = Collection.invalid_name_regex.search # most names are valid, checked fully only if this matches
+        pos = 0
+        while True:
+            match = search(text, pos)
+            if not match:
+                if checkpoints:
+                    pos = backtrack(checkpoints[-1][0]) # the innermost element tried is not closed
+                    continue
+                break
+            token = match.group(0)
+            pos = match.end()
+            top = stack[-1] if stack else None
+            if token == '{{{':
+                stack.append(['parameter', pos, [], 0, None])
+            elif token == '{{':
+                stack.append(['template', pos, [], 0, None])
+            elif token == '[[':
+                stack.append(['link', pos, [], 0, None])
+            elif token == ']]':
+                while top and top[0] != 'link' and (not top[3] or top[4] is False): # brackets in a template name, or a template not closed
+                    plain_text(stack.pop())
+                    top = stack[-1] if stack else None
+                if top and top[0] == 'link' and not top[3] and invalid(text, top[1], match.start()) and Collection.invalid_name(text[top[1]:match.start()], True):
+                    plain_text(stack.pop()) # the brackets may close another link
+                    pos = match.start()
+                elif top and top[0] == 'link':
+                    if stack.pop()[4]:
+                        checkpoints.pop()
+                elif top and top[4] is None and any(element[0] == 'link' for element in stack):
+                    attempt(top, match.start()) # the brackets are in the template, if it is closed further
+            elif token in '|=':
+                if token == '|' and top and not top[3] and (invalid(text, top[1], match.start()) or top[0] != 'link') and Collection.invalid_name(text[top[1]:match.start()], top[0] == 'link'): # plain text
+                    plain_text(stack.pop())
+                    top = stack[-1] if stack else None
+                if top:
+                    if token == '|':
+                        top[3] += 1
+                    if top[0] != 'link' or len(stack) > 1: # those of a link only matter inside a template
+                        top[2].append((token, match.start()))
+            elif token == '}}}' and top and top[0] == 'parameter':
+                if stack.pop()[4]:
+                    checkpoints.pop()
+            else: # }} or }}} closing a template followed by a brace
+                if top and top[0] == 'link' and top[3] and top[4] is not False:
+                    if top[4] is None:
+                        attempt(top, match.start()) # the braces are in the text of the link, if it is closed further
+                    continue
+                failed = None
+                while stack and stack[-1][0] == 'link': # unclosed links are plain text
+                    link = stack.pop()
+                    if link[4]:
+                        failed = link
+                        break
+                    plain_text(link)
+                if failed:
+                    pos = backtrack(failed[1])
+                    continue
+                if stack and stack[-1][0] == 'parameter': # {{{name}} is a brace then a template
+                    stack[-1][0] = 'template'
+                if not stack or stack[-1][0] != 'template':
+                    continue
+                pos = match.start() + 2
+                element = stack.pop()
+                (kind, start, separators, count, tried) = element
+                if tried:
+                    checkpoints.pop()
+                pipes = []
+                equals = {}
+                for (separator_token, position) in separators:
+                    if separator_token == '|':
+                        pipes.append(position)
+                    elif pipes and len(pipes) - 1 not in equals:
+                        equals[len(pipes) - 1] = position
+                name = text[start:pipes[0] if pipes else match.start()].strip()
+                if Collection.invalid_name(name): # plain text, the braces may close another template
+                    plain_text(element)
+                    pos = match.start()
+                    continue
+                if name.startswith('#'): # parser functions
+                    continue
+                args = {}
+                number = 0
+                bounds = pipes + [match.start()]
+                for (index, pipe) in enumerate(pipes):
+                    if index in equals:
+                        args[text[pipe + 1:equals[index]].strip()] = text[equals[index] + 1:bounds[index + 1]].strip()
+                    else:
+                        number += 1
+                        args[format(number)] = text[pipe + 1:bounds[index + 1]].strip()
+                positional = []
+                while format(len(positional) + 1) in args:
+                    positional.append(args.pop(format(len(positional) + 1)))
+                templates.append((start, name, positional, args))
+        return [template[1:] for template in sorted(templates, key=lambda template: template[0])]
+
+    @staticmethod
+    def invalid_name(name, link = False):
+        # Names of templates and links cannot be empty or contain brackets, besides nested templates.
+        name = name if link else name.strip() # no line break in a link, even around its title
+        if not name:
+            return not link
+        return bool(Collection.invalid_name_regex.search(name) and Collection.invalid_name_regex.search(Collection.nested_template_regex.sub('', name)))
 
     def save_harvested_value(self, searched_property, value, wikidata_id, site_id):
         if self.debug:
@@ -422,10 +1141,10 @@ class Collection:
                 print('Delete', wikidata_id, 'because type', nature, 'is excluded.')
             self.db.cur.execute('DELETE FROM `%s` WHERE wikidata_id = ?' % (self.name,), (wikidata_id,))
             return
-        for prop in self.properties + self.mandatory_properties:
+        for (prop, kind, names) in self.property_columns():
             value = self.pywb.get_claim_value(prop, item)
             i += 1
-            self.db.cur.execute('UPDATE `%s` SET P%s = ? WHERE wikidata_id = ?' % (self.name, prop), (value, wikidata_id))
+            self.db.cur.execute('UPDATE `%s` SET %s WHERE wikidata_id = ?' % (self.name, ', '.join(['%s = ?' % (name,) for name in names])), self.column_values(kind, value) + [wikidata_id])
         for lang in self.languages:
             label = item.labels[lang] if item.labels and lang in item.labels.keys() else item.labels['mul'] if item.labels and 'mul' in item.labels.keys() else ''
             description = item.descriptions[lang] if item.descriptions and lang in item.descriptions.keys() else item.descriptions['mul'] if item.descriptions.keys() and 'mul' in item.descriptions else ''
@@ -433,27 +1152,125 @@ class Collection:
         self.db.cur.execute('UPDATE `%s` SET last_modified = datetime("NOW") WHERE wikidata_id = ?' % (self.name,), (wikidata_id,))
         print('- %s properties updated.' % (i,))
 
+    def outdated_query(self):
+        return 'SELECT wikidata_id FROM `%s` WHERE last_modified IS NULL' % (self.name,)
+
     def update_outdated_items(self):
-        self.db.cur.execute('SELECT wikidata_id FROM `%s` WHERE last_modified IS NULL' % (self.name,))
+        if self.bulk_refresh:
+            return self.refresh_outdated_items()
+        self.db.cur.execute(self.outdated_query())
         ids_to_update = [item[0] for item in self.db.cur.fetchall()]
         total = len(ids_to_update)
         print(total, 'elements to update.')
         i = 0
         for wikidata_id in ids_to_update:
+            if i % self.preload_window == 0:
+                self.pywb.preload_items(ids_to_update[i:i + self.preload_window])
             i += 1
-            item = self.get_item(wikidata_id)
             try:
-                if item and item.exists():
-                    print('(%s/%s) - Q%s' % (i, total, wikidata_id), end=' ')
-                    self.update_item(item)
+                self.pywb.call(self.pywb.wikidata, self.update_outdated_item, wikidata_id, i, total)
+            except PYWB.transient_errors as e:
+                print('ERROR... (%s) Q%s will be updated next time.' % (e, wikidata_id))
+            self.commit(i)
+        self.commit(0)
+
+    def refresh_outdated_items(self):
+        # Same query as fetch, restricted to chunks of outdated IDs: one SPARQL request per chunk instead of one API call per item.
+        self.db.cur.execute(self.outdated_query())
+        ids_to_update = [item[0] for item in self.db.cur.fetchall()]
+        print(len(ids_to_update), 'elements to refresh.')
+        columns = [name for (prop, kind, names) in self.property_columns() for name in names]
+        fallback = []
+        refreshed = set()
+        while ids_to_update:
+            chunk = [wikidata_id for wikidata_id in ids_to_update[:self.refresh_size] if wikidata_id not in refreshed]
+            ids_to_update = ids_to_update[self.refresh_size:]
+            refreshed.update(chunk)
+            if not chunk:
+                continue
+            values = 'VALUES ?%s { %s }' % (self.name, ' '.join(['wd:Q%s' % (wikidata_id,) for wikidata_id in chunk]))
+            bindings = self.download_bindings(self.build_query(None, values))
+            if bindings is None:
+                print('ERROR... %s items will be refreshed next time.' % (len(chunk),))
+                continue
+            found = set([int(item[self.name].split('/')[-1].replace('Q', '')) for item in bindings])
+            # values removed from Wikidata must not survive the upsert
+            self.db.cur.executemany('UPDATE `%s` SET %s WHERE wikidata_id = ?' % (self.name, ', '.join(['%s = NULL' % (column,) for column in columns])), [(wikidata_id,) for wikidata_id in found])
+            if bindings:
+                self.save_bindings(bindings, len(bindings))
+            missing = [wikidata_id for wikidata_id in chunk if wikidata_id not in found]
+            if missing:
+                (redirected, filtered) = self.resolve_missing_items(missing)
+                ids_to_update.extend(redirected)
+                fallback.extend(filtered)
+        self.commit(0)
+        if fallback:
+            # still in the collection but filtered out by the query (articles or mandatory properties), load them one by one
+            print(len(fallback), 'elements to update.')
+            for (i, wikidata_id) in enumerate(fallback, 1):
+                if i % self.preload_window == 1:
+                    self.pywb.preload_items(fallback[i - 1:i - 1 + self.preload_window])
+                try:
+                    self.pywb.call(self.pywb.wikidata, self.update_outdated_item, wikidata_id, i, len(fallback))
+                except PYWB.transient_errors as e:
+                    print('ERROR... (%s) Q%s will be updated next time.' % (e, wikidata_id))
+                self.commit(i)
+            self.commit(0)
+
+    def resolve_missing_items(self, ids):
+        # Items missing from the refresh query: follow redirects, delete the items which were deleted or left the collection.
+        country_filter = ('?%s wdt:P17 wd:Q%s .' % (self.name, self.country)) if self.country else ''
+        main_condition = ' (wdt:P31/wdt:P279*) wd:Q%s ' % self.main_type if self.main_type else self.main_condition
+        values = ' '.join(['wd:Q%s' % (wikidata_id,) for wikidata_id in ids])
+        query = 'SELECT ?%s ?target ?member WHERE { VALUES ?%s { %s } OPTIONAL { ?%s owl:sameAs ?target . } OPTIONAL { ?%s %s . %s BIND(1 AS ?member) } }' % (self.name, self.name, values, self.name, self.name, main_condition, country_filter)
+        bindings = self.download_bindings(query)
+        if bindings is None:
+            return ([], [])
+        targets = {}
+        members = set()
+        for item in bindings:
+            wikidata_id = int(item[self.name].split('/')[-1].replace('Q', ''))
+            if 'target' in item:
+                targets[wikidata_id] = int(item['target'].split('/')[-1].replace('Q', ''))
+            if 'member' in item:
+                members.add(wikidata_id)
+        redirected = []
+        filtered = []
+        deleted = 0
+        for wikidata_id in ids:
+            if wikidata_id in targets:
+                new_id = targets[wikidata_id]
+                self.db.cur.execute('SELECT wikidata_id FROM `%s` WHERE wikidata_id = ?' % (self.name,), (new_id,))
+                if len(self.db.cur.fetchall()) == 0: # avoid unicity constraint violation
+                    self.db.cur.execute('UPDATE `%s` SET wikidata_id = ?, last_modified = NULL WHERE wikidata_id = ?' % (self.name,), (new_id, wikidata_id))
+                    redirected.append(new_id)
                 else:
                     self.db.cur.execute('DELETE FROM `%s` WHERE wikidata_id = ?' % (self.name,), (wikidata_id,))
-            except pywikibot.exceptions.MaxlagTimeoutError as e:
-                print('ERROR... (%s) will retry in %s seconds...' % (e, self.sleep))
-                time.sleep(self.sleep)
-                self.update_outdated_items()
-            self.commit(i)
+            elif wikidata_id in members:
+                filtered.append(wikidata_id)
+            else:
+                self.db.cur.execute('DELETE FROM `%s` WHERE wikidata_id = ?' % (self.name,), (wikidata_id,))
+                deleted += 1
         self.commit(0)
+        print('%s redirects followed, %s removed items deleted.' % (len(redirected), deleted))
+        return (redirected, filtered)
+
+    def download_bindings(self, query):
+        # Uncached query: the cache entry written by download is only used to retry and to parse the response.
+        key = self.cache_key(query)
+        if not self.download(query, key):
+            return None
+        bindings = list(self.cache.read(key))
+        self.cache.delete(key)
+        return bindings
+
+    def update_outdated_item(self, wikidata_id, i, total):
+        item = self.get_item(wikidata_id)
+        if item and item.exists():
+            print('(%s/%s) - Q%s' % (i, total, wikidata_id), end=' ')
+            self.update_item(item)
+        else:
+            self.db.cur.execute('DELETE FROM `%s` WHERE wikidata_id = ?' % (self.name,), (wikidata_id,))
 
     def get_item(self, wikidata_id):
         item = self.pywb.ItemPage(wikidata_id)
@@ -474,12 +1291,57 @@ class Collection:
             self.db.con.commit()
 
     def copy_harvested_properties(self, only_those = None):
+        # All the values harvested for an item are checked, then saved in a single edit.
         props = only_those or self.properties
+        query = self.copy_harvested_properties_query(props)
+        if self.debug:
+            print(query)
+        self.db.cur.execute(query)
+        results = self.db.cur.fetchall()
+        i = 0
+        t = len(set([row[0] for row in results]))
+        print('Found values to write for %s items.' % (t,))
+        self.login()
+        self.pywb.batch_claims = True
+        try:
+            items = [wikidata_id for (wikidata_id, rows) in itertools.groupby(results, key=lambda row: row[0])]
+            for (wikidata_id, rows) in itertools.groupby(results, key=lambda row: row[0]):
+                if i % self.preload_window == 0:
+                    self.pywb.preload_items(items[i:i + self.preload_window])
+                i += 1
+                written = []
+                for (wikidata_id, source, *values) in rows:
+                    for (prop, value) in zip(props, values):
+                        if value is not None: # a second source is still checked, add_claim ignores the duplicates
+                            print('(%s/%s)' % (i, t), end=' ')
+                            if self.pywb.write_prop(prop, wikidata_id, value, source):
+                                written.append((prop, source))
+                self.pywb.save_claims()
+                if written:
+                    self.mark_outdated(wikidata_id)
+                for (prop, source) in written:
+                    self.db.cur.execute('UPDATE harvested SET P%s = NULL WHERE wikidata_id = ? AND source = ?' % (prop,), (wikidata_id, source))
+                self.commit(i)
+        finally:
+            self.pywb.save_claims()
+            self.pywb.batch_claims = False
+        self.pywb.retry_failed_edits()
+        self.commit(0)
+
+    def copy_harvested_properties_query(self, props):
+        # One select per property reads its partial index harvested_P<n>, then the values of each item and source are put together.
+        selects = []
         for prop in props:
-            self.copy_harvested_property(prop)
+            values = ', '.join(['%s AS v%s' % ('h.P%s' % (prop,) if other == prop else 'NULL', index) for (index, other) in enumerate(props)])
+            selects.append('SELECT h.wikidata_id, h.source, %s FROM harvested h JOIN `%s` w ON w.wikidata_id = h.wikidata_id WHERE h.P%s IS NOT NULL AND w.P%s IS NULL' % (values, self.name, prop, prop))
+        columns = ', '.join(['MAX(v%s)' % (index,) for index in range(len(props))]) # at most one value per item, source and property
+        return 'SELECT wikidata_id, source, %s FROM (%s) GROUP BY wikidata_id, source ORDER BY wikidata_id, source' % (columns, ' UNION ALL '.join(selects))
+
+    def copy_harvested_query(self, prop):
+        return 'SELECT h.wikidata_id, h.P%s, h.source FROM harvested h JOIN `%s` w ON w.wikidata_id = h.wikidata_id WHERE h.P%s IS NOT NULL AND w.P%s IS NULL' % (prop, self.name, prop, prop)
 
     def copy_harvested_property(self, prop):
-        query = 'SELECT h.wikidata_id, h.P%s, h.source FROM harvested h JOIN `%s` w ON w.wikidata_id = h.wikidata_id WHERE h.P%s IS NOT NULL AND w.P%s IS NULL' % (prop, self.name, prop, prop)
+        query = self.copy_harvested_query(prop)
         if self.debug:
             print(query)
         self.db.cur.execute(query)
@@ -487,52 +1349,479 @@ class Collection:
         i = 0
         t = len(results)
         print('Found %s values to write for P%s.' % (t, prop))
-        self.login(self.copy_harvested_property, prop)
+        self.login()
         for (wikidata_id, title, source) in results:
+            if i % self.preload_window == 0:
+                self.pywb.preload_items([row[0] for row in results[i:i + self.preload_window]])
             i += 1
             print('(%s/%s)' % (i, t), end=' ')
             if self.pywb.write_prop(prop, wikidata_id, title, source):
                 self.mark_outdated(wikidata_id)
                 self.db.cur.execute('UPDATE harvested SET P%s = NULL WHERE wikidata_id = ? AND source = ?' % (prop,), (wikidata_id, source))
             self.commit(i)
+        self.pywb.retry_failed_edits()
         self.commit(0)
 
+    def copy_ciwiki_query(self):
+        return 'SELECT i.wikidata_id, i.title FROM interwiki i JOIN `%s` w ON w.wikidata_id = i.wikidata_id WHERE i.lang = "commonswiki" AND w.P373 IS NULL' % (self.name,)
+
     def copy_ciwiki_to_declaration(self):
-        self.db.cur.execute('SELECT i.wikidata_id, i.title FROM interwiki i JOIN `%s` w ON w.wikidata_id = i.wikidata_id WHERE i.lang = "commonswiki" AND w.P373 IS NULL' % (self.name,))
+        self.db.cur.execute(self.copy_ciwiki_query())
         results = self.db.cur.fetchall()
         i = 0
         t = len(results)
         print('Found %s Commons links to write to P373.' % (t,))
         if t == 0:
             return
-        self.login(self.copy_ciwiki_to_declaration)
+        self.login()
         for (wikidata_id, title) in results:
             i += 1
             print('(%s/%s)' % (i, t), end=' ')
             self.pywb.write_prop_373(wikidata_id, title)
             self.mark_outdated(wikidata_id)
             self.commit(i)
+        self.pywb.retry_failed_edits()
         self.commit(0)
 
-    def login(self, callback = None, arg = None):
+    def login(self):
         if not self.pywb.wikidata.logged_in():
-            try:
-                self.pywb.wikidata.login()
-            except pywikibot.exceptions.MaxlagTimeoutError as e:
-                print('ERROR... (%s) will retry in %s seconds...' % (e, self.sleep))
-                time.sleep(self.sleep)
-                if callback:
-                    callback(arg)
+            self.pywb.call(self.pywb.wikidata, self.pywb.wikidata.login)
+
+class HarvestPlan:
+    # Templates of a wiki compiled once: lowercase names and redirects, parameter -> (property, kind) and the properties to harvest.
+    coordinates_separators = str.maketrans({'°': '/', '′': '/', '″': '/', "'": '/', '"': '/'})
+    hemisphere_regex = re.compile(r'([NS])/')
+
+    def __init__(self, templates, properties, aliases = None):
+        self.templates = {}
+        self.entities = {} # property -> (constraints, only one value)
+        props = set()
+        for name, params in templates.items():
+            if isinstance(params, dict):
+                compiled = {}
+                for param, prop in params.items():
+                    kind = self.kind(prop)
+                    prop = 625 if kind in ['latitude', 'longitude'] else prop
+                    if prop not in properties:
+                        continue
+                    compiled[param.lower()] = (prop, kind)
+                    props.add(format(prop))
+                    if kind == 'entity':
+                        self.entities[prop] = (PYWB.managed_properties[prop]['constraints'], not PYWB.managed_properties[prop]['multiple'])
+                self.templates[name.lower()] = compiled
+            elif isinstance(params, int) and params in properties:
+                self.templates[name.lower()] = params
+                props.add(format(params))
+                if self.kind(params) == 'entity':
+                    self.entities[params] = (PYWB.managed_properties[params]['constraints'], not PYWB.managed_properties[params]['multiple'])
+        self.props = sorted(props)
+        self.names = {} # template names as written in the pages -> normalized names
+        for (alias, template) in (aliases or {}).items():
+            if template in self.templates:
+                self.templates[alias] = self.templates[template]
+
+    @staticmethod
+    def kind(prop):
+        if prop == '625a':
+            return 'latitude'
+        if prop == '625b':
+            return 'longitude'
+        if prop == 625:
+            return 'coordinates'
+        if prop in PYWB.managed_properties and PYWB.managed_properties[prop]['type'] == 'entity':
+            return 'entity'
+        return 'value'
+
+    def template_name(self, name):
+        normalized = self.names.get(name)
+        if normalized is None:
+            normalized = ' '.join(name.replace('_', ' ').split()).lower()
+            normalized = normalized[9:].lstrip() if normalized.startswith('template:') else normalized
+            self.names[name] = normalized
+        return normalized
+
+    @staticmethod
+    def convert_coordinates(val):
+        val = val.strip().replace('\t', '').replace(' ', '|')
+        if val.count('/') == 1:
+            return val.replace('/', '|') + '|0'
+        return HarvestPlan.hemisphere_regex.sub(r'\1|', val.translate(HarvestPlan.coordinates_separators)) + '|0'
 
 class Database:
-    def __init__(self, filepath):
-        self.con = sqlite3.connect(filepath)
+    # One writer connection (con, cur) used by the main thread, and one read-only connection per thread which reads while it writes.
+    profiles = {
+        'default': {}, # SQLite defaults: rollback journal, synchronous FULL
+        'fast': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -64000, 'mmap_size': 256 * 1024 ** 2, 'temp_store': 'MEMORY'}, # a crash of the machine may lose the last commits, never corrupt the DB
+        'bulk': {'journal_mode': 'WAL', 'synchronous': 'OFF', 'cache_size': -256000, 'mmap_size': 1024 ** 3, 'temp_store': 'MEMORY'}, # for a first fetch, the DB can be rebuilt
+    }
+
+    def __init__(self, filepath, profile = 'default'):
+        self.filepath = filepath
+        self.pragmas = self.profiles[profile] if isinstance(profile, str) else profile # name of a profile or dict of PRAGMAs
+        self.con = self.connect()
         self.cur = self.con.cursor()
+        self.local = threading.local()
+        self.readers = []
+        self.lock = threading.Lock()
+
+    def connect(self, read_only = False):
+        # Readers may be closed by another thread than theirs, in close().
+        con = sqlite3.connect(self.filepath, timeout=30, check_same_thread=not read_only)
+        for (pragma, value) in self.pragmas.items():
+            if not (read_only and pragma == 'journal_mode'): # the journal mode belongs to the file, the writer sets it
+                con.execute('PRAGMA %s = %s' % (pragma, value))
+        if read_only:
+            con.execute('PRAGMA query_only = ON')
+        return con
+
+    def reader(self):
+        # Cursor of the read-only connection of the current thread. In WAL mode, readers see the last commit and never block the writer.
+        if self.filepath == ':memory:' or self.filepath.startswith('file::memory:'):
+            return self.con.cursor() # not shared between connections
+        con = getattr(self.local, 'con', None)
+        if con is None:
+            con = self.connect(True)
+            self.local.con = con
+            with self.lock:
+                self.readers.append(con)
+        return con.cursor()
+
+    def read(self, query, params = ()):
+        cursor = self.reader()
+        try:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def close(self):
+        with self.lock:
+            for con in self.readers:
+                con.close()
+            self.readers = []
+        self.local = threading.local()
+        self.con.commit()
+        self.con.close()
 
     def vacuum(self):
         self.cur.execute('VACUUM')
 
+class LRUCache:
+    # Dictionary keeping the most recently used entries, within a number of entries and/or an approximate size in bytes.
+    def __init__(self, max_entries = None, max_bytes = None, sizer = sys.getsizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizer = sizer
+        self.entries = OrderedDict() # key -> (value, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.invalidate(key)
+            size = self.sizer(value) if self.max_bytes else 0
+            self.entries[key] = (value, size)
+            self.size += size
+            self.evict()
+
+    def __delitem__(self, key):
+        self.invalidate(key)
+
+    def get(self, key, default = None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            return default
+
+    def invalidate(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def resize(self, key):
+        # Measure an entry again, when its value has grown since it was stored.
+        with self.lock:
+            if key in self.entries and self.max_bytes:
+                (value, size) = self.entries[key]
+                self.entries[key] = (value, self.sizer(value))
+                self.size += self.entries[key][1] - size
+                self.evict()
+
+    def evict(self):
+        with self.lock:
+            while self.entries and ((self.max_entries and len(self.entries) > self.max_entries) or (self.max_bytes and self.size > self.max_bytes)):
+                (key, (value, size)) = self.entries.popitem(last=False)
+                self.size -= size
+                self.evictions += 1
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+class RateLimiter:
+    # Token bucket for one host, with a rate and a number of concurrent requests adjusted AIMD-style:
+    # increased after successful requests up to their maximum, halved when the server asks to slow down.
+    def __init__(self, rate, burst = None, concurrency = 4, max_concurrency = 50, max_rate = None):
+        self.rate = rate
+        self.max_rate = max_rate or rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.paused_until = 0
+        self.updated = time.monotonic()
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    self.condition.wait(self.paused_until - now)
+                elif self.active >= int(self.concurrency):
+                    self.condition.wait()
+                elif self.tokens < 1:
+                    self.condition.wait((1 - self.tokens) / self.rate)
+                else:
+                    self.tokens -= 1
+                    self.active += 1
+                    return
+
+    def release(self, delay = 0, failed = False):
+        with self.condition:
+            self.active -= 1
+            if delay:
+                self.concurrency = max(1, self.concurrency / 2)
+                self.rate = max(self.max_rate / 20, self.rate / 2)
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            elif not failed: # a failed request does not show that the server can take more
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+            self.condition.notify_all()
+
+class Cache:
+    # Compressed SPARQL results, stored as pickled batches of compact bindings and evicted by least recent use.
+    def __init__(self, directory, compression = 'gzip', max_size = 1024 ** 3, batch_size = 1000):
+        self.directory = directory
+        self.compression = compression # 'gzip', 'lzma' or None
+        self.max_size = max_size # in bytes, None means no limit
+        self.batch_size = batch_size
+        self.extension = {'gzip': '.pickle.gz', 'lzma': '.pickle.xz'}.get(compression, '.pickle')
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.extension)
+
+    def open(self, path, mode):
+        if self.compression == 'gzip':
+            return gzip.open(path, mode, compresslevel=5)
+        if self.compression == 'lzma':
+            return lzma.open(path, mode)
+        return open(path, mode)
+
+    def is_recent(self, key, days):
+        path = self.path(key)
+        recent = os.path.isfile(path) and os.path.getmtime(path) > time.time() - days * 24 * 3600
+        with self.lock:
+            if recent:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return recent
+
+    def read(self, key):
+        path = self.path(key)
+        os.utime(path, (time.time(), os.path.getmtime(path))) # the access time orders the eviction, the modification time tells the age
+        # The entry ends with ('end', count): a cut file must not load as a smaller collection, it is removed and counted as a miss.
+        count = 0
+        with self.open(path, 'rb') as f:
+            while True:
+                try:
+                    batch = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError, lzma.LZMAError, zlib.error, gzip.BadGzipFile):
+                    break
+                if isinstance(batch, tuple):
+                    if batch == ('end', count):
+                        return
+                    break
+                count += len(batch)
+                yield from batch
+        self.delete(key)
+        with self.lock:
+            self.misses += 1
+        raise EOFError('incomplete cache entry "%s" (%s bindings read)' % (key, count))
+
+    def tee(self, key, bindings):
+        # Yield the bindings while writing them, the entry only replaces the previous one once complete.
+        path = self.path(key)
+        part = '%s.%s.part' % (path, threading.get_ident())
+        complete = False
+        try:
+            count = 0
+            with self.open(part, 'wb') as f:
+                for batch in Collection.chunks(bindings, self.batch_size):
+                    pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+                    count += len(batch)
+                    yield from batch
+                pickle.dump(('end', count), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(part, path)
+            complete = True
+        finally:
+            if not complete and os.path.exists(part):
+                os.remove(part)
+        self.evict(key)
+
+    def write(self, key, bindings):
+        for binding in self.tee(key, bindings):
+            pass
+
+    def delete(self, key):
+        path = self.path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def evict(self, keep = None):
+        if self.max_size is None:
+            return
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if not name.endswith('.part') and os.path.isfile(path): # the JSON files of the previous format count too, they are never read again
+                    stat = os.stat(path)
+                    entries.append((stat.st_atime, stat.st_size, name))
+            total = sum([size for (atime, size, name) in entries])
+            for (atime, size, name) in sorted(entries):
+                if total <= self.max_size:
+                    break
+                if keep is not None and name == keep + self.extension:
+                    continue
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+                self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+class SnapshotStore:
+    # Wikitext of the fetched pages, compressed and stored once per content hash, indexed by (site, title, revision) in an SQLite file.
+    def __init__(self, directory, max_revisions = 1, compression = 'lzma'):
+        self.directory = directory
+        self.max_revisions = max_revisions # revisions kept per page, the older ones are removed when a new one is added
+        self.compression = compression # 'lzma', 'zlib' or None
+        self.extension = {'lzma': '.xz', 'zlib': '.z'}.get(compression, '.txt')
+        self.db = None
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def database(self):
+        if not self.db:
+            self.db = Database(os.path.join(self.directory, 'snapshots.db'), 'fast')
+            self.db.cur.execute('CREATE TABLE IF NOT EXISTS snapshots (lang, title, target, revid INT, hash, stored, CONSTRAINT `unique_revision` UNIQUE(lang, title, revid) ON CONFLICT REPLACE)')
+            self.db.cur.execute('CREATE INDEX IF NOT EXISTS `snapshots_hash` ON snapshots (hash)')
+            self.db.con.commit()
+        return self.db
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + self.extension)
+
+    def add(self, site_id, title, target, revid, text):
+        # title is the one requested, target the page read after a redirect.
+        data = text.encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path): # same content, same file
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            part = '%s.%s.part' % (path, threading.get_ident())
+            with open(part, 'wb') as f:
+                f.write(lzma.compress(data) if self.compression == 'lzma' else zlib.compress(data, 9) if self.compression == 'zlib' else data)
+            os.replace(part, path)
+        db = self.database()
+        db.cur.execute('INSERT INTO snapshots (lang, title, target, revid, hash, stored) VALUES (?, ?, ?, ?, ?, datetime("NOW"))', (site_id, title, target, revid, digest))
+        self.retain(site_id, title)
+
+    def retain(self, site_id, title):
+        db = self.database()
+        db.cur.execute('SELECT revid, hash FROM snapshots WHERE lang = ? AND title = ? ORDER BY revid DESC LIMIT -1 OFFSET ?', (site_id, title, self.max_revisions))
+        removed = db.cur.fetchall()
+        for (revid, digest) in removed:
+            db.cur.execute('DELETE FROM snapshots WHERE lang = ? AND title = ? AND revid = ?', (site_id, title, revid))
+            db.cur.execute('SELECT COUNT(*) FROM snapshots WHERE hash = ?', (digest,))
+            if db.cur.fetchone()[0] == 0 and os.path.exists(self.path(digest)):
+                os.remove(self.path(digest))
+
+    def commit(self):
+        if self.db:
+            self.db.con.commit()
+
+    def load(self, digest):
+        # Memory-mapped, the compressed file is decompressed without being copied first.
+        path = self.path(digest)
+        if os.path.getsize(path) == 0:
+            return ''
+        with open(path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                data = lzma.decompress(data) if self.compression == 'lzma' else zlib.decompress(data) if self.compression == 'zlib' else data[:]
+        return data.decode('utf-8')
+
+    def read(self, site_id, title, revid = None):
+        # (target, revid, text) of the given or latest revision, None if it was not kept.
+        db = self.database()
+        if revid:
+            db.cur.execute('SELECT target, revid, hash FROM snapshots WHERE lang = ? AND title = ? AND revid = ?', (site_id, title, revid))
+        else:
+            db.cur.execute('SELECT target, revid, hash FROM snapshots WHERE lang = ? AND title = ? ORDER BY revid DESC LIMIT 1', (site_id, title))
+        row = db.cur.fetchone()
+        return (row[0], row[1], self.load(row[2])) if row else None
+
+    def read_latest(self, site_id, titles):
+        # title -> (target, revid, text) of the latest revisions of several pages.
+        db = self.database()
+        rows = {}
+        for chunk in Collection.chunks(titles, 500):
+            db.cur.execute('SELECT title, target, MAX(revid), hash FROM snapshots WHERE lang = ? AND title IN (%s) GROUP BY title' % (','.join(['?'] * len(chunk)),), [site_id] + chunk)
+            rows.update({row[0]: row[1:] for row in db.cur.fetchall()})
+        return {title: (target, revid, self.load(digest)) for (title, (target, revid, digest)) in rows.items()}
+
+    def stats(self):
+        db = self.database()
+        db.cur.execute('SELECT COUNT(*), COUNT(DISTINCT hash) FROM snapshots')
+        (revisions, files) = db.cur.fetchone()
+        return {'revisions': revisions, 'files': files}
+
 class PYWB:
+    transient_errors = (pywikibot.exceptions.ServerError, pywikibot.exceptions.TimeoutError) # including maxlag timeouts
     date_properties = [569, 570, 571, 574, 575, 576, 577, 580]
     image_properties = [18, 94, 154, 158, 242, 1442, 1801, 1943, 3311, 3451, 5775, 8592, 9721] # jpg|jpeg|jpe|png|svg|tif|tiff|gif|xcf|pdf|djvu|webp
     integer_properties = [2971, 3407, 8366, 10689]
@@ -940,31 +2229,78 @@ class PYWB:
         self.site = pywikibot.Site(lang)
         self.commons = self.site.image_repository()
         self.wikidata = self.site.data_repository()
-        self.items = {} # cache for Wikidata items
-        self.categories = {} # cache for Commons categories
-        self.pages = {} # cache for pages, per site
-        self.sleep = 70 # rate-limiting
+        self.items = LRUCache(max_entries=10000) # cache for Wikidata items
+        self.categories = LRUCache(max_entries=10000) # cache for Commons categories
+        self.pages = LRUCache(max_entries=5000, max_bytes=256 * 1024 ** 2, sizer=PYWB.page_size) # cache for pages, by (site, title)
+        self.rate = 10 # maximum number of page requests per second and per wiki
+        self.edit_rate = 1 # initial number of edits per second, adapted to the lag reported by the server
+        self.max_edit_rate = 5
+        self.retries = 5 # attempts for each request when the server asks to slow down
+        self.backoff_delay = 5 # seconds before the 1st retry, doubled at each attempt
+        self.max_backoff_delay = 120
+        self.failed_edits = [] # (function, args, kwargs) to retry with retry_failed_edits
+        self.scheduled = threading.local()
+        self.pace_edits = False # True to let the rate limiter pace the edits up to max_edit_rate, instead of config.put_throttle
+        self.preload_size = 50 # number of pages loaded per API request, 50 is the maximum for page contents
+        self.rate_limiters = {}
+        self.lock = threading.Lock()
+        self.constraints_path = 'constraints.db' # natures and superclasses of the items checked against constraints
+        self.constraints_ttl = 30 # check them again after 30 days
+        self.constraints_db = None
+        self.constraint_decisions = {} # (item, constraints) -> matching item or False
+        self.closures = {} # constraints -> all their subclasses
+        self.batch_claims = False # queue claims in add_claim, save_claims writes them in one edit per item
+        self.pending_claims = {} # QID -> (item, claims)
+        self.constraint_stats = {'decisions': 0, 'cached': 0, 'loaded': 0}
+        self.page_store_path = 'pages.db' # templates of the harvested pages by revision, shared by all the collections, None to disable
+        self.page_store_ttl = 1 # use the stored templates without checking the revision of the page during 1 day
+        self.page_store = None
+        self.page_stats = {'reused': 0, 'checked': 0, 'fetched': 0}
+        self.snapshots = None # SnapshotStore keeping the text of the fetched pages, to harvest them again offline
 
     def ItemPage(self, wikidata_id):
-        if wikidata_id in self.items:
-            return self.items[wikidata_id]
+        cached = self.items.get(wikidata_id)
+        if cached is not None:
+            return cached
         datapage = pywikibot.ItemPage(self.wikidata, wikidata_id if format(wikidata_id).startswith('Q') else 'Q%s' % wikidata_id)
-        try:
-            if datapage.isRedirectPage():
-                datapage = pywikibot.ItemPage(self.wikidata, datapage.getRedirectTarget().title())
-        except pywikibot.exceptions.MaxlagTimeoutError as e:
-            print('ERROR... (%s) will retry in %s seconds...' % (e, self.sleep))
-            time.sleep(self.sleep)
-            return self.ItemPage(wikidata_id)
+        if self.call(self.wikidata, datapage.isRedirectPage):
+            datapage = pywikibot.ItemPage(self.wikidata, datapage.getRedirectTarget().title())
         self.items[wikidata_id] = datapage
         return datapage
 
+    def preload_items(self, wikidata_ids):
+        # Load the items which are not cached yet, 50 per request with redirects resolved, and cache them for ItemPage.
+        ids = {}
+        for wikidata_id in wikidata_ids:
+            if wikidata_id not in self.items:
+                ids['Q%s' % format(wikidata_id).replace('Q', '')] = wikidata_id
+        qids = list(ids.keys())
+        for start in range(0, len(qids), self.preload_size):
+            try:
+                data = self.call(self.wikidata, self.wikidata.simple_request(action='wbgetentities', ids=qids[start:start + self.preload_size]).submit)
+            except pywikibot.exceptions.Error as e:
+                print('ERROR... (%s) items will be loaded one by one' % (e,))
+                return
+            for (qid, entity) in data.get('entities', {}).items():
+                qid = entity.get('redirects', {}).get('from', qid)
+                if qid not in ids:
+                    continue
+                if 'missing' in entity:
+                    item = pywikibot.ItemPage(self.wikidata, qid)
+                    item._content = entity # exists() is False without any request
+                else:
+                    item = pywikibot.ItemPage(self.wikidata, entity['id']) # the target of a redirect
+                    item._content = entity
+                    item.get()
+                self.items[ids[qid]] = item
+
     def Category(self, title):
-        if title in self.categories:
-            return self.categories[title]
+        cached = self.categories.get(title)
+        if cached is not None:
+            return cached
         category = pywikibot.Category(self.commons, 'Category:%s' % title)
-        if category.isCategoryRedirect():
-            category = category.getCategoryRedirectTarget()
+        if self.call(self.commons, category.isCategoryRedirect):
+            category = self.call(self.commons, category.getCategoryRedirectTarget)
         self.categories[title] = category
         return category
 
@@ -976,20 +2312,40 @@ class PYWB:
 
     def FilePage(self, title):
         filepage = pywikibot.FilePage(self.commons, 'File:%s' % title)
-        if filepage.isRedirectPage():
-            filepage = self.FilePage(filepage.getRedirectTarget().title(with_ns=False))
+        if self.call(self.commons, filepage.isRedirectPage):
+            filepage = self.FilePage(self.call(self.commons, filepage.getRedirectTarget).title(with_ns=False))
         return filepage
 
     def Page(self, site_id, title):
-        if site_id in self.pages and title in self.pages[site_id].keys():
-            return self.pages[site_id][title]
+        cached = self.pages.get((site_id, title))
+        if cached is not None:
+            return cached
         site = pywikibot.Site(site_id.replace('wiki', ''))
-        if site_id not in self.pages:
-            self.pages[site_id] = {}
         page = pywikibot.Page(site, title)
-        self.pages[site_id][title] = page
+        self.pages[(site_id, title)] = page
         return page
 
+    def print_cache_stats(self):
+        for (name, cache) in (('items', self.items), ('categories', self.categories), ('pages', self.pages)):
+            stats = cache.stats()
+            lookups = stats['hits'] + stats['misses']
+            print('Cache of %s: %s entries, %.1f MB, %s%% hits, %s evictions' % (name, stats['entries'], stats['bytes'] / 1024 ** 2, round(100 * stats['hits'] / lookups) if lookups else 0, stats['evictions']))
+        stats = self.constraint_stats
+        print('Constraints: %s decisions reused, %s items read from %s, %s items loaded from Wikidata' % (stats['decisions'], stats['cached'], self.constraints_path, stats['loaded']))
+        if self.page_store_path:
+            stats = self.page_stats
+            print('Pages: %s read from %s without request, %s after checking their revision, %s fetched' % (stats['reused'], self.page_store_path, stats['checked'], stats['fetched']))
+
+    @staticmethod
+    def page_size(page):
+        # Approximate memory used by a page, mostly its loaded text.
+        if isinstance(page, str):
+            return sys.getsizeof(page)
+        size = sys.getsizeof(page)
+        for revision in getattr(page, '_revisions', {}).values():
+            size += len(revision.get('text') or '')
+        return size
+
     def add_claim(self, item, claim, source = None):
         if self.wikidata.logged_in() is True and self.wikidata.user() == self.user:
             try:
@@ -1007,41 +2363,355 @@ class PYWB:
                         claim.addSource(qualifier)
                     else:
                         print('ERROR: unknown source', source)
-                item.addClaim(claim)
-                print(' - added!')
-            except (pywikibot.exceptions.OtherPageSaveError, pywikibot.exceptions.MaxlagTimeoutError) as e:
+                if self.batch_claims:
+                    (item_, claims) = self.pending_claims.setdefault(item.getID(), (item, []))
+                    if claim.getID() in [claim_.getID() for claim_ in claims]:
+                        print(' - already queued.')
+                    else:
+                        claims.append(claim)
+                        print(' - queued!')
+                    return
+                if self.edit(item.addClaim, claim):
+                    print(' - added!')
+            except pywikibot.exceptions.OtherPageSaveError as e:
                 print('ERROR... (%s) will ignore this claim this time...' % (e,))
         else:
             print(' - error, please check you are logged in!')
 
+    def save_claims(self):
+        # In batch mode, save the claims queued for each item with their sources, in a single edit per item.
+        for (qid, (item, claims)) in self.pending_claims.items():
+            props = [claim.getID() for claim in claims]
+            print('%s - saving %s' % (qid, ', '.join(props)), end='')
+            try:
+                if self.edit(item.editEntity, {'claims': [claim.toJSON() for claim in claims]}, summary='Add %s' % ', '.join(props)):
+                    print(' - added!')
+            except pywikibot.exceptions.OtherPageSaveError as e:
+                print(' - ERROR... (%s) will ignore these claims this time...' % (e,))
+            self.items.invalidate(qid)
+            self.items.invalidate(int(qid.replace('Q', '')))
+        self.pending_claims = {}
+
     def check_constraints(self, wikidata_id, constraints):
+        key = (int(format(wikidata_id).replace('Q', '')), tuple(constraints))
+        if key in self.constraint_decisions:
+            self.constraint_stats['decisions'] += 1
+            target = self.constraint_decisions[key]
+        else:
+            target = self.match_constraints(key[0], constraints)
+            self.constraint_decisions[key] = target
+        if not target:
+            return False
+        return pywikibot.ItemPage(self.wikidata, 'Q%s' % target) # not loaded, its claims are not needed to set a target
+
+    def match_constraints(self, wikidata_id, constraints):
+        # Returns the ID of the item (after redirects) if one of its natures is a subclass of the constraints.
+        # Without a precomputed closure, only the direct superclasses of the natures are checked.
+        entity = self.get_entity_classes(wikidata_id)
+        if not entity:
+            return False
+        (target, natures, superclasses) = entity
+        if not constraints:
+            return target
+        closure = self.get_closure(constraints)
+        if closure is not None:
+            return target if closure.intersection(natures) else False
+        for nature in natures:
+            if nature in constraints:
+                return target
+            nature_entity = self.get_entity_classes(nature)
+            if nature_entity and set(nature_entity[2]) & set(constraints):
+                return target
+        return False
+
+    def constraints_database(self):
+        if not self.constraints_db:
+            self.constraints_db = Database(self.constraints_path, 'fast')
+            self.constraints_db.cur.execute('CREATE TABLE IF NOT EXISTS entities (wikidata_id INT, target INT, P31, P279, checked, CONSTRAINT `unique_entity` UNIQUE(wikidata_id) ON CONFLICT REPLACE)')
+            self.constraints_db.cur.execute('CREATE TABLE IF NOT EXISTS closures (constraints, subclass INT, checked, CONSTRAINT `unique_subclass` UNIQUE(constraints, subclass) ON CONFLICT REPLACE)')
+            self.constraints_db.con.commit()
+        return self.constraints_db
+
+    def page_store_database(self):
+        if not self.page_store:
+            self.page_store = Database(self.page_store_path, 'fast')
+            self.page_store.cur.execute('CREATE TABLE IF NOT EXISTS pages (lang, title, target, revid INT, templates BLOB, checked, CONSTRAINT `unique_page` UNIQUE(lang, title) ON CONFLICT REPLACE)')
+            self.page_store.con.commit()
+        return self.page_store
+
+    def lookup_pages(self, site_id, pages):
+        # Pages already parsed by a collection: page['stored'] = (title after redirect, revid, templates).
+        # Those checked less than page_store_ttl days ago are 'fresh' and used as is, the others are used if their revision has not changed.
+        if not self.page_store_path:
+            return
+        db = self.page_store_database()
+        rows = {}
+        for titles in Collection.chunks([page['key'][1] for page in pages], 500):
+            db.cur.execute('SELECT title, target, revid, templates, julianday("now") - julianday(checked) FROM pages WHERE lang = ? AND title IN (%s)' % (','.join(['?'] * len(titles)),), [site_id] + titles)
+            rows.update({row[0]: row[1:] for row in db.cur.fetchall()})
+        for page in pages:
+            row = rows.get(page['key'][1])
+            if row is None:
+                continue
+            (target, revid, templates, age) = row
+            page['stored'] = (target, revid, pickle.loads(zlib.decompress(templates)))
+            if age < self.page_store_ttl:
+                page['fresh'] = True
+                page['page'] = pywikibot.Page(page['page'].site, target)
+                page['templates'] = page['stored'][2]
+                page['revid'] = revid
+                self.page_stats['reused'] += 1
+
+    def store_pages(self, site_id, pages):
+        # Templates of the pages fetched or checked again, the fresh ones keep their date.
+        if not self.page_store_path:
+            return
+        rows = []
+        for page in pages:
+            if page.get('revid') and 'templates' in page and not page.get('fresh'):
+                rows.append((site_id, page['key'][1], page['page'].title(), page['revid'], zlib.compress(pickle.dumps(page['templates'], pickle.HIGHEST_PROTOCOL))))
+        if rows:
+            db = self.page_store_database()
+            db.cur.executemany('INSERT INTO pages (lang, title, target, revid, templates, checked) VALUES (?, ?, ?, ?, ?, datetime("now"))', rows)
+            db.con.commit()
+
+    def save_snapshots(self, site_id, pages):
+        if not self.snapshots:
+            return
+        for page in pages:
+            if page.get('fetched'): # text loaded from the wiki
+                self.snapshots.add(site_id, page['key'][1], page['page'].title(), page['revid'], page['page'].text)
+        self.snapshots.commit()
+
+    def read_snapshots(self, site_id, pages):
+        # The pages which have a snapshot, with its text, without any request.
+        found = self.snapshots.read_latest(site_id, [page['key'][1] for page in pages])
+        result = []
+        for page in pages:
+            if page['key'][1] in found:
+                (target, revid, text) = found[page['key'][1]]
+                page['page'] = pywikibot.Page(page['page'].site, target)
+                page['page'].text = text
+                page['revid'] = revid
+                result.append(page)
+        return result
+
+    def get_revisions(self, site, titles):
+        # Last revision of up to 50 pages in a single request, without their text.
+        result = self.call(site, site.simple_request(action='query', prop='info', titles=titles).submit)
+        pages = result.get('query', {}).get('pages', {})
+        return {page['title']: page.get('lastrevid') for page in (pages.values() if isinstance(pages, dict) else pages)}
+
+    @staticmethod
+    def closure_key(constraints):
+        return ','.join([format(constraint) for constraint in sorted(constraints)])
+
+    def closure_is_recent(self, constraints):
+        db = self.constraints_database()
+        db.cur.execute('SELECT 1 FROM closures WHERE constraints = ? AND checked > datetime("NOW", ?) LIMIT 1', (PYWB.closure_key(constraints), '-%s days' % self.constraints_ttl))
+        return db.cur.fetchone() is not None
+
+    def get_closure(self, constraints):
+        # Subclasses (at any depth) of the constraints, None if they were never fetched. An outdated closure is still used.
+        key = PYWB.closure_key(constraints)
+        if key not in self.closures:
+            db = self.constraints_database()
+            db.cur.execute('SELECT subclass FROM closures WHERE constraints = ?', (key,))
+            classes = frozenset([row[0] for row in db.cur.fetchall()])
+            if not classes:
+                return None
+            self.closures[key] = classes
+        return self.closures[key]
+
+    def set_closure(self, constraints, classes):
+        key = PYWB.closure_key(constraints)
+        classes = frozenset(classes) | frozenset(constraints)
+        db = self.constraints_database()
+        db.cur.execute('DELETE FROM closures WHERE constraints = ?', (key,))
+        db.cur.executemany('INSERT INTO closures (constraints, subclass, checked) VALUES (?, ?, datetime("NOW"))', [(key, subclass) for subclass in classes])
+        db.con.commit()
+        self.closures[key] = classes
+        self.constraint_decisions = {} # they may have been taken with one level of subclasses only
+
+    def get_entity_classes(self, wikidata_id):
+        # (target, P31 values, P279 values) of an item, from the local database if checked recently, None if it does not exist.
+        db = self.constraints_database()
+        db.cur.execute('SELECT target, P31, P279 FROM entities WHERE wikidata_id = ? AND checked > datetime("NOW", ?)', (wikidata_id, '-%s days' % self.constraints_ttl))
+        row = db.cur.fetchone()
+        if row:
+            self.constraint_stats['cached'] += 1
+            return (row[0], json.loads(row[1]), json.loads(row[2])) if row[0] else None
+        self.constraint_stats['loaded'] += 1
         item = self.ItemPage(wikidata_id)
+        entity = None
         if item.exists():
             claims = item.claims or {}
-            if not constraints:
-                return item
-            if 'P31' in claims:
-                for claim in claims['P31']:
-                    nature = claim.getTarget()
-                    if nature:
-                        nature_id = nature.title().replace('Q', '')
-                        if int(nature_id) in constraints:
-                            return item
-                        if nature.exists():
-                            nature_claims = nature.claims or {}
-                            if 'P279' in nature_claims:
-                                for nature_claim in nature_claims['P279']:
-                                    subclass = nature_claim.getTarget()
-                                    if subclass:
-                                        subclass_id = subclass.title().replace('Q', '')
-                                        if int(subclass_id) in constraints:
-                                            return item
-        return False
+            classes = {}
+            for prop in ('P31', 'P279'):
+                classes[prop] = []
+                for claim in claims.get(prop, []):
+                    value = claim.getTarget()
+                    if value:
+                        classes[prop].append(int(value.title().replace('Q', '')))
+            entity = (int(item.title().replace('Q', '')), classes['P31'], classes['P279'])
+        db.cur.execute('INSERT INTO entities (wikidata_id, target, P31, P279, checked) VALUES (?, ?, ?, ?, datetime("NOW"))', (wikidata_id, entity[0] if entity else None, json.dumps(entity[1] if entity else []), json.dumps(entity[2] if entity else [])))
+        db.con.commit()
+        return entity
 
-    @staticmethod
-    def fetch_page_templates(page):
-        time.sleep(2) # avoid 429 errors
-        page['page'].templatesWithParams()
+    def rate_limiter(self, host, write = False):
+        key = ('write', host) if write else host
+        with self.lock:
+            if key not in self.rate_limiters:
+                self.rate_limiters[key] = RateLimiter(self.edit_rate, max_rate=self.max_edit_rate, concurrency=1, max_concurrency=1) if write else RateLimiter(self.rate)
+            return self.rate_limiters[key]
+
+    def backoff(self, attempt, retry_after = 0):
+        return max(retry_after, min(self.max_backoff_delay, self.backoff_delay * 2 ** attempt)) # never shorter than Retry-After
+
+    def call(self, site, function, *args, write = False, **kwargs):
+        # Every request to a wiki goes through its rate limiter; when the server asks to slow down, all the requests
+        # to that wiki pause and the request is retried with an exponential backoff, at most self.retries times.
+        if getattr(self.scheduled, 'active', False): # nested call, the outer one is limited and retried
+            return function(*args, **kwargs)
+        limiter = self.rate_limiter(site.hostname(), write)
+        if write and self.pace_edits and site.throttle.writedelay > 1 / self.max_edit_rate:
+            site.throttle.setDelays(writedelay=1 / self.max_edit_rate)
+        for attempt in range(self.retries):
+            limiter.acquire()
+            self.scheduled.active = True
+            delay = 0
+            failed = True
+            try:
+                result = function(*args, **kwargs)
+                delay = site.throttle.retry_after # set by pywikibot from the Retry-After header
+                failed = False
+                return result
+            except PYWB.transient_errors as e:
+                delay = self.backoff(attempt, site.throttle.retry_after)
+                if attempt + 1 == self.retries:
+                    raise
+                print('ERROR... (%s) will retry in %s seconds...' % (e, delay))
+            finally:
+                self.scheduled.active = False
+                limiter.release(delay, failed)
+
+    def edit(self, function, *args, **kwargs):
+        # Save through the scheduler; an edit still failing after the retries is queued for retry_failed_edits.
+        try:
+            self.call(self.wikidata, function, *args, write=True, **kwargs)
+            return True
+        except PYWB.transient_errors as e:
+            print(' - ERROR... (%s) edit queued for a later retry' % (e,))
+            self.failed_edits.append((function, args, kwargs))
+            return False
+
+    def retry_failed_edits(self):
+        edits = self.failed_edits
+        self.failed_edits = []
+        if edits:
+            print('Retrying %s failed edits...' % (len(edits),))
+        for (function, args, kwargs) in edits:
+            self.edit(function, *args, **kwargs)
+        if self.failed_edits:
+            print('%s edits failed again, they will be retried at the next call.' % (len(self.failed_edits),))
+
+    def page_worker(self, tasks, results, retries = 3):
+        # Fetch queued batches of pages within the limits of their wiki, until None is queued.
+        while True:
+            batch = tasks.get()
+            if batch is None:
+                return
+            site = batch[0]['page'].site
+            limiter = self.rate_limiter(site.hostname())
+            limiter.acquire()
+            self.scheduled.active = True # the requests of preload_pages are limited and retried here
+            delay = 0
+            error = None
+            try:
+                self.preload_pages(site, batch)
+                delay = site.throttle.retry_after # set by pywikibot from the Retry-After header
+            except PYWB.transient_errors as e:
+                delay = self.backoff(batch[0].get('attempts', 0), site.throttle.retry_after)
+                error = e
+            except Exception as e:
+                error = e
+            finally:
+                self.scheduled.active = False
+                limiter.release(delay, error is not None)
+            if error and delay and batch[0].get('attempts', 0) < retries:
+                batch[0]['attempts'] = batch[0].get('attempts', 0) + 1
+                tasks.put(batch)
+                continue
+            if error:
+                print('ERROR... (%s) %s pages not fetched, they will be harvested next time' % (error, len(batch)))
+            for page in batch:
+                if error:
+                    page['error'] = error # not loaded, its text must not be read
+                results.put(page)
+
+    def preload_pages(self, site, batch):
+        # Load the text of up to 50 pages in a single request, then the targets of the redirects in another one.
+        # Stored pages are checked first, their text is loaded only if they have a new revision.
+        stored = [page for page in batch if 'stored' in page and 'templates' not in page]
+        if stored:
+            revisions = self.get_revisions(site, [page['stored'][0] for page in stored])
+            for page in stored:
+                (title, revid, templates) = page['stored']
+                if revisions.get(title) == revid:
+                    page['page'] = pywikibot.Page(site, title)
+                    page['templates'] = templates
+                    page['revid'] = revid
+            with self.lock:
+                self.page_stats['checked'] += len([page for page in stored if 'templates' in page])
+        batch = [page for page in batch if 'templates' not in page]
+        if not batch:
+            return
+        for page in site.preloadpages([page['page'] for page in batch], groupsize=self.preload_size):
+            pass
+        redirects = []
+        for page in batch:
+            if not page['page'].exists():
+                page['missing'] = True
+            elif page['page'].isRedirectPage():
+                match = site.redirect_regex.match(page['page'].text)
+                if match:
+                    page['page'] = pywikibot.Page(site, match.group(1).strip())
+                    redirects.append(page)
+        if redirects:
+            for page in site.preloadpages([page['page'] for page in redirects], groupsize=self.preload_size):
+                pass
+            for page in redirects:
+                if not page['page'].exists() or page['page'].isRedirectPage(): # no double redirects
+                    page['missing'] = True
+        for page in batch:
+            if not page.get('missing'):
+                page['revid'] = page['page'].latest_revision_id
+                page['fetched'] = True
+            if 'key' in page:
+                self.pages.resize(page['key']) # the text is loaded now
+        with self.lock:
+            self.page_stats['fetched'] += len(batch)
+
+    def get_wikibase_items(self, site, titles):
+        # Wikidata IDs of up to 50 pages in a single request, following normalizations and redirects.
+        result = self.call(site, site.simple_request(action='query', prop='pageprops', ppprop='wikibase_item', redirects=True, titles=titles).submit)
+        query = result.get('query', {})
+        targets = {}
+        for mapping in query.get('normalized', []) + query.get('redirects', []):
+            targets[mapping['from']] = mapping['to']
+        pages = query.get('pages', {})
+        items = {}
+        for page in (pages.values() if isinstance(pages, dict) else pages):
+            items[page['title']] = page.get('pageprops', {}).get('wikibase_item')
+        found = {}
+        for title in titles:
+            target = title
+            for hop in range(5):
+                if target in items or target not in targets:
+                    break
+                target = targets[target]
+            found[title] = items.get(target)
+        return found
 
     def get_claim_value(self, prop, item):
         claims = item.claims if item.claims else {}
@@ -1056,6 +2726,12 @@ class PYWB:
             elif self.managed_properties[prop]['type'] == 'coordinates':
                 target = claims[pprop][0].getTarget()
                 return '%f|%f|%f' % (float(target.lat), float(target.lon), float(target.alt if target.alt else 0)) if target else None
+            elif self.managed_properties[prop]['type'] == 'date': # same format as SPARQL
+                target = claims[pprop][0].getTarget()
+                return '%s%04d-%02d-%02dT00:00:00Z' % ('-' if target.year < 0 else '', abs(target.year), target.month or 1, target.day or 1) if target else None
+            elif self.managed_properties[prop]['type'] == 'integer':
+                target = claims[pprop][0].getTarget()
+                return '%s' % (target.amount,) if target else None
         return None
 
     def write_prop(self, prop, wikidata_id, value, source = None): # FIXME check ItemPage existence here and pass it to subfunctions
@@ -1083,8 +2759,8 @@ class PYWB:
             self.write_prop_8389(wikidata_id, value, source)
         else:
             print('Writing prop %s is not implemented yet! Patches are welcome!' % prop)
-        if wikidata_id in self.items:
-            del self.items[wikidata_id] # invalidate cache
+        if not self.batch_claims:
+            self.items.invalidate(wikidata_id) # in batch mode, the item is reused until its claims are saved
         return True
 
     def write_prop_item(self, prop, wikidata_id, value, source = None):
@@ -1123,16 +2799,16 @@ class PYWB:
                 summaries = []
                 summaries.append('Add description for ' + '/'.join(add_lang) if len(add_lang) > 0 else '')
                 summaries.append('Fix description for ' + '/'.join(fix_lang) if len(fix_lang) > 0 else '')
-                item.editDescriptions(description_, summary = '. '.join(summaries))
+                self.edit(item.editDescriptions, description_, summary = '. '.join(summaries))
 
     def write_label(self, wikidata_id, lang, label, overwrite = False):
         item = self.ItemPage(wikidata_id)
         if item.exists():
             try:
                 if lang not in item.labels.keys():
-                    item.editLabels({lang: label}, summary = 'Add %s label.' % lang)
+                    self.edit(item.editLabels, {lang: label}, summary = 'Add %s label.' % lang)
                 elif overwrite and item.labels[lang] != label:
-                    item.editLabels({lang: label}, summary = 'Fix %s label.' % lang)
+                    self.edit(item.editLabels, {lang: label}, summary = 'Fix %s label.' % lang)
             except pywikibot.exceptions.OtherPageSaveError as e:
                 print('Label edit failed with:', e)
 
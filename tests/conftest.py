@@ -0,0 +1,288 @@
+import io
+import json
+import os
+import re
+import sys
+import tempfile
+
+os.environ.setdefault('PYWIKIBOT_NO_USER_CONFIG', '2')
+os.environ.setdefault('PYWIKIBOT_DIR', tempfile.mkdtemp(prefix='pywikibot-'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import pywdcollections as PYWDC
+
+
+class FakePYWB:
+    # Stand-in for PYWB in tests which do not talk to Wikidata.
+    user = 'Test'
+    preload_size = 50
+
+    def backoff(self, attempt, retry_after = 0):
+        return 0
+
+
+class FakeResponse(io.BytesIO):
+    # HTTP response which breaks after `fail_after` bytes when asked to.
+    def __init__(self, data, fail_after = None, error = ConnectionResetError):
+        super().__init__(data)
+        self.fail_after = fail_after
+        self.error = error
+
+    def read(self, size = -1):
+        if self.fail_after is not None and self.tell() >= self.fail_after:
+            raise self.error('connection lost')
+        if self.fail_after is not None:
+            size = min(size if size > 0 else self.fail_after, self.fail_after - self.tell())
+        return super().read(size)
+
+
+class FakeSPARQL:
+    # Replaces SPARQLWrapper: each query takes the next response (or raises the next exception) of the list.
+    def __init__(self, responses, queries):
+        self.responses = responses
+        self.queries = queries
+
+    def query(self):
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        self.response = response
+        return self
+
+    def convert(self):
+        return json.loads(self.response.read())
+
+
+def sparql_json(bindings):
+    # SPARQL JSON results for compact bindings, URIs for the entity values.
+    rows = []
+    for binding in bindings:
+        rows.append({key: {'type': 'uri' if value.startswith('http') else 'literal', 'value': value} for (key, value) in binding.items()})
+    return json.dumps({'head': {'vars': []}, 'results': {'bindings': rows}}).encode('utf-8')
+
+
+@pytest.fixture
+def collection(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    class Museums(PYWDC.Collection):
+        def __init__(self, pywb):
+            self.db = PYWDC.Database(':memory:')
+            self.name = 'museums'
+            self.main_type = 33506
+            self.properties = [17, 131, 625]
+            self.languages = ['fr']
+            self.templates = {'frwiki': {'Infobox Musée': {'pays': 17, 'commune': 131}}}
+            self.cache = PYWDC.Cache(str(tmp_path / 'cache'))
+            super().__init__(pywb)
+
+    return Museums(FakePYWB())
+
+
+class FakeEndpoint:
+    # Replaces Collection.sparql: add responses (FakeResponse or exceptions) in order, the queries sent are kept.
+    def __init__(self):
+        self.responses = []
+        self.queries = []
+
+    def __call__(self, query):
+        self.queries.append(query)
+        return FakeSPARQL(self.responses, self.queries)
+
+
+@pytest.fixture
+def sparql(collection, monkeypatch):
+    endpoint = FakeEndpoint()
+    monkeypatch.setattr(collection, 'sparql', endpoint)
+    return endpoint
+
+
+class FakeThrottle:
+    retry_after = 0
+    writedelay = 10 # config.put_throttle
+
+    def setDelays(self, delay = None, writedelay = None):
+        self.writedelay = writedelay or FakeThrottle.writedelay
+
+
+class FakeRequest:
+    def __init__(self, site, params):
+        self.site = site
+        self.params = params
+
+    def submit(self):
+        self.site.requests.append(self.params)
+        return self.site.api(self.params)
+
+
+class FakeSite:
+    # Stand-in wiki: pages maps titles to their text (None for missing pages), every request is kept in requests.
+    redirect_regex = re.compile(r'\s*#REDIRECT\s*\[\[(.+?)(?:\|.*?)?\]\]', re.IGNORECASE)
+
+    def __init__(self, code = 'fr', pages = None):
+        self.code = code
+        self.lang = code
+        self.items = {} # title -> QID of the page, for pageprops
+        self.pages = pages if pages is not None else {}
+        self.revisions = {}
+        self.entities = {} # QID -> entity data, for wbgetentities
+        self.redirects = {} # QID -> QID
+        self.requests = []
+        self.throttle = FakeThrottle()
+
+    def hostname(self):
+        return '%s.wikipedia.test' % (self.code,)
+
+    def image_repository(self):
+        return self
+
+    def data_repository(self):
+        return self
+
+    def preloadpages(self, pages, groupsize = 50):
+        pages = list(pages)
+        for start in range(0, len(pages), groupsize):
+            group = pages[start:start + groupsize]
+            self.requests.append({'action': 'query', 'titles': [page.title() for page in group]})
+            for page in group:
+                page.load()
+                yield page
+
+    def simple_request(self, **params):
+        return FakeRequest(self, params)
+
+    def api(self, params):
+        if params.get('prop') == 'info':
+            return {'query': {'pages': {title: {'title': title, 'lastrevid': self.revisions.get(title, 1)} for title in params['titles'] if self.pages.get(title) is not None}}}
+        if params.get('prop') == 'pageprops':
+            query = {'redirects': [], 'pages': {}}
+            for title in params['titles']:
+                target = self.pages.get(title)
+                match = self.redirect_regex.match(target or '')
+                if match:
+                    query['redirects'].append({'from': title, 'to': match.group(1)})
+                    title = match.group(1)
+                if self.pages.get(title) is not None:
+                    query['pages'][title] = {'title': title, 'pageprops': {'wikibase_item': self.items[title]} if title in self.items else {}}
+            return {'query': query}
+        if params.get('action') == 'wbgetentities':
+            assert len(params['ids']) <= 50
+            return {'entities': dict(self.entity(qid) for qid in params['ids'])}
+        raise NotImplementedError(params)
+
+    def entity(self, qid):
+        # (key, data) as wbgetentities returns them: redirects under their target.
+        target = self.redirects.get(qid, qid)
+        if target not in self.entities:
+            return (qid, {'id': qid, 'missing': ''})
+        data = dict(self.entities[target], id=target, type='item')
+        if target != qid:
+            data['redirects'] = {'from': qid, 'to': target}
+        return (target, data)
+
+
+class FakePage:
+    def __init__(self, site, title, ns = 0):
+        self.site = site
+        self._title = title
+        self._revisions = {}
+
+    def title(self, with_ns = True):
+        return self._title
+
+    def load(self):
+        self.text = self.site.pages.get(self._title)
+        self.latest_revision_id = self.site.revisions.get(self._title, 1)
+
+    def exists(self):
+        return self.site.pages.get(self._title) is not None
+
+    def isRedirectPage(self):
+        return self.exists() and self.site.redirect_regex.match(self.site.pages[self._title]) is not None
+
+    def backlinks(self, **kwargs):
+        self.site.requests.append({'action': 'query', 'list': 'backlinks', 'bltitle': self._title})
+        return iter([])
+
+
+class FakeClaim:
+    def __init__(self, target):
+        self.target = target
+
+    def getTarget(self):
+        return self.target
+
+
+def claims(**values):
+    # Item claims as FakeItemPage.claims gives them: claims(P31=[5]) for the value Q5 of P31.
+    return {prop: [FakeClaim(FakeItemPage(None, 'Q%s' % (value,))) for value in targets] for (prop, targets) in values.items()}
+
+
+class FakeItemPage:
+    # Loads its entity with a request unless _content is set, like pywikibot.ItemPage.
+    def __init__(self, site, title):
+        self.site = site
+        self.id = title
+
+    def title(self):
+        return self.id
+
+    def get(self):
+        if not hasattr(self, '_content'):
+            self.site.requests.append({'action': 'wbgetentities', 'ids': [self.id]})
+            self._content = self.site.entity(self.id)[1]
+        self.claims = self._content.get('claims', {})
+        return self._content
+
+    def exists(self):
+        if not hasattr(self, '_content'):
+            self.get()
+        return 'missing' not in self._content
+
+    def isRedirectPage(self):
+        return 'redirects' in self.get()
+
+    def getRedirectTarget(self):
+        return FakeItemPage(self.site, self.get()['id'])
+
+
+@pytest.fixture
+def wiki(tmp_path, monkeypatch):
+    # PYWB connected to a FakeSite instead of the real wikis.
+    monkeypatch.chdir(tmp_path)
+    site = FakeSite()
+    monkeypatch.setattr(PYWDC.pywikibot, 'Site', lambda *args, **kwargs: site)
+    monkeypatch.setattr(PYWDC.pywikibot, 'Page', FakePage)
+    monkeypatch.setattr(PYWDC.pywikibot, 'ItemPage', FakeItemPage)
+    pywb = PYWDC.PYWB('Test', 'fr')
+    return (pywb, site)
+
+
+@pytest.fixture
+def museums(wiki, tmp_path):
+    # Offline collection of 120 museums whose pages are in the snapshots.
+    (pywb, site) = wiki
+
+    class Museums(PYWDC.Collection):
+        def __init__(self, pywb):
+            self.db = PYWDC.Database(':memory:')
+            self.name = 'museums'
+            self.main_type = 33506
+            self.properties = [373, 625]
+            self.languages = ['fr']
+            self.templates = {'frwiki': {'Infobox Musée': {'coordonnées': 625}, 'Commonscat': 373}}
+            self.cache = PYWDC.Cache(str(tmp_path / 'cache'))
+            self.offline = True
+            super().__init__(pywb)
+
+    pywb.snapshots = PYWDC.SnapshotStore(str(tmp_path / 'snapshots'))
+    collection = Museums(pywb)
+    for n in range(1, 121):
+        title = 'Musée %s' % (n,)
+        collection.db.cur.execute('INSERT INTO museums (wikidata_id) VALUES (?)', (n,))
+        collection.db.cur.execute('INSERT INTO interwiki (wikidata_id, lang, title) VALUES (?, ?, ?)', (n, 'frwiki', title))
+        pywb.snapshots.add('frwiki', title, title, n, '{{Infobox Musée|coordonnées=48/2}} text {{Commonscat|Musée numéro %s}}' % (n,))
+    pywb.snapshots.commit()
+    collection.db.con.commit()
+    return collection
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+import pywdcollections as PYWDC
+from conftest import FakeResponse, sparql_json
+
+BINDINGS = [{'museums': 'http://www.wikidata.org/entity/Q%s' % (i,), 'modified': '2026-01-01T00:00:00Z'} for i in range(1, 5001)]
+
+
+def cut(path, fraction):
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as f:
+        f.truncate(int(size * fraction))
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'lzma', None])
+def test_complete_entry_is_read(tmp_path, compression):
+    cache = PYWDC.Cache(str(tmp_path), compression)
+    cache.write('key', BINDINGS)
+    assert list(cache.read('key')) == BINDINGS
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'lzma', None])
+def test_truncated_entry_is_a_miss(tmp_path, compression):
+    cache = PYWDC.Cache(str(tmp_path), compression)
+    cache.write('key', BINDINGS)
+    cut(cache.path('key'), 0.5)
+    read = []
+    with pytest.raises(EOFError):
+        for binding in cache.read('key'):
+            read.append(binding)
+    assert len(read) < len(BINDINGS)
+    assert not os.path.exists(cache.path('key'))
+    assert not cache.is_recent('key', 1)
+
+
+def test_fetch_downloads_a_truncated_entry_again(collection, sparql):
+    collection.skip_if_recent = False
+    data = sparql_json(BINDINGS)
+    sparql.responses.extend([FakeResponse(data), FakeResponse(data)])
+    assert collection.fetch_query()
+    cut(collection.cache.path(collection.cache_key(sparql.queries[0])), 0.4)
+    assert collection.fetch_query()
+    assert len(sparql.queries) == 2
+    collection.db.cur.execute('SELECT COUNT(*) FROM museums')
+    assert collection.db.cur.fetchone()[0] == len(BINDINGS)
+    assert len(list(collection.cache.read(collection.cache_key(sparql.queries[0])))) == len(BINDINGS)
+
+
+def test_files_of_the_previous_format_are_evicted(tmp_path):
+    legacy = tmp_path / 'museums_mul-fr_0123456789abcdef0123456789abcdef'
+    legacy.write_bytes(b'{"results": {"bindings": []}}' + b' ' * 10000)
+    os.utime(legacy, (1, 1))
+    cache = PYWDC.Cache(str(tmp_path), max_size=5000)
+    cache.write('key', BINDINGS[:10])
+    assert not legacy.exists()
+    assert os.path.exists(cache.path('key'))
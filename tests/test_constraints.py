@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+import pywdcollections as PYWDC
+from conftest import FakeEndpoint, FakeResponse, claims, sparql_json
+
+COUNTRY = [3624078, 6256] # constraints of P17
+
+
+@pytest.fixture
+def countries(museums, monkeypatch):
+    # Collection harvesting P17, whose constraints are checked against the closure of their subclasses.
+    museums.properties = [17]
+    museums.pywb.backoff_delay = 0.01
+    endpoint = FakeEndpoint()
+    monkeypatch.setattr(museums, 'sparql', endpoint)
+    return (museums, endpoint)
+
+
+def subclasses(*ids):
+    return sparql_json([{'class': 'http://www.wikidata.org/entity/Q%s' % (i,)} for i in ids])
+
+
+def test_closure_is_fetched_through_the_retry_loop(countries, tmp_path):
+    (museums, endpoint) = countries
+    data = subclasses(3624078, 6256, 7275)
+    endpoint.responses.extend([FakeResponse(data, fail_after=20), FakeResponse(data)])
+    museums.fetch_closures()
+    assert len(endpoint.queries) == 2
+    assert museums.pywb.get_closure(COUNTRY) == frozenset([3624078, 6256, 7275])
+    assert os.listdir(str(tmp_path / 'cache')) == []
+    museums.fetch_closures() # recent enough
+    assert len(endpoint.queries) == 2
+
+
+def test_failed_closure_keeps_the_previous_one(countries):
+    (museums, endpoint) = countries
+    museums.pywb.set_closure(COUNTRY, [7275])
+    museums.pywb.constraints_db.cur.execute('UPDATE closures SET checked = datetime("NOW", "-60 days")')
+    museums.retries = 2
+    endpoint.responses.extend([ConnectionResetError('connection lost'), TimeoutError('timed out')])
+    museums.fetch_closures()
+    assert len(endpoint.queries) == 2
+    assert museums.pywb.get_closure(COUNTRY) == frozenset([3624078, 6256, 7275])
+
+
+def test_natures_and_superclasses_are_kept_between_runs(wiki):
+    (pywb, site) = wiki
+    site.entities.update({'Q10': {'claims': claims(P31=[20])}, 'Q20': {'claims': claims(P279=[6256])}, 'Q30': {'claims': claims(P31=[5])}, 'Q5': {}})
+    assert pywb.check_constraints(10, COUNTRY).title() == 'Q10'
+    assert pywb.check_constraints(30, COUNTRY) is False
+    requests = len(site.requests)
+    assert pywb.check_constraints(10, COUNTRY).title() == 'Q10' # decision reused
+    assert pywb.constraint_stats['decisions'] == 1
+    other = PYWDC.PYWB('Test', 'fr') # next run, same constraints.db
+    assert other.check_constraints(10, COUNTRY).title() == 'Q10'
+    assert other.check_constraints(30, COUNTRY) is False
+    assert len(site.requests) == requests
+    assert other.constraint_stats['cached'] == 4 and other.constraint_stats['loaded'] == 0
+
+
+def test_redirects_missing_and_outdated_items(wiki):
+    (pywb, site) = wiki
+    site.entities.update({'Q11': {'claims': claims(P31=[6256])}})
+    site.redirects['Q10'] = 'Q11'
+    assert pywb.check_constraints(10, COUNTRY).title() == 'Q11'
+    assert pywb.check_constraints(99, COUNTRY) is False # missing
+    pywb.constraints_db.cur.execute('SELECT wikidata_id, target FROM entities ORDER BY wikidata_id')
+    assert pywb.constraints_db.cur.fetchall() == [(10, 11), (99, None)]
+    pywb.constraints_db.cur.execute('UPDATE entities SET checked = datetime("NOW", "-60 days")')
+    pywb.constraints_db.con.commit()
+    site.entities['Q99'] = {'claims': claims(P31=[3624078])} # created since
+    other = PYWDC.PYWB('Test', 'fr')
+    assert other.check_constraints(99, COUNTRY).title() == 'Q99'
+    assert other.constraint_stats['loaded'] == 1
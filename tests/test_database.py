@@ -0,0 +1,70 @@
+import sqlite3
+import threading
+
+import pytest
+
+import pywdcollections as PYWDC
+
+
+def pragma(con, name):
+    return con.execute('PRAGMA %s' % (name,)).fetchone()[0]
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = PYWDC.Database(str(tmp_path / 'test.db'), 'fast')
+    db.cur.execute('CREATE TABLE items (wikidata_id INTEGER PRIMARY KEY, label)')
+    db.cur.executemany('INSERT INTO items VALUES (?, ?)', [(1, 'a'), (2, 'b')])
+    db.con.commit()
+    yield db
+    db.close()
+
+
+def in_thread(function):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(function()))
+    thread.start()
+    thread.join(10)
+    return result[0]
+
+
+@pytest.mark.parametrize('profile, journal_mode, synchronous', [('default', 'delete', 2), ('fast', 'wal', 1), ('bulk', 'wal', 0), ({'synchronous': 'OFF'}, 'delete', 0)])
+def test_profiles(tmp_path, profile, journal_mode, synchronous):
+    db = PYWDC.Database(str(tmp_path / 'test.db'), profile)
+    assert (pragma(db.con, 'journal_mode'), pragma(db.con, 'synchronous')) == (journal_mode, synchronous)
+    reader = db.reader().connection
+    assert (pragma(reader, 'synchronous'), pragma(reader, 'query_only')) == (synchronous, 1)
+    db.close()
+
+
+def test_readers_are_read_only_and_per_thread(db):
+    assert db.read('SELECT label FROM items ORDER BY wikidata_id') == [('a',), ('b',)]
+    with pytest.raises(sqlite3.OperationalError):
+        db.reader().execute('DELETE FROM items')
+    assert db.reader().connection is db.reader().connection
+    other = in_thread(lambda: db.reader().connection)
+    assert other is not db.reader().connection
+    assert len(db.readers) == 2
+
+
+def test_readers_do_not_wait_for_the_writer(db):
+    db.cur.execute('UPDATE items SET label = ? WHERE wikidata_id = 1', ('c',)) # not committed yet
+    assert in_thread(lambda: db.read('SELECT label FROM items WHERE wikidata_id = 1')) == [('a',)]
+    db.con.commit()
+    assert in_thread(lambda: db.read('SELECT label FROM items WHERE wikidata_id = 1')) == [('c',)]
+
+
+def test_close_closes_the_readers(db):
+    reader = in_thread(lambda: db.reader().connection)
+    db.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        reader.execute('SELECT 1')
+    db.con = db.connect() # for the fixture teardown
+
+
+def test_memory_database_reads_with_the_writer():
+    db = PYWDC.Database(':memory:')
+    db.cur.execute('CREATE TABLE items (wikidata_id INTEGER PRIMARY KEY)')
+    db.cur.execute('INSERT INTO items VALUES (1)')
+    assert db.reader().connection is db.con
+    assert db.read('SELECT wikidata_id FROM items') == [(1,)]
@@ -0,0 +1,97 @@
+import random
+import re
+
+import pytest
+from pywikibot import textlib
+
+from pywdcollections import Collection
+
+TITLE = 'Musée des Beaux-Arts'
+
+
+def reference(text, title):
+    # What harvesting got from pywikibot: templatesWithParams() numbering, positional values stripped too,
+    # with {{PAGENAME}} replaced beforehand.
+    text = re.sub(r'\{\{\s*PAGENAME\s*\}\}', title, text)
+    result = []
+    for (name, args) in textlib.extract_templates_and_params(text, True, True):
+        numbered = {}
+        named = {}
+        for (key, value) in args.items():
+            if key.isdigit():
+                numbered[int(key)] = value
+            else:
+                named[key] = value
+        positional = []
+        while len(positional) + 1 in numbered:
+            positional.append(numbered.pop(len(positional) + 1).strip())
+        named.update({format(key): value for (key, value) in numbered.items()})
+        result.append((name, positional, named))
+    return result
+
+
+CASES = [
+    # nested templates and links
+    '{{Infobox musée|nom=Louvre|image=[[Fichier:a.jpg|thumb|alt=x]]|commune=[[Paris|Ville]], {{drapeau|France}}|coord={{coord|48|51|N|2|21|E|display=title}}}}',
+    '{{a|{{b|{{c|d}}}}}}',
+    '{{a|b={{c|d}}}} {{e}}',
+    '{{Navbox|list={{hlist|[[a]]|[[b]]}}}}',
+    'Text {{Commonscat}} {{Commonscat|Foo bar|display}} {{#if:{{{1|}}}|yes|no}} {{DEFAULTSORT:X}}',
+    '{{ Infobox_person |x=1}}',
+    # numbered parameters
+    '{{a| foo | 2 = bar | baz }}',
+    '{{a|1=x|y|z}}',
+    '{{a|x|1=y}}',
+    '{{a|1=x|1=y}}',
+    '{{a|2=x|y}}',
+    '{{a|3=z|x}}',
+    '{{a|url=http://example.org/?a=b&c=d|title=Q=R}}',
+    '{{a|b=}}}',
+    # disabled parts
+    '{{a|<!-- comment | with = pipe -->x=1|y=<nowiki>{{b}}|c</nowiki>}}',
+    '{{a|<nowiki>}}</nowiki>|b}}',
+    '{{a|<!--}}-->b}}',
+    '{{a|<pre>|</pre>x}}',
+    '{{a|<!-- unclosed',
+    # unclosed links
+    '{{a|[[b|c}}',
+    '{{a|b=[[c}} {{d|e}}',
+    '{{a|x=[[b|c]]|[[d}}',
+    '{{a|[[b|x=c|d}}',
+    '[[unclosed {{a|b}}',
+    '{{a|[[b|x}} c]] d}}',
+    '{{a|[[b|}}{{c|]]',
+    '{{a|[[b\n|c}}',
+    '{{a|[[]=]]}}',
+    # invalid names
+    '{{{d}}',
+    '{{a|{{}}',
+    '{{a|{{|b}}',
+    '{{a}b|c}}',
+    '{{a\nb|c}}',
+    '{{a{{b}}|c}}',
+    # magic word
+    '{{a|{{PAGENAME}}|t={{ PAGENAME }}}}',
+    '{{Infobox\n| name = {{PAGENAME}}\n| image = \n| caption = A [[b|c]] d\n}}',
+]
+
+
+def generated(count):
+    random.seed(3)
+    words = ['foo', 'bar', '[[link]]', '[[a|b]]', '[[open|x', 'y]]', '{{x|y}}', '{{y|k=v}}', 'k=v', '1=v', '<!-- c -->', '<nowiki>|</nowiki>', '[[File:z.png|thumb|left]]', "''it''", '{{{p|d}}}', '{{PAGENAME}}']
+    for n in range(count):
+        parts = []
+        for t in range(random.randint(1, 4)):
+            params = '|'.join((random.choice(['', 'k%s = ' % (i,), '%s=' % (i,)]) + ' '.join(random.choice(words) for w in range(random.randint(0, 3)))) for i in range(random.randint(0, 6)))
+            parts.append('{{T%s|%s}} text %s' % (t, params, random.choice(words)))
+        yield '\n'.join(parts)
+
+
+@pytest.mark.parametrize('text', CASES)
+def test_same_templates_as_pywikibot(text):
+    assert Collection.extract_templates(text, TITLE) == reference(text, TITLE)
+
+
+def test_same_templates_as_pywikibot_on_generated_pages():
+    different = [text for text in generated(2000) if Collection.extract_templates(text, TITLE) != reference(text, TITLE)]
+    assert different == []
@@ -0,0 +1,116 @@
+import email.message
+import os
+import sqlite3
+import urllib.error
+
+from conftest import FakeResponse, sparql_json
+
+
+def museum(wikidata_id, country = 142):
+    return {
+        'museums': 'http://www.wikidata.org/entity/Q%s' % (wikidata_id,),
+        'P17': 'http://www.wikidata.org/entity/Q%s' % (country,),
+        'modified': '2026-01-01T00:00:00Z',
+    }
+
+
+def stored(collection):
+    collection.db.cur.execute('SELECT wikidata_id, P17 FROM museums ORDER BY wikidata_id')
+    return collection.db.cur.fetchall()
+
+
+def test_stream_is_retried_after_connection_reset(collection, sparql):
+    data = sparql_json([museum(i) for i in range(1, 101)])
+    sparql.responses.extend([FakeResponse(data, fail_after=len(data) // 2), FakeResponse(data)])
+    collection.streaming = True
+    assert collection.fetch_query()
+    assert len(sparql.queries) == 2
+    assert len(stored(collection)) == 100
+    assert len(list(collection.cache.read(collection.cache_key(sparql.queries[0])))) == 100
+
+
+def test_stream_is_retried_after_timeout(collection, sparql):
+    data = sparql_json([museum(1)])
+    sparql.responses.extend([FakeResponse(data, fail_after=10, error=TimeoutError), FakeResponse(data)])
+    collection.streaming = True
+    assert collection.fetch_query()
+    assert stored(collection) == [(1, 'Q142')]
+
+
+def http_error(code, retry_after = None):
+    headers = email.message.Message()
+    if retry_after is not None:
+        headers['Retry-After'] = str(retry_after)
+    return urllib.error.HTTPError('https://query.wikidata.org/', code, 'error', headers, None)
+
+
+def test_query_is_retried_after_server_error(collection, sparql):
+    sparql.responses.extend([http_error(503), FakeResponse(sparql_json([museum(1), museum(2, 183)]))])
+    assert collection.fetch_query()
+    assert stored(collection) == [(1, 'Q142'), (2, 'Q183')]
+
+
+def test_query_gives_up_after_retries(collection, sparql):
+    collection.retries = 2
+    sparql.responses.extend([http_error(429), http_error(429)])
+    assert not collection.fetch_query()
+    assert stored(collection) == []
+
+
+def test_subclass_shards_are_retried(collection, sparql):
+    collection.shards = 'subclasses'
+    subclasses = [{'subclass': 'http://www.wikidata.org/entity/Q%s' % (i,)} for i in (3, 2)]
+    sparql.responses.extend([http_error(429), FakeResponse(sparql_json(subclasses))])
+    shards = collection.list_shards()
+    assert [condition for (condition, filters) in shards] == [' wdt:P31 wd:Q33506 ', ' (wdt:P31/wdt:P279*) wd:Q2 ', ' (wdt:P31/wdt:P279*) wd:Q3 ']
+
+
+def test_failed_subclass_listing_does_not_crash_fetch(collection, sparql):
+    collection.shards = 'subclasses'
+    collection.retries = 1
+    sparql.responses.extend([http_error(502), http_error(502)])
+    assert collection.list_shards() == []
+    assert not collection.fetch_shards()
+
+
+def test_large_batches_stay_within_the_sqlite_parameter_limit(collection):
+    collection.db.con.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999) # before SQLite 3.32
+    collection.batch_size = 1200
+    collection.save_bindings([museum(i) for i in range(1, 1201)])
+    collection.save_bindings([museum(i, 183) for i in range(1, 1201)])
+    assert len(stored(collection)) == 1200
+
+
+def test_evicted_slice_is_downloaded_again(collection, sparql, monkeypatch):
+    collection.shards = 'digits'
+    sparql.responses.extend([FakeResponse(sparql_json([museum(1)])) for i in range(11)])
+    read = collection.cache.read
+    evicted = []
+
+    def evict(key):
+        if not evicted:
+            evicted.append(key)
+            raise FileNotFoundError(key)
+        return read(key)
+
+    monkeypatch.setattr(collection.cache, 'read', evict)
+    assert collection.fetch_shards()
+    assert len(sparql.queries) == 11
+    assert collection.cache_key(sparql.queries[-1]) == evicted[0]
+    assert stored(collection) == [(1, 'Q142')]
+
+
+def test_failed_slice_does_not_stop_the_others(collection, sparql):
+    collection.shards = 'digits'
+    (collection.workers, collection.retries) = (1, 1)
+    sparql.responses.extend([ValueError('bad query')] + [FakeResponse(sparql_json([museum(i)])) for i in range(2, 11)])
+    assert not collection.fetch_shards()
+    assert len(stored(collection)) == 9
+
+
+def test_removed_items_are_deleted_and_the_id_query_is_not_kept(collection, sparql, tmp_path):
+    collection.save_bindings([museum(i) for i in range(1, 4)])
+    sparql.responses.append(FakeResponse(sparql_json([{'museums': 'http://www.wikidata.org/entity/Q%s' % (i,)} for i in (1, 3)])))
+    collection.remove_deleted_items()
+    assert stored(collection) == [(1, 'Q142'), (3, 'Q142')]
+    assert os.listdir(str(tmp_path / 'cache')) == []
@@ -0,0 +1,26 @@
+import pytest
+
+import pywdcollections as PYWDC
+
+
+@pytest.mark.parametrize('processes', [0, 2])
+def test_harvest_saves_every_group(museums, processes):
+    museums.processes = processes
+    assert museums.harvest_templates() == 120
+    museums.db.cur.execute('SELECT COUNT(*), COUNT(P373), COUNT(P625) FROM harvested WHERE source = "frwiki"')
+    assert museums.db.cur.fetchone() == (120, 120, 120)
+    museums.db.cur.execute('SELECT P373 FROM harvested WHERE wikidata_id = 42')
+    assert museums.db.cur.fetchone() == ('Musée numéro 42',)
+    museums.db.cur.execute('SELECT COUNT(*) FROM interwiki WHERE last_harvested IS NULL')
+    assert museums.db.cur.fetchone() == (0,)
+
+
+def test_parse_pages_in_a_pool(museums):
+    pages = [{'page': PYWDC.pywikibot.Page(None, 'Musée %s' % (n,)), 'wikidata_id': n} for n in range(3)]
+    for page in pages:
+        page['page'].text = '{{Commonscat|Musée %s}}' % (page['wikidata_id'],)
+    expected = museums.parse_pages('frwiki', pages).result()
+    with PYWDC.concurrent.futures.ProcessPoolExecutor(1) as pool:
+        future = museums.parse_pages('frwiki', pages, pool)
+        assert future.result() == expected
+    assert [result[0] for (result, templates) in expected] == [[(n, 373, 'Musée %s' % (n,), 'frwiki')] for n in range(3)]
@@ -0,0 +1,52 @@
+import pytest
+
+
+@pytest.fixture
+def links(museums):
+    museums.offline = False
+    site = museums.pywb.site
+    for n in range(120):
+        site.pages['Ville %s' % (n,)] = 'text'
+        site.items['Ville %s' % (n,)] = 'Q%s' % (1000 + n,)
+    site.pages.update({'Paname': '#REDIRECT [[Ville 1]]', 'Sans élément': 'text'})
+    return (museums, site)
+
+
+def stored(museums):
+    museums.db.cur.execute('SELECT title, wikidata_id FROM links ORDER BY title')
+    return dict(museums.db.cur.fetchall())
+
+
+def test_links_are_resolved_50_titles_per_request(links):
+    (museums, site) = links
+    titles = ['Ville %s' % (n,) for n in range(120)]
+    found = museums.resolve_links(site, titles + titles[:10])
+    assert found == {'Ville %s' % (n,): 'Q%s' % (1000 + n,) for n in range(120)}
+    assert [len(request['titles']) for request in site.requests] == [50, 50, 20]
+    assert len(stored(museums)) == 120
+
+
+def test_redirects_and_pages_without_item(links):
+    (museums, site) = links
+    found = museums.resolve_links(site, ['Paname', 'Sans élément', 'Inconnue'])
+    assert found == {'Paname': 'Q1001', 'Sans élément': None, 'Inconnue': None}
+    assert stored(museums) == found
+
+
+def test_links_are_kept_for_harvest_frequency_days(links):
+    (museums, site) = links
+    museums.resolve_links(site, ['Ville 1', 'Sans élément'])
+    assert museums.resolve_links(site, ['Ville 1', 'Sans élément']) == {'Ville 1': 'Q1001', 'Sans élément': None}
+    assert len(site.requests) == 1 # pages without item are not asked again either
+    museums.db.cur.execute('UPDATE links SET checked = datetime("NOW", ?)', ('-%s days' % (museums.harvest_frequency + 1),))
+    site.items['Sans élément'] = 'Q7'
+    assert museums.resolve_links(site, ['Ville 1', 'Sans élément']) == {'Ville 1': 'Q1001', 'Sans élément': 'Q7'}
+    assert len(site.requests) == 2
+
+
+def test_find_items_in_value(links):
+    (museums, site) = links
+    assert museums.find_items_in_value(site, '[[Ville 2|Lyon]] et [[Paname]], [[Fichier:Ville.jpg]]', []) == ['Q1002', 'Q1001']
+    assert museums.find_items_in_value(site, '[[Ville 2]] ([[Ville 3]])', [], one=True) is None
+    assert museums.find_items_in_value(site, '[[Ville 3#Histoire]]', [], one=True) == 'Q1003'
+    assert len(site.requests) == 2
@@ -0,0 +1,34 @@
+def test_preload_items_requests_50_items_at_once(wiki):
+    (pywb, site) = wiki
+    site.entities.update({'Q%s' % (n,): {'claims': {'P31': n}} for n in range(1, 121)})
+    pywb.preload_items(range(1, 121))
+    assert [len(request['ids']) for request in site.requests] == [50, 50, 20]
+    assert pywb.ItemPage(42).claims == {'P31': 42}
+    assert pywb.ItemPage(120).title() == 'Q120'
+    assert len(site.requests) == 3 # read from the cache
+
+
+def test_preload_items_skips_cached_items(wiki):
+    (pywb, site) = wiki
+    site.entities.update({'Q1': {}, 'Q2': {}})
+    pywb.preload_items([1])
+    pywb.preload_items([1, 2])
+    assert [request['ids'] for request in site.requests] == [['Q1'], ['Q2']]
+
+
+def test_preload_items_follows_redirects(wiki):
+    (pywb, site) = wiki
+    site.entities['Q2'] = {'claims': {'P17': 142}}
+    site.redirects['Q1'] = 'Q2'
+    pywb.preload_items([1])
+    assert pywb.items[1].title() == 'Q2' and pywb.items[1].claims == {'P17': 142}
+    assert len(site.requests) == 1
+
+
+def test_missing_items_do_not_exist_without_request(wiki):
+    (pywb, site) = wiki
+    site.entities['Q1'] = {}
+    pywb.preload_items([1, 999])
+    assert pywb.ItemPage(999).exists() is False
+    assert pywb.ItemPage(1).exists() is True
+    assert len(site.requests) == 1
@@ -0,0 +1,217 @@
+import queue
+import threading
+
+import pywikibot
+
+import pywdcollections as PYWDC
+from conftest import FakePage
+
+
+def batch(site, titles):
+    return [{'page': FakePage(site, title)} for title in titles]
+
+
+def test_preload_pages_requests(wiki):
+    (pywb, site) = wiki
+    titles = ['Page %s' % i for i in range(1000)]
+    for (i, title) in enumerate(titles):
+        site.pages[title] = '#REDIRECT [[Target %s]]' % i if i % 10 == 0 else '{{Infobox Musée}} %s' % i
+        site.pages['Target %s' % i] = 'target %s' % i
+    for start in range(0, len(titles), pywb.preload_size):
+        pywb.preload_pages(site, batch(site, titles[start:start + pywb.preload_size]))
+    # one request per 50 pages, one more for the 5 redirects of each batch
+    assert len(site.requests) == 20 + 20
+    assert pywb.page_stats['fetched'] == 1000
+
+
+def test_preload_pages_redirects_and_missing(wiki):
+    (pywb, site) = wiki
+    site.pages.update({
+        'Musée': 'text',
+        'Redirect': '#REDIRECT [[Musée]]',
+        'Broken': '#redirect [[Nowhere]]',
+        'Double': '#REDIRECT [[Redirect]]',
+    })
+    site.revisions['Musée'] = 42
+    pages = batch(site, ['Musée', 'Redirect', 'Broken', 'Double', 'Missing'])
+    pywb.preload_pages(site, pages)
+    (page, redirect, broken, double, missing) = pages
+    assert (page['revid'], page['fetched']) == (42, True)
+    assert redirect['page'].title() == 'Musée' and redirect['revid'] == 42
+    assert redirect['page'].text == 'text'
+    assert broken.get('missing') and double.get('missing') and missing.get('missing')
+    assert not any(page.get('fetched') for page in (broken, double, missing))
+    assert len(site.requests) == 2
+
+
+def test_page_worker(wiki):
+    (pywb, site) = wiki
+    titles = ['Page %s' % i for i in range(120)]
+    site.pages.update({title: 'text' for title in titles[:100]})
+    tasks = queue.Queue()
+    results = queue.Queue()
+    for start in range(0, len(titles), pywb.preload_size):
+        tasks.put(batch(site, titles[start:start + pywb.preload_size]))
+    tasks.put(None)
+    pywb.page_worker(tasks, results)
+    pages = [results.get_nowait() for i in range(results.qsize())]
+    assert len(pages) == 120
+    assert len([page for page in pages if page.get('missing')]) == 20
+    assert len(site.requests) == 3
+
+
+def test_page_worker_retries_when_asked_to_slow_down(wiki, monkeypatch):
+    (pywb, site) = wiki
+    pywb.backoff_delay = 0.01
+    site.pages['Musée'] = 'text'
+    preloadpages = site.preloadpages
+    failures = [pywikibot.exceptions.ServerError('503 Service Unavailable')]
+
+    def flaky(pages, groupsize = 50):
+        if failures:
+            site.requests.append('failed')
+            raise failures.pop()
+        return preloadpages(pages, groupsize)
+
+    monkeypatch.setattr(site, 'preloadpages', flaky)
+    tasks = queue.Queue()
+    results = queue.Queue()
+    worker = threading.Thread(target=pywb.page_worker, args=(tasks, results), daemon=True)
+    worker.start()
+    tasks.put(batch(site, ['Musée']))
+    page = results.get(timeout=10)
+    tasks.put(None)
+    worker.join(10)
+    assert (page['attempts'], page['fetched']) == (1, True)
+    assert site.requests[0] == 'failed' and len(site.requests) == 2
+
+
+def failing(site, monkeypatch, errors):
+    def preloadpages(pages, groupsize = 50):
+        site.requests.append('failed')
+        raise errors.pop(0)
+
+    monkeypatch.setattr(site, 'preloadpages', preloadpages)
+
+
+def test_failed_batch_is_marked_and_reported(wiki, monkeypatch, capsys):
+    (pywb, site) = wiki
+    failing(site, monkeypatch, [ValueError('unexpected answer')])
+    (tasks, results) = (queue.Queue(), queue.Queue())
+    tasks.put(batch(site, ['Musée 1', 'Musée 2']))
+    tasks.put(None)
+    pywb.page_worker(tasks, results)
+    pages = [results.get_nowait() for i in range(results.qsize())]
+    assert [format(page['error']) for page in pages] == ['unexpected answer'] * 2
+    assert len(site.requests) == 1 # not retried
+    assert 'unexpected answer' in capsys.readouterr().out
+
+
+def test_batch_failing_after_the_retries_is_marked(wiki, monkeypatch):
+    (pywb, site) = wiki
+    pywb.backoff_delay = 0.01
+    failing(site, monkeypatch, [pywikibot.exceptions.ServerError('503 Service Unavailable')] * 2)
+    (tasks, results) = (queue.Queue(), queue.Queue())
+    worker = threading.Thread(target=pywb.page_worker, args=(tasks, results, 1), daemon=True)
+    worker.start()
+    tasks.put(batch(site, ['Musée 1']))
+    page = results.get(timeout=10)
+    tasks.put(None)
+    worker.join(10)
+    assert page['attempts'] == 1 and isinstance(page['error'], pywikibot.exceptions.ServerError)
+    assert len(site.requests) == 2
+
+
+def test_pages_not_fetched_are_recorded_without_reading_their_text(museums):
+    museums.offline = False
+    (pywb, site) = (museums.pywb, museums.pywb.site)
+    site.pages['Musée 1'] = '{{Commonscat|Musée numéro 1}}'
+    pages = [{'page': pywb.Page('frwiki', 'Musée %s' % (n,)), 'key': ('frwiki', 'Musée %s' % (n,)), 'wikidata_id': n} for n in (1, 2)]
+    pywb.preload_pages(site, pages[:1])
+    pages[1]['error'] = ValueError('unexpected answer') # FakePage has no text until it is loaded
+    museums.load_template_aliases('frwiki')
+    museums.save_pages('frwiki', pages, museums.parse_pages('frwiki', pages).result(), 0, 2)
+    museums.db.cur.execute('SELECT wikidata_id, last_harvested IS NOT NULL, errors FROM interwiki WHERE wikidata_id IN (1, 2) ORDER BY wikidata_id')
+    assert museums.db.cur.fetchall() == [(1, 1, ''), (2, 0, 'fetch failed: unexpected answer')]
+    museums.db.cur.execute('SELECT wikidata_id, P373 FROM harvested')
+    assert museums.db.cur.fetchall() == [(1, 'Musée numéro 1')]
+
+
+def store(pywb, site, title, revid, templates, age = 0):
+    page = {'page': FakePage(site, title), 'key': ('frwiki', title), 'revid': revid, 'templates': templates}
+    pywb.store_pages('frwiki', [page])
+    db = pywb.page_store_database()
+    db.cur.execute('UPDATE pages SET checked = datetime("now", ?) WHERE title = ?', ('-%s days' % (age,), title))
+    db.con.commit()
+
+
+def stored_batch(pywb, site, titles):
+    pages = [{'page': FakePage(site, title), 'key': ('frwiki', title)} for title in titles]
+    pywb.lookup_pages('frwiki', pages)
+    return pages
+
+
+def test_stored_pages_of_the_same_revision_are_not_fetched(wiki):
+    (pywb, site) = wiki
+    site.pages['Musée'] = '{{Commonscat|Musée}}'
+    site.revisions['Musée'] = 7
+    templates = [('Commonscat', ['Musée'], {})]
+    store(pywb, site, 'Musée', 7, templates, age=3)
+    pages = stored_batch(pywb, site, ['Musée'])
+    assert not pages[0].get('fresh')
+    pywb.preload_pages(site, pages)
+    assert (pages[0]['templates'], pages[0]['revid']) == (templates, 7)
+    assert not pages[0].get('fetched')
+    assert [request['prop'] for request in site.requests] == ['info'] # no text loaded
+    assert pywb.page_stats['checked'] == 1
+
+
+def test_stored_pages_of_another_revision_are_fetched_again(wiki):
+    (pywb, site) = wiki
+    site.pages['Musée'] = '{{Commonscat|Musée}}'
+    site.revisions['Musée'] = 8
+    store(pywb, site, 'Musée', 7, [], age=3)
+    pages = stored_batch(pywb, site, ['Musée'])
+    pywb.preload_pages(site, pages)
+    assert 'templates' not in pages[0] and pages[0]['fetched'] and pages[0]['revid'] == 8
+    assert pages[0]['page'].text == '{{Commonscat|Musée}}'
+    assert len(site.requests) == 2
+
+
+def test_recent_stored_pages_need_no_request(wiki):
+    (pywb, site) = wiki
+    store(pywb, site, 'Musée', 7, [('Commonscat', ['Musée'], {})])
+    pages = stored_batch(pywb, site, ['Musée', 'Autre'])
+    assert pages[0]['fresh'] and pages[0]['templates'] == [('Commonscat', ['Musée'], {})]
+    assert 'stored' not in pages[1]
+    assert site.requests == [] and pywb.page_stats['reused'] == 1
+
+
+def test_page_store_is_shared_between_collections(museums):
+    museums.offline = False
+    site = museums.pywb.site
+    for n in range(1, 121):
+        site.pages['Musée %s' % (n,)] = '{{Commonscat|Musée numéro %s}}' % (n,)
+    assert museums.harvest_templates() == 120
+    fetches = [request for request in site.requests if 'titles' in request]
+    assert len(fetches) == 3
+
+    class Monuments(PYWDC.Collection):
+        def __init__(self, pywb):
+            self.db = PYWDC.Database(':memory:')
+            self.name = 'monuments'
+            self.main_type = 4989906
+            self.properties = [373]
+            self.languages = ['fr']
+            self.templates = {'frwiki': {'Commonscat': 373}}
+            super().__init__(pywb)
+
+    other = Monuments(PYWDC.PYWB('Test', 'fr')) # another run, same pages.db
+    for n in range(1, 121):
+        other.db.cur.execute('INSERT INTO monuments (wikidata_id) VALUES (?)', (n,))
+        other.db.cur.execute('INSERT INTO interwiki (wikidata_id, lang, title) VALUES (?, ?, ?)', (n, 'frwiki', 'Musée %s' % (n,)))
+    assert other.harvest_templates() == 120
+    assert [request for request in site.requests if 'titles' in request] == fetches # no page loaded again
+    assert other.pywb.page_stats['reused'] == 120
+    other.db.cur.execute('SELECT COUNT(P373) FROM harvested')
+    assert other.db.cur.fetchone() == (120,)
@@ -0,0 +1,61 @@
+import pytest
+
+
+@pytest.fixture
+def offline_collection(collection, monkeypatch):
+    # The plans must not depend on the wiki: listing template redirects would need the network.
+    def no_network(site_id):
+        raise AssertionError('load_template_aliases called while checking query plans')
+
+    monkeypatch.setattr(collection, 'load_template_aliases', no_network)
+    collection.templates['frwiki']['Commonscat'] = 373
+    collection.properties.append(373)
+    collection.db.cur.execute('ALTER TABLE museums ADD COLUMN P373')
+    collection.db.cur.execute('ALTER TABLE harvested ADD COLUMN P373')
+    collection.create_property_indexes()
+    return collection
+
+
+def test_hot_queries_do_not_scan_whole_tables(offline_collection):
+    assert offline_collection.check_query_plans() == []
+
+
+def test_scan_through_a_unique_index_is_reported(offline_collection, monkeypatch):
+    query = 'SELECT h.wikidata_id FROM harvested h JOIN `museums` w ON w.wikidata_id = h.wikidata_id WHERE h.P17 IS NOT NULL OR h.P131 IS NOT NULL ORDER BY h.wikidata_id'
+    monkeypatch.setattr(offline_collection, 'hot_queries', lambda: [(query, ())])
+    full_scans = offline_collection.check_query_plans()
+    assert len(full_scans) == 1
+    assert 'sqlite_autoindex_harvested_1' in full_scans[0][1]
+
+
+def test_covering_index_scan_is_reported(offline_collection, monkeypatch):
+    monkeypatch.setattr(offline_collection, 'hot_queries', lambda: [('SELECT lang, last_harvested FROM interwiki', ())])
+    assert [detail for (query, detail) in offline_collection.check_query_plans()] == ['SCAN interwiki USING COVERING INDEX interwiki_lang']
+
+
+def test_indexes_on_missing_values_are_dropped(collection):
+    collection.db.cur.execute('CREATE INDEX `museums_P17_missing` ON museums (wikidata_id) WHERE P17 IS NULL')
+    collection.set_metadata('schema_version', 1)
+    collection.migrate()
+    assert 'museums_P17_missing' not in collection.index_names('museums')
+    assert 'museums_outdated' in collection.index_names('museums')
+
+
+def test_copy_query_reads_the_index_of_each_property(offline_collection):
+    query = offline_collection.copy_harvested_properties_query(offline_collection.properties)
+    assert (query, ()) in offline_collection.hot_queries()
+    details = [row[-1] for row in offline_collection.db.read('EXPLAIN QUERY PLAN ' + query)]
+    assert ['SCAN h USING INDEX harvested_P%s' % (prop,) for prop in offline_collection.properties] == [detail for detail in details if detail.startswith('SCAN h')]
+
+
+def test_copy_query_groups_the_values_of_each_item(offline_collection):
+    db = offline_collection.db
+    db.cur.executemany('INSERT INTO museums (wikidata_id, P17, P131) VALUES (?, ?, ?)', [(1, None, None), (2, 142, None), (3, 142, 90)])
+    db.cur.executemany('INSERT INTO harvested (wikidata_id, source, P17, P131, P373) VALUES (?, ?, ?, ?, ?)', [
+        (1, 'frwiki', 142, 90, 'Musée 1'),
+        (1, 'enwiki', 142, None, None),
+        (2, 'frwiki', 183, 64, None), # P17 is already set on Wikidata
+        (3, 'frwiki', 142, 90, None), # nothing left to write
+    ])
+    db.cur.execute(offline_collection.copy_harvested_properties_query([17, 131, 373]))
+    assert db.cur.fetchall() == [(1, 'enwiki', 142, None, None), (1, 'frwiki', 142, 90, 'Musée 1'), (2, 'frwiki', None, 64, None)]
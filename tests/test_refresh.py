@@ -0,0 +1,73 @@
+import pytest
+
+from conftest import FakeResponse, sparql_json
+
+ENTITY = 'http://www.wikidata.org/entity/Q%s'
+
+
+def museum(wikidata_id, country = 142):
+    binding = {'museums': ENTITY % (wikidata_id,), 'modified': '2026-02-01T00:00:00Z'}
+    if country:
+        binding['P17'] = ENTITY % (country,)
+    return binding
+
+
+def resolved(wikidata_id, target = None, member = False):
+    binding = {'museums': ENTITY % (wikidata_id,)}
+    if target:
+        binding['target'] = ENTITY % (target,)
+    if member:
+        binding['member'] = '1'
+    return binding
+
+
+def stored(collection):
+    collection.db.cur.execute('SELECT wikidata_id, P17, last_modified IS NOT NULL FROM museums ORDER BY wikidata_id')
+    return collection.db.cur.fetchall()
+
+
+@pytest.fixture
+def outdated(collection):
+    collection.save_bindings([dict(museum(i), modified='2026-01-01T00:00:00Z') for i in range(1, 6)])
+    collection.db.cur.execute('UPDATE museums SET last_modified = NULL')
+    collection.bulk_refresh = True
+    return collection
+
+
+def test_outdated_items_are_refreshed_redirected_and_deleted(outdated, sparql):
+    sparql.responses.extend([
+        FakeResponse(sparql_json([museum(1, 183), museum(2, None)])), # Q2 lost its P17
+        FakeResponse(sparql_json([resolved(3, target=30), resolved(4), resolved(5)])), # Q4 deleted, Q5 left the collection
+        FakeResponse(sparql_json([museum(30)])),
+    ])
+    outdated.update_outdated_items()
+    assert stored(outdated) == [(1, 'Q183', 1), (2, None, 1), (30, 'Q142', 1)]
+    assert 'VALUES ?museums { wd:Q1 wd:Q2 wd:Q3 wd:Q4 wd:Q5 }' in sparql.queries[0]
+    assert 'VALUES ?museums { wd:Q3 wd:Q4 wd:Q5 }' in sparql.queries[1] and 'owl:sameAs' in sparql.queries[1]
+    assert 'VALUES ?museums { wd:Q30 }' in sparql.queries[2]
+
+
+def test_failed_chunk_deletes_nothing(outdated, sparql):
+    outdated.retries = 1
+    sparql.responses.append(ConnectionResetError('connection lost'))
+    outdated.update_outdated_items()
+    assert stored(outdated) == [(i, 'Q142', 0) for i in range(1, 6)]
+
+
+def test_failed_resolution_deletes_nothing(outdated, sparql):
+    outdated.retries = 1
+    sparql.responses.extend([FakeResponse(sparql_json([museum(1)])), ConnectionResetError('connection lost')])
+    outdated.update_outdated_items()
+    assert stored(outdated) == [(1, 'Q142', 1)] + [(i, 'Q142', 0) for i in range(2, 6)]
+
+
+def test_members_filtered_out_are_loaded_one_by_one(outdated, sparql):
+    sparql.responses.append(FakeResponse(sparql_json([resolved(4, member=True), resolved(5)])))
+    assert outdated.resolve_missing_items([4, 5]) == ([], [4])
+    assert [row[0] for row in stored(outdated)] == [1, 2, 3, 4]
+
+
+def test_redirect_to_an_item_of_the_collection(outdated, sparql):
+    sparql.responses.append(FakeResponse(sparql_json([resolved(4, target=1)])))
+    assert outdated.resolve_missing_items([4]) == ([], [])
+    assert [row[0] for row in stored(outdated)] == [1, 2, 3, 5]
@@ -0,0 +1,120 @@
+import pywikibot
+import pytest
+
+
+def test_backoff_is_capped_but_never_shorter_than_retry_after(wiki):
+    (pywb, site) = wiki
+    (pywb.backoff_delay, pywb.max_backoff_delay) = (5, 120)
+    assert [pywb.backoff(attempt) for attempt in range(6)] == [5, 10, 20, 40, 80, 120]
+    assert pywb.backoff(0, 30) == 30
+    assert pywb.backoff(5, 300) == 300
+
+
+def test_edits_keep_put_throttle_unless_paced(wiki):
+    (pywb, site) = wiki
+    pywb.call(site, lambda: None, write=True)
+    assert site.throttle.writedelay == 10
+    pywb.pace_edits = True
+    pywb.call(site, lambda: None, write=True)
+    assert site.throttle.writedelay == 1 / pywb.max_edit_rate
+
+
+def flaky(site, monkeypatch, failures = 1):
+    api = site.api
+    errors = [pywikibot.exceptions.ServerError('503 Service Unavailable')] * failures
+
+    def call(params):
+        if errors:
+            raise errors.pop()
+        return api(params)
+
+    monkeypatch.setattr(site, 'api', call)
+
+
+def test_requests_are_retried_when_asked_to_slow_down(wiki, monkeypatch):
+    (pywb, site) = wiki
+    pywb.backoff_delay = 0.01
+    site.pages['Musée'] = 'text'
+    flaky(site, monkeypatch)
+    assert pywb.get_revisions(site, ['Musée']) == {'Musée': 1}
+    assert len(site.requests) == 2
+    assert pywb.rate_limiter(site.hostname()).paused_until > 0
+
+
+def test_requests_fail_after_the_retries(wiki, monkeypatch):
+    (pywb, site) = wiki
+    (pywb.backoff_delay, pywb.retries) = (0.01, 3)
+    flaky(site, monkeypatch, failures=3)
+    with pytest.raises(pywikibot.exceptions.ServerError):
+        pywb.get_revisions(site, ['Musée'])
+    assert len(site.requests) == 3
+
+
+def test_failed_request_does_not_raise_the_rate(wiki):
+    (pywb, site) = wiki
+    limiter = pywb.rate_limiter(site.hostname())
+    (limiter.rate, limiter.concurrency) = (5, 4)
+
+    def broken():
+        raise ValueError('unexpected answer')
+
+    with pytest.raises(ValueError):
+        pywb.call(site, broken)
+    assert (limiter.rate, limiter.concurrency, limiter.active, limiter.paused_until) == (5, 4, 0, 0)
+    pywb.call(site, lambda: None)
+    assert limiter.rate > 5 and limiter.concurrency > 4
+
+
+class Edits:
+    # Saves which fail with a server error while failures are left.
+    def __init__(self, failures):
+        self.failures = failures
+        self.saved = []
+
+    def save(self, claim, summary = ''):
+        if self.failures:
+            self.failures -= 1
+            raise pywikibot.exceptions.ServerError('503 Service Unavailable')
+        self.saved.append((claim, summary))
+
+
+def test_failed_edits_are_queued_and_replayed(wiki):
+    (pywb, site) = wiki
+    (pywb.backoff_delay, pywb.retries, pywb.edit_rate, pywb.max_edit_rate) = (0.01, 2, 100, 100)
+    edits = Edits(failures=4)
+    assert pywb.edit(edits.save, 'P17', summary='Add P17') is False
+    assert pywb.edit(edits.save, 'P131') is False
+    assert len(pywb.failed_edits) == 2 and edits.saved == []
+    pywb.retry_failed_edits()
+    assert edits.saved == [('P17', 'Add P17'), ('P131', '')]
+    assert pywb.failed_edits == []
+
+
+def test_edits_failing_again_stay_queued(wiki):
+    (pywb, site) = wiki
+    (pywb.backoff_delay, pywb.retries, pywb.edit_rate, pywb.max_edit_rate) = (0.01, 1, 100, 100)
+    edits = Edits(failures=2)
+    pywb.edit(edits.save, 'P17')
+    pywb.retry_failed_edits()
+    assert [args for (function, args, kwargs) in pywb.failed_edits] == [('P17',)]
+    pywb.retry_failed_edits()
+    assert edits.saved == [('P17', '')] and pywb.failed_edits == []
+
+
+def test_outdated_items_are_retried_one_by_one(museums, monkeypatch):
+    pywb = museums.pywb
+    (pywb.backoff_delay, pywb.retries) = (0.01, 2)
+    attempts = []
+
+    def update(wikidata_id, i, total):
+        attempts.append(wikidata_id)
+        if wikidata_id == 2 or (wikidata_id == 3 and attempts.count(3) == 1):
+            raise pywikibot.exceptions.TimeoutError('maxlag')
+        museums.db.cur.execute('UPDATE museums SET last_modified = datetime("NOW") WHERE wikidata_id = ?', (wikidata_id,))
+
+    museums.db.cur.execute('DELETE FROM museums WHERE wikidata_id > 4')
+    monkeypatch.setattr(museums, 'update_outdated_item', update)
+    museums.update_outdated_items()
+    assert attempts == [1, 2, 2, 3, 3, 4]
+    museums.db.cur.execute(museums.outdated_query())
+    assert museums.db.cur.fetchall() == [(2,)] # updated next time
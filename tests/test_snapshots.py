@@ -0,0 +1,88 @@
+import os
+
+import pytest
+
+import pywdcollections as PYWDC
+
+
+def files(directory):
+    return sorted(name for (path, dirs, names) in os.walk(directory) for name in names if not name.startswith('snapshots.db'))
+
+
+@pytest.mark.parametrize('compression', ['lzma', 'zlib', None])
+def test_snapshots_round_trip(tmp_path, compression):
+    store = PYWDC.SnapshotStore(str(tmp_path), max_revisions=3, compression=compression)
+    store.add('frwiki', 'Musée', 'Musée', 1, 'première version é')
+    store.add('frwiki', 'Musée', 'Musée', 2, 'deuxième version ' * 1000)
+    store.add('frwiki', 'Redirection', 'Musée', 2, 'deuxième version ' * 1000) # same text, same file
+    store.add('frwiki', 'Vide', 'Vide', 1, '')
+    store.commit()
+    assert store.read('frwiki', 'Musée') == ('Musée', 2, 'deuxième version ' * 1000)
+    assert store.read('frwiki', 'Musée', 1) == ('Musée', 1, 'première version é')
+    assert store.read('frwiki', 'Musée', 3) is None and store.read('enwiki', 'Musée') is None
+    assert store.read_latest('frwiki', ['Redirection', 'Vide', 'Inconnue']) == {'Redirection': ('Musée', 2, 'deuxième version ' * 1000), 'Vide': ('Vide', 1, '')}
+    assert store.stats() == {'revisions': 4, 'files': 3}
+    assert len(files(str(tmp_path))) == 3
+
+
+def test_older_revisions_and_their_files_are_removed(tmp_path):
+    store = PYWDC.SnapshotStore(str(tmp_path), max_revisions=2)
+    for revid in (1, 2, 3):
+        store.add('frwiki', 'Musée', 'Musée', revid, 'version %s' % (revid,))
+    store.add('frwiki', 'Copie', 'Copie', 1, 'version 2') # shares the file of revision 2
+    store.add('frwiki', 'Musée', 'Musée', 4, 'version 4')
+    store.commit()
+    assert [store.read('frwiki', 'Musée', revid) is not None for revid in (1, 2, 3, 4)] == [False, False, True, True]
+    assert store.read('frwiki', 'Copie')[2] == 'version 2'
+    assert store.stats() == {'revisions': 3, 'files': 3}
+    assert len(files(str(tmp_path))) == 3
+
+
+@pytest.fixture
+def communes(wiki, tmp_path):
+    # Offline collection of 3 museums with a link to their commune, checked against the constraints of P131.
+    (pywb, site) = wiki
+
+    class Museums(PYWDC.Collection):
+        def __init__(self, pywb):
+            self.db = PYWDC.Database(':memory:')
+            self.name = 'museums'
+            self.main_type = 33506
+            self.properties = [131, 373]
+            self.languages = ['fr']
+            self.templates = {'frwiki': {'Infobox Musée': {'commune': 131}}}
+            self.offline = True
+            super().__init__(pywb)
+
+    pywb.snapshots = PYWDC.SnapshotStore(str(tmp_path / 'snapshots'))
+    collection = Museums(pywb)
+    for (n, commune) in ((1, 'Paris'), (2, 'Lyon'), (3, 'Nulle part')):
+        title = 'Musée %s' % (n,)
+        collection.db.cur.execute('INSERT INTO museums (wikidata_id) VALUES (?)', (n,))
+        collection.db.cur.execute('INSERT INTO interwiki (wikidata_id, lang, title, last_harvested) VALUES (?, ?, ?, datetime("NOW"))', (n, 'frwiki', title))
+        pywb.snapshots.add('frwiki', title, title, n, '{{Infobox Musée|commune=[[%s]]}} {{Commonscat|Musée %s}}' % (commune, n))
+    pywb.snapshots.commit()
+    collection.db.cur.executemany('INSERT INTO links (lang, title, wikidata_id, checked) VALUES ("frwiki", ?, ?, datetime("NOW", "-1 year"))', [('Paris', 'Q90'), ('Lyon', 'Q456')])
+    db = pywb.constraints_database()
+    db.cur.executemany('INSERT INTO entities (wikidata_id, target, P31, P279, checked) VALUES (?, ?, ?, "[]", datetime("NOW"))', [(90, 90, '[515]'), (456, 456, '[515]')])
+    db.con.commit()
+    return (collection, site)
+
+
+def test_offline_harvest_makes_no_request(communes):
+    (collection, site) = communes
+    assert collection.harvest_templates() == 3 # harvested again whatever their date
+    collection.db.cur.execute('SELECT wikidata_id, P131 FROM harvested ORDER BY wikidata_id')
+    assert collection.db.cur.fetchall() == [(1, 'Q90'), (2, 'Q456')] # the unresolved link is left
+    assert site.requests == []
+
+
+def test_mapping_change_is_applied_offline(communes):
+    (collection, site) = communes
+    collection.harvest_templates()
+    collection.templates['frwiki']['Commonscat'] = 373
+    collection.harvest_plans = {}
+    collection.harvest_templates()
+    collection.db.cur.execute('SELECT wikidata_id, P373 FROM harvested ORDER BY wikidata_id')
+    assert collection.db.cur.fetchall() == [(1, 'Musée 1'), (2, 'Musée 2'), (3, 'Musée 3')]
+    assert site.requests == []
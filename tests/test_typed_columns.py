@@ -0,0 +1,115 @@
+import pytest
+
+import pywdcollections as PYWDC
+from conftest import FakePYWB
+
+ENTITY = 'http://www.wikidata.org/entity/Q%s'
+BINDINGS = [
+    {'monuments': ENTITY % 1, 'P17': ENTITY % 142, 'P625': 'Point(2.35 48.85)', 'P571': '1850-01-01T00:00:00Z', 'P2971': '1200', 'P18': 'http://commons.wikimedia.org/wiki/Special:FilePath/Foo%20bar.jpg', 'modified': '2026-01-01T00:00:00Z'},
+    {'monuments': ENTITY % 2, 'P17': 'http://www.wikidata.org/.well-known/genid/0a1b2c', 'P571': '-300-01-01T00:00:00Z', 'modified': '2026-01-01T00:00:00Z'}, # unknown value
+    {'monuments': ENTITY % 3, 'modified': '2026-01-01T00:00:00Z'},
+]
+
+
+def collection(path, typed):
+    class Monuments(PYWDC.Collection):
+        def __init__(self, pywb):
+            self.db = PYWDC.Database(path)
+            self.name = 'monuments'
+            self.main_type = 4989906
+            self.properties = [17, 18, 571, 625, 2971]
+            self.languages = ['fr']
+            self.templates = {}
+            self.typed_columns = typed
+            super().__init__(pywb)
+
+    return Monuments(FakePYWB())
+
+
+def rows(collection, columns = 'wikidata_id, P17, P18, P571, P625, P2971'):
+    collection.db.cur.execute('SELECT %s FROM monuments ORDER BY wikidata_id' % (columns,))
+    return collection.db.cur.fetchall()
+
+
+def indexes(collection):
+    collection.db.cur.execute('SELECT name, sql FROM sqlite_master WHERE type = "index" AND tbl_name = "monuments" ORDER BY name')
+    return collection.db.cur.fetchall()
+
+
+@pytest.fixture
+def untyped(tmp_path):
+    old = collection(str(tmp_path / 'monuments.db'), False)
+    old.save_bindings(BINDINGS)
+    old.db.cur.execute('ALTER TABLE monuments ADD COLUMN P31') # property not harvested anymore
+    old.db.cur.execute('UPDATE monuments SET P31 = "Q4989906"')
+    old.db.cur.execute('UPDATE monuments SET P2971 = "about 300" WHERE wikidata_id = 2') # edited by hand
+    old.db.con.commit()
+    assert rows(old)[0] == (1, 'Q142', 'Foo bar.jpg', '1850-01-01T00:00:00Z', '48.85|2.35|0', '1200')
+    before = indexes(old)
+    old.db.close()
+    return (str(tmp_path / 'monuments.db'), before)
+
+
+def test_migration_converts_the_values(untyped):
+    (path, before) = untyped
+    new = collection(path, True)
+    assert rows(new, 'wikidata_id, P17, P18, P571, P625, P625_longitude, P2971, P31') == [
+        (1, 142, 'Foo bar.jpg', '1850-01-01', 48.85, 2.35, 1200, 'Q4989906'),
+        (2, None, None, '-0300-01-01', None, None, 'about 300', 'Q4989906'),
+        (3, None, None, None, None, None, None, 'Q4989906'),
+    ]
+    new.db.cur.execute('SELECT typeof(P17), typeof(P625), typeof(P2971), typeof(last_modified) FROM monuments WHERE wikidata_id = 1')
+    assert new.db.cur.fetchone() == ('integer', 'real', 'integer', 'text')
+    assert indexes(new) == before
+    assert new.get_metadata('typed_columns') == 1
+
+
+def test_migration_matches_a_typed_fetch(untyped, tmp_path):
+    (path, before) = untyped
+    migrated = collection(path, True)
+    fetched = collection(str(tmp_path / 'typed.db'), True)
+    fetched.save_bindings(BINDINGS)
+    assert rows(migrated)[0::2] == rows(fetched)[0::2]
+
+
+def test_migration_runs_once(untyped, capsys):
+    (path, before) = untyped
+    collection(path, True).db.close()
+    capsys.readouterr()
+    again = collection(path, True)
+    assert 'Converting' not in capsys.readouterr().out
+    assert len(rows(again)) == 3
+
+
+def test_typed_database_opened_without_the_option(untyped, capsys):
+    (path, before) = untyped
+    collection(path, True).db.close()
+    capsys.readouterr()
+    collection(path, False)
+    assert 'typed_columns = True' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('kind, value, expected', [
+    ('entity', 'Q42', [42]),
+    ('entity', '42', [42]),
+    ('entity', '0a1b2c', [None]),
+    ('entity', None, [None]),
+    ('coordinates', '48.85|2.35|0', [48.85, 2.35]),
+    ('coordinates', '48.85', [None, None]),
+    ('coordinates', 'north|east', [None, None]),
+    ('coordinates', '', [None, None]),
+    ('date', '1850-01-01T00:00:00Z', ['1850-01-01']),
+    ('date', '+1850-01-01T00:00:00Z', ['1850-01-01']),
+    ('date', '-44-03-15T00:00:00Z', ['-0044-03-15']),
+    ('date', 'circa 1850', ['circa 1850']),
+    ('date', '', [None]),
+    ('integer', '1200', [1200]),
+    ('integer', 'about 300', ['about 300']),
+    ('string', 'AB-123', ['AB-123']),
+])
+def test_column_values(tmp_path, kind, value, expected):
+    assert collection(':memory:', True).column_values(kind, value) == expected
+
+
+def test_untyped_column_values_are_unchanged():
+    assert collection(':memory:', False).column_values('coordinates', '48.85|2.35|0') == ['48.85|2.35|0']